@@ -0,0 +1,16 @@
+#!/bin/sh
+# Linux build of the shim (used by tests/benchmark.py and CI).
+# Set E2 to a libext2fs install prefix if it is not in the system paths.
+
+E2=${E2:-/usr}
+CC=${CC:-gcc}
+
+cd "$(dirname "$0")" || exit 1
+mkdir -p bin
+
+$CC -O2 -fPIC -fvisibility=hidden \
+  -I"$E2/include" -L"$E2/lib" \
+  -shared -o bin/libext4shim.so ext4shim.c \
+  -lext2fs -lcom_err || exit 1
+
+echo "Build completed."
@@ -1,5 +1,6 @@
 // ext4shim.c
-// Windows shim over libext2fs for Python (ctypes).
+// Shim over libext2fs for Python (ctypes). Primary target is Windows;
+// also builds on Linux as libext4shim.so (see build_shim.sh).
 // Build example (MinGW64):
 //   gcc -O2 -D_WIN32_WINNT=0x0601 ^
 //     -I"C:\dev\e2fs-mingw64\include" -L"C:\dev\e2fs-mingw64\lib" ^
@@ -9,18 +10,27 @@
 // Exports are declared via __declspec(dllexport). You may also provide a .def file.
 
 #define _CRT_SECURE_NO_WARNINGS
+#ifndef _WIN32
+#  define _GNU_SOURCE  // fallocate() for ext4_trim
+#endif
 #include <stdio.h>
 #include <stdint.h>
 #include <stdlib.h>
 #include <string.h>
+#include <time.h>
 
 #ifdef _WIN32
+#  include <windows.h>
 #  include <io.h>
 #  include <fcntl.h>
 #  include <sys/types.h>
 #  include <sys/stat.h>
 #  define lseek64  _lseeki64
 #  define ftruncate64 _chsize_s
+#else
+#  include <unistd.h>
+#  include <fcntl.h>
+#  include <sys/stat.h>
 #endif
 
 #include <errno.h>
@@ -30,14 +40,123 @@
 
 // ------------------------ Common ------------------------
 
-#define SHIM_API __declspec(dllexport)
+#ifdef _WIN32
+#  define SHIM_API __declspec(dllexport)
+#  define SHIM_IO_MANAGER windows_io_manager
+#else
+#  define SHIM_API __attribute__((visibility("default")))
+#  define SHIM_IO_MANAGER unix_io_manager
+#endif
 #define MIN(a,b) ((a)<(b)?(a):(b))
 #define MINU64(a,b) ((uint64_t)((a)<(b)?(a):(b)))
 
+// Per-API counters; keep in sync with op_names.
+enum {
+    OP_OPEN, OP_LISTDIR, OP_STAT, OP_READ, OP_WRITE, OP_MKDIRS, OP_REMOVE, OP_RENAME, OP_HASH,
+    OP_RMTREE, OP_MOVE, OP_COPY, OP_COPYTREE, OP_SCAN_INODES, OP_SUBMIT, OP_TRIM, OP_CLONE,
+    OP_READ_AT, OP_DU, OP_WALK, OP_MAP_DIGEST, OP_SYNC, OP_READ_INODES,
+    OP_COUNT
+};
+static const char* op_names[OP_COUNT] = {
+    "open", "listdir", "stat", "read", "write_overwrite", "mkdirs", "remove", "rename", "hash",
+    "rmtree", "move", "copy", "copytree", "scan_inodes", "submit", "trim", "clone",
+    "read_at", "du", "walk", "map_digest", "sync", "read_inodes"
+};
+
+typedef struct {
+    uint64_t calls;
+    uint64_t ns;
+} op_stat_t;
+
+typedef struct {
+    op_stat_t ops[OP_COUNT];
+    uint64_t namei;
+    uint64_t lookups;
+    uint64_t inode_reads;
+    uint64_t inode_writes;
+    uint64_t block_reads;
+    uint64_t block_writes;
+    uint64_t bytes_read;
+    uint64_t bytes_written;
+    uint64_t flushes;
+    uint64_t flush_ns;
+    uint64_t bitmap_loads;
+    uint64_t bitmap_ns;
+    uint64_t journal_commits;
+    uint64_t journal_blocks;
+    uint64_t checkpoints;
+    uint64_t checkpoint_blocks;
+} shim_stats_t;
+
+typedef struct jent jent_t;  // one captured block (see the Journal section)
+
+typedef struct {
+    ext2_filsys fs;
+    io_manager io;                // device I/O that bypasses the capture hooks
+    int tried, active;            // attach attempted / metadata is being captured
+    int direct;                   // > 0 while file data is written (in place when safe)
+    blk64_t* map;                 // log block -> device block
+    uint8_t* jsb;                 // the log's superblock block
+    uint32_t maxlen, first, head; // log area is [first, maxlen); head is the next free block
+    uint32_t tid;                 // sequence number of the next transaction
+    int empty;                    // nothing logged since the last checkpoint
+    uint32_t incompat, tag_bytes, per_desc, seed;
+    jent_t** table;               // captured blocks by device block number
+    uint32_t buckets, count;
+    jent_t** run;                 // blocks changed since the last commit
+    uint32_t nrun, run_cap;
+    uint64_t mem;                 // bytes of captured block copies
+    ext2fs_block_bitmap busy;     // in use by the last commit or allocated since: the allocators avoid these
+    ext2fs_block_bitmap reused;   // allocated since the last commit although it may still reference them
+    uint32_t interval_ms;         // group ops into one transaction for this long
+    uint64_t txn_start;           // now_ns() of the first op not yet committed, 0 if none
+    errcode_t (*old_alloc)(ext2_filsys, blk64_t, blk64_t*);
+    errcode_t (*old_range)(ext2_filsys, int, blk64_t, blk64_t, blk64_t*, blk64_t*);
+} journal_t;
+
 typedef struct {
     ext2_filsys fs;
+    shim_stats_t stats;
+    journal_t j;
+    int in_batch;                         // ext4_submit running: commits are deferred
+    io_manager io_base;                   // manager ext2fs_open picked
+    struct struct_io_manager io_counting; // copy of io_base with counting read/write hooks
 } shim_fs_t;
 
+// libext2fs callbacks only see the filesystem; the handle rides in fs->priv_data.
+static shim_fs_t* shim_of(ext2_filsys fs) {
+    return fs ? (shim_fs_t*)fs->priv_data : NULL;
+}
+
+static uint64_t now_ns(void) {
+#ifdef _WIN32
+    static LARGE_INTEGER freq;
+    LARGE_INTEGER c;
+    if (!freq.QuadPart) QueryPerformanceFrequency(&freq);
+    QueryPerformanceCounter(&c);
+    return (uint64_t)((double)c.QuadPart * 1e9 / (double)freq.QuadPart);
+#else
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return (uint64_t)ts.tv_sec * 1000000000ull + (uint64_t)ts.tv_nsec;
+#endif
+}
+
+static void stats_op(void* fs_handle, int op, uint64_t ns) {
+    if (!fs_handle) return;
+    shim_fs_t* h = (shim_fs_t*)fs_handle;
+    h->stats.ops[op].calls++;
+    h->stats.ops[op].ns += ns;
+}
+
+// Exported entry points are thin wrappers: time the do_* body and account it to op.
+#define SHIM_TIMED(fs_handle, op, call) do {                 \
+        uint64_t t0_ = now_ns();                             \
+        int rc_ = (call);                                    \
+        stats_op((fs_handle), (op), now_ns() - t0_);         \
+        return rc_;                                          \
+    } while (0)
+
 static void set_err(char* err, int errlen, const char* msg) {
     if (!err || errlen <= 0) return;
     if (!msg) { err[0] = 0; return; }
@@ -49,7 +168,9 @@ static void set_err(char* err, int errlen, const char* msg) {
 }
 
 static void set_err_rc(char* err, int errlen, const char* prefix, errcode_t rc) {
+    static int table_ready = 0;
     if (!err || errlen <= 0) return;
+    if (!table_ready) { initialize_ext2_error_table(); table_ready = 1; }
     const char* em = error_message(rc);
     if (!prefix) prefix = "";
 #ifdef _MSC_VER
@@ -102,6 +223,604 @@ static int json_escape_name(const char* s, char* out, int outcap) {
     return 0;
 }
 
+static int append_json(char* out, int cap, int* pos, const char* s) {
+    int n = (int)strlen(s);
+    if (*pos + n + 1 > cap) return -1;
+    memcpy(out + *pos, s, (size_t)n);
+    *pos += n;
+    out[*pos] = 0;
+    return 0;
+}
+
+// ------------------------ htree directories ------------------------
+// Directories start linear; when the first block fills up on a dir_index
+// filesystem they are converted to a hashed tree (root + leaves, one index
+// level at most) like the kernel does. Lookups, inserts and unlinks on
+// indexed directories touch only the blocks on the hash path.
+
+#define DX_MAX_LEVELS 2   // root + one index level (no largedir)
+#define DX_BLOCK_MASK 0x0fffffffu
+
+typedef struct {
+    blk64_t pblk;
+    char* buf;
+    struct ext2_dx_entry* entries;
+    int at;
+} dx_frame_t;
+
+typedef struct {
+    dx_frame_t frames[DX_MAX_LEVELS];
+    int levels;          // number of frames in use
+    ext2_dirhash_t hash;
+} dx_path_t;
+
+static struct ext2_dx_countlimit* dx_cl(dx_frame_t* f) {
+    return (struct ext2_dx_countlimit*)f->entries;
+}
+
+static int dx_csum_size(ext2_filsys fs) {
+    return ext2fs_has_feature_metadata_csum(fs->super) ? (int)sizeof(struct ext2_dx_tail) : 0;
+}
+
+static int leaf_tail_size(ext2_filsys fs) {
+    return ext2fs_has_feature_metadata_csum(fs->super) ? (int)sizeof(struct ext2_dir_entry_tail) : 0;
+}
+
+static int dx_root_limit(ext2_filsys fs) {
+    return (int)((fs->blocksize - 32 - dx_csum_size(fs)) / sizeof(struct ext2_dx_entry));
+}
+
+static int dx_node_limit(ext2_filsys fs) {
+    return (int)((fs->blocksize - 8 - dx_csum_size(fs)) / sizeof(struct ext2_dx_entry));
+}
+
+static int dx_hash_version(ext2_filsys fs, int root_version) {
+    if (root_version <= EXT2_HASH_TEA && (fs->super->s_flags & EXT2_FLAGS_UNSIGNED_HASH)) return root_version + 3;
+    return root_version;
+}
+
+static void dx_path_free(dx_path_t* p) {
+    for (int i = 0; i < DX_MAX_LEVELS; ++i) free(p->frames[i].buf);
+    memset(p, 0, sizeof(*p));
+}
+
+static errcode_t dir_block_map(ext2_filsys fs, ext2_ino_t dir, struct ext2_inode* din, blk64_t lblk, blk64_t* pblk) {
+    *pblk = 0;
+    errcode_t rc = ext2fs_bmap2(fs, dir, din, NULL, 0, lblk, NULL, pblk);
+    if (!rc && *pblk == 0) rc = EXT2_ET_DIR_CORRUPTED;
+    return rc;
+}
+
+static errcode_t dir_read_lblk(ext2_filsys fs, ext2_ino_t dir, struct ext2_inode* din, blk64_t lblk, blk64_t* pblk, char** buf) {
+    errcode_t rc = dir_block_map(fs, dir, din, lblk, pblk);
+    if (rc) return rc;
+    if (!*buf && !(*buf = (char*)malloc(fs->blocksize))) return EXT2_ET_NO_MEMORY;
+    return ext2fs_read_dir_block4(fs, *pblk, *buf, 0, dir);
+}
+
+// Appends one block to a directory; returns its logical and physical number.
+static errcode_t dir_append_block(ext2_filsys fs, ext2_ino_t dir, struct ext2_inode* din, blk64_t* lblk, blk64_t* pblk) {
+    *lblk = EXT2_I_SIZE(din) / fs->blocksize;
+    *pblk = 0;
+    errcode_t rc = ext2fs_bmap2(fs, dir, din, NULL, BMAP_ALLOC, *lblk, NULL, pblk);
+    if (rc) return rc;
+    rc = ext2fs_inode_size_set(fs, din, (*lblk + 1) * fs->blocksize);
+    if (rc) return rc;
+    return ext2fs_write_inode(fs, dir, din);
+}
+
+// Walks from the root to the index entry covering name's hash.
+static errcode_t dx_probe(ext2_filsys fs, ext2_ino_t dir, struct ext2_inode* din, const char* name, int len, dx_path_t* p) {
+    memset(p, 0, sizeof(*p));
+    dx_frame_t* f = &p->frames[0];
+    errcode_t rc = dir_read_lblk(fs, dir, din, 0, &f->pblk, &f->buf);
+    if (rc) return rc;
+
+    struct ext2_dx_root_info* info = (struct ext2_dx_root_info*)(f->buf + 24);
+    if (info->reserved_zero || info->info_length != 8 || info->indirect_levels >= DX_MAX_LEVELS) return EXT2_ET_DIR_CORRUPTED;
+    ext2_dirhash_t minor = 0;
+    rc = ext2fs_dirhash(dx_hash_version(fs, info->hash_version), name, len, fs->super->s_hash_seed, &p->hash, &minor);
+    if (rc) return rc;
+
+    p->levels = info->indirect_levels + 1;
+    f->entries = (struct ext2_dx_entry*)(f->buf + 24 + info->info_length);
+    for (int level = 0; ; ++level) {
+        f = &p->frames[level];
+        int count = dx_cl(f)->count;
+        if (count == 0 || count > dx_cl(f)->limit) return EXT2_ET_DIR_CORRUPTED;
+        int lo = 1, hi = count - 1;
+        while (lo <= hi) {
+            int mid = (lo + hi) / 2;
+            if (f->entries[mid].hash > p->hash) hi = mid - 1; else lo = mid + 1;
+        }
+        f->at = lo - 1;
+        if (level + 1 == p->levels) return 0;
+
+        dx_frame_t* c = &p->frames[level + 1];
+        rc = dir_read_lblk(fs, dir, din, f->entries[f->at].block & DX_BLOCK_MASK, &c->pblk, &c->buf);
+        if (rc) return rc;
+        c->entries = (struct ext2_dx_entry*)(c->buf + 8);
+    }
+}
+
+// Moves to the next leaf if it may still hold entries with the probed hash
+// (hash collisions spill over with the low bit of the index hash set).
+// Returns 1 when moved, 0 when the hash range is exhausted.
+static int dx_next_leaf(ext2_filsys fs, ext2_ino_t dir, struct ext2_inode* din, dx_path_t* p, errcode_t* rc) {
+    int level = p->levels - 1;
+    while (level >= 0 && p->frames[level].at + 1 >= dx_cl(&p->frames[level])->count) level--;
+    if (level < 0) return 0;
+    dx_frame_t* f = &p->frames[level];
+    f->at++;
+    if ((f->entries[f->at].hash & ~1u) != p->hash) return 0;
+    for (; level + 1 < p->levels; ++level) {
+        dx_frame_t* c = &p->frames[level + 1];
+        *rc = dir_read_lblk(fs, dir, din, p->frames[level].entries[p->frames[level].at].block & DX_BLOCK_MASK, &c->pblk, &c->buf);
+        if (*rc) return 0;
+        c->entries = (struct ext2_dx_entry*)(c->buf + 8);
+        c->at = 0;
+    }
+    return 1;
+}
+
+static blk64_t dx_leaf_lblk(dx_path_t* p) {
+    dx_frame_t* f = &p->frames[p->levels - 1];
+    return f->entries[f->at].block & DX_BLOCK_MASK;
+}
+
+// Finds name in a leaf block; *prev is the entry before it (or -1).
+static errcode_t leaf_find(ext2_filsys fs, char* buf, const char* name, int len, int* off, int* prev) {
+    int o = 0, pv = -1;
+    while (o + 8 <= (int)fs->blocksize) {
+        struct ext2_dir_entry* de = (struct ext2_dir_entry*)(buf + o);
+        unsigned int rec_len = 0;
+        errcode_t rc = ext2fs_get_rec_len(fs, de, &rec_len);
+        if (rc) return rc;
+        if (rec_len < 8 || o + (int)rec_len > (int)fs->blocksize) return EXT2_ET_DIR_CORRUPTED;
+        if (de->inode && ext2fs_dirent_name_len(de) == len && memcmp(de->name, name, (size_t)len) == 0) {
+            *off = o; *prev = pv;
+            return 0;
+        }
+        pv = o;
+        o += (int)rec_len;
+    }
+    return EXT2_ET_FILE_NOT_FOUND;
+}
+
+typedef struct {
+    blk64_t pblk;
+    char* buf;     // leaf block holding the entry
+    int off;
+    int prev;
+} dx_hit_t;
+
+static errcode_t dx_find(ext2_filsys fs, ext2_ino_t dir, struct ext2_inode* din, const char* name, int len, dx_hit_t* hit) {
+    dx_path_t p;
+    errcode_t rc = dx_probe(fs, dir, din, name, len, &p);
+    memset(hit, 0, sizeof(*hit));
+    while (!rc) {
+        rc = dir_read_lblk(fs, dir, din, dx_leaf_lblk(&p), &hit->pblk, &hit->buf);
+        if (rc) break;
+        rc = leaf_find(fs, hit->buf, name, len, &hit->off, &hit->prev);
+        if (rc != EXT2_ET_FILE_NOT_FOUND) break;
+        if (!dx_next_leaf(fs, dir, din, &p, &rc)) { if (!rc) rc = EXT2_ET_FILE_NOT_FOUND; break; }
+    }
+    dx_path_free(&p);
+    if (rc) { free(hit->buf); hit->buf = NULL; }
+    return rc;
+}
+
+static errcode_t dx_lookup(ext2_filsys fs, ext2_ino_t dir, struct ext2_inode* din, const char* name, ext2_ino_t* out_ino, int* out_ftype) {
+    dx_hit_t hit;
+    errcode_t rc = dx_find(fs, dir, din, name, (int)strlen(name), &hit);
+    if (rc) return rc;
+    struct ext2_dir_entry* de = (struct ext2_dir_entry*)(hit.buf + hit.off);
+    *out_ino = de->inode;
+    if (out_ftype) *out_ftype = ext2fs_has_feature_filetype(fs->super) ? ext2fs_dirent_file_type(de) : EXT2_FT_UNKNOWN;
+    free(hit.buf);
+    return 0;
+}
+
+static errcode_t dx_unlink(ext2_filsys fs, ext2_ino_t dir, struct ext2_inode* din, const char* name, ext2_ino_t ino) {
+    dx_hit_t hit;
+    errcode_t rc = dx_find(fs, dir, din, name, (int)strlen(name), &hit);
+    if (rc) return rc;
+    struct ext2_dir_entry* de = (struct ext2_dir_entry*)(hit.buf + hit.off);
+    if (ino && de->inode != ino) { free(hit.buf); return EXT2_ET_FILE_NOT_FOUND; }
+    if (hit.prev >= 0) {
+        struct ext2_dir_entry* pde = (struct ext2_dir_entry*)(hit.buf + hit.prev);
+        unsigned int plen = 0, len = 0;
+        ext2fs_get_rec_len(fs, pde, &plen);
+        ext2fs_get_rec_len(fs, de, &len);
+        rc = ext2fs_set_rec_len(fs, plen + len, pde);
+    } else {
+        de->inode = 0;
+    }
+    if (!rc) rc = ext2fs_write_dir_block4(fs, hit.pblk, hit.buf, 0, dir);
+    free(hit.buf);
+    return rc;
+}
+
+// Places a new entry into free space of a leaf; EXT2_ET_DIR_NO_SPACE if full.
+static errcode_t leaf_insert(ext2_filsys fs, char* buf, const char* name, int len, ext2_ino_t ino, int ftype) {
+    int need = EXT2_DIR_REC_LEN(len);
+    int end = (int)fs->blocksize - leaf_tail_size(fs);
+    int o = 0;
+    while (o < end) {
+        struct ext2_dir_entry* de = (struct ext2_dir_entry*)(buf + o);
+        unsigned int rec_len = 0;
+        errcode_t rc = ext2fs_get_rec_len(fs, de, &rec_len);
+        if (rc) return rc;
+        if (rec_len < 8 || o + (int)rec_len > end) return EXT2_ET_DIR_CORRUPTED;
+        int used = de->inode ? EXT2_DIR_REC_LEN(ext2fs_dirent_name_len(de)) : 0;
+        if ((int)rec_len >= used + need) {
+            if (used) {
+                ext2fs_set_rec_len(fs, (unsigned)used, de);
+                de = (struct ext2_dir_entry*)(buf + o + used);
+                ext2fs_set_rec_len(fs, rec_len - (unsigned)used, de);
+            }
+            de->inode = ino;
+            ext2fs_dirent_set_name_len(de, len);
+            ext2fs_dirent_set_file_type(de, ext2fs_has_feature_filetype(fs->super) ? ftype : EXT2_FT_UNKNOWN);
+            memcpy(de->name, name, (size_t)len);
+            return 0;
+        }
+        o += (int)rec_len;
+    }
+    return EXT2_ET_DIR_NO_SPACE;
+}
+
+typedef struct {
+    ext2_dirhash_t hash;
+    ext2_ino_t ino;
+    int ftype;
+    int len;
+    char name[256];
+} dx_ent_t;
+
+static int dx_ent_cmp(const void* a, const void* b) {
+    ext2_dirhash_t x = ((const dx_ent_t*)a)->hash, y = ((const dx_ent_t*)b)->hash;
+    return x < y ? -1 : (x > y ? 1 : 0);
+}
+
+// Live entries of a directory block (skipping '.'/'..' when skip_dots).
+static errcode_t leaf_collect(ext2_filsys fs, char* buf, int hash_version, int skip_dots, dx_ent_t* out, int* n) {
+    int end = (int)fs->blocksize - leaf_tail_size(fs), o = 0;
+    *n = 0;
+    while (o < end) {
+        struct ext2_dir_entry* de = (struct ext2_dir_entry*)(buf + o);
+        unsigned int rec_len = 0;
+        errcode_t rc = ext2fs_get_rec_len(fs, de, &rec_len);
+        if (rc) return rc;
+        if (rec_len < 8 || o + (int)rec_len > end) return EXT2_ET_DIR_CORRUPTED;
+        int len = ext2fs_dirent_name_len(de);
+        int dots = (len == 1 && de->name[0] == '.') || (len == 2 && de->name[0] == '.' && de->name[1] == '.');
+        if (de->inode && len && !(skip_dots && dots)) {
+            dx_ent_t* e = &out[(*n)++];
+            e->ino = de->inode;
+            e->ftype = ext2fs_dirent_file_type(de);
+            e->len = len;
+            memcpy(e->name, de->name, (size_t)len);
+            e->name[len] = 0;
+            ext2_dirhash_t minor = 0;
+            rc = ext2fs_dirhash(hash_version, e->name, len, fs->super->s_hash_seed, &e->hash, &minor);
+            if (rc) return rc;
+        }
+        o += (int)rec_len;
+    }
+    return 0;
+}
+
+// Packs entries into an empty leaf block (with checksum tail if needed).
+static void leaf_fill(ext2_filsys fs, char* buf, dx_ent_t* ents, int n) {
+    int end = (int)fs->blocksize - leaf_tail_size(fs), o = 0;
+    memset(buf, 0, fs->blocksize);
+    for (int i = 0; i < n; ++i) {
+        struct ext2_dir_entry* de = (struct ext2_dir_entry*)(buf + o);
+        int rec = (i == n - 1) ? end - o : EXT2_DIR_REC_LEN(ents[i].len);
+        de->inode = ents[i].ino;
+        ext2fs_set_rec_len(fs, (unsigned)rec, de);
+        ext2fs_dirent_set_name_len(de, ents[i].len);
+        ext2fs_dirent_set_file_type(de, ents[i].ftype);
+        memcpy(de->name, ents[i].name, (size_t)ents[i].len);
+        o += rec;
+    }
+    if (n == 0) ext2fs_set_rec_len(fs, (unsigned)end, (struct ext2_dir_entry*)buf);
+    if (leaf_tail_size(fs)) ext2fs_initialize_dirent_tail(fs, (struct ext2_dir_entry_tail*)(buf + end));
+}
+
+static void dx_node_init(ext2_filsys fs, char* buf) {
+    memset(buf, 0, fs->blocksize);
+    ext2fs_set_rec_len(fs, fs->blocksize, (struct ext2_dir_entry*)buf);
+    struct ext2_dx_countlimit* cl = (struct ext2_dx_countlimit*)(buf + 8);
+    cl->limit = (__u16)dx_node_limit(fs);
+    cl->count = 0;
+}
+
+static errcode_t dx_write_frame(ext2_filsys fs, ext2_ino_t dir, dx_frame_t* f) {
+    return ext2fs_write_dir_block4(fs, f->pblk, f->buf, 0, dir);
+}
+
+// 1 if dx_insert_index can take one more entry at the leaf's index level.
+static int dx_index_has_room(dx_path_t* p) {
+    dx_frame_t* f = &p->frames[p->levels - 1];
+    if (dx_cl(f)->count < dx_cl(f)->limit) return 1;
+    if (p->levels == 1) return 1;  // root can still grow one level
+    return dx_cl(&p->frames[0])->count < dx_cl(&p->frames[0])->limit;
+}
+
+static void dx_insert_at(dx_frame_t* f, int pos, ext2_dirhash_t hash, blk64_t lblk) {
+    struct ext2_dx_countlimit* cl = dx_cl(f);
+    int count = cl->count;
+    memmove(&f->entries[pos + 1], &f->entries[pos], sizeof(struct ext2_dx_entry) * (size_t)(count - pos));
+    f->entries[pos].hash = hash;
+    f->entries[pos].block = (__u32)lblk;
+    cl = dx_cl(f);   // entries[0] overlaps the count/limit header
+    cl->count = (__u16)(count + 1);
+}
+
+// Adds (hash -> lblk) right after frames[level].at, splitting index nodes or
+// growing the root by one level as needed. Callers check dx_index_has_room.
+static errcode_t dx_insert_index(ext2_filsys fs, ext2_ino_t dir, struct ext2_inode* din, dx_path_t* p, int level, ext2_dirhash_t hash, blk64_t lblk) {
+    dx_frame_t* f = &p->frames[level];
+    struct ext2_dx_countlimit* cl = dx_cl(f);
+    if (cl->count < cl->limit) {
+        dx_insert_at(f, f->at + 1, hash, lblk);
+        return dx_write_frame(fs, dir, f);
+    }
+
+    blk64_t nl = 0, np = 0;
+    errcode_t rc = dir_append_block(fs, dir, din, &nl, &np);
+    if (rc) return rc;
+    char* nbuf = (char*)malloc(fs->blocksize);
+    if (!nbuf) return EXT2_ET_NO_MEMORY;
+    dx_node_init(fs, nbuf);
+    struct ext2_dx_entry* nent = (struct ext2_dx_entry*)(nbuf + 8);
+    int count = cl->count;
+
+    if (level == 0) {
+        // root full: move all of its entries one level down
+        memcpy(nent, f->entries, sizeof(struct ext2_dx_entry) * (size_t)count);
+        ((struct ext2_dx_countlimit*)nent)->limit = (__u16)dx_node_limit(fs);
+        ((struct ext2_dx_countlimit*)nent)->count = (__u16)count;
+        cl->count = 1;
+        f->entries[0].block = (__u32)nl;
+        ((struct ext2_dx_root_info*)(f->buf + 24))->indirect_levels = 1;
+        rc = dx_write_frame(fs, dir, f);
+        if (rc) { free(nbuf); return rc; }
+
+        p->frames[1].pblk = np;
+        p->frames[1].buf = nbuf;
+        p->frames[1].entries = nent;
+        p->frames[1].at = f->at;
+        f->at = 0;
+        p->levels = 2;
+        return dx_insert_index(fs, dir, din, p, 1, hash, lblk);
+    }
+
+    // index node full: move the upper half into a new node
+    int half = count / 2;
+    ext2_dirhash_t split = f->entries[half].hash;
+    memcpy(nent, &f->entries[half], sizeof(struct ext2_dx_entry) * (size_t)(count - half));
+    ((struct ext2_dx_countlimit*)nent)->limit = (__u16)dx_node_limit(fs);
+    ((struct ext2_dx_countlimit*)nent)->count = (__u16)(count - half);
+    cl->count = (__u16)half;
+
+    dx_frame_t nf = { np, nbuf, nent, 0 };
+    rc = dx_insert_index(fs, dir, din, p, level - 1, split, nl);
+    if (!rc) {
+        if (f->at + 1 > half) dx_insert_at(&nf, f->at + 1 - half, hash, lblk);
+        else dx_insert_at(f, f->at + 1, hash, lblk);
+        rc = dx_write_frame(fs, dir, f);
+        if (!rc) rc = dx_write_frame(fs, dir, &nf);
+    }
+    free(nbuf);
+    return rc;
+}
+
+static errcode_t dx_link(ext2_filsys fs, ext2_ino_t dir, struct ext2_inode* din, const char* name, ext2_ino_t ino, int ftype) {
+    int len = (int)strlen(name);
+    dx_path_t p;
+    char* leaf = NULL;
+    dx_ent_t* ents = NULL;
+    blk64_t lpblk = 0;
+    errcode_t rc = dx_probe(fs, dir, din, name, len, &p);
+    if (!rc) rc = dir_read_lblk(fs, dir, din, dx_leaf_lblk(&p), &lpblk, &leaf);
+    if (!rc) {
+        rc = leaf_insert(fs, leaf, name, len, ino, ftype);
+        if (!rc) { rc = ext2fs_write_dir_block4(fs, lpblk, leaf, 0, dir); goto out; }
+    }
+    if (rc != EXT2_ET_DIR_NO_SPACE) goto out;
+
+    // leaf full: split it by hash, the new entry included
+    if (!dx_index_has_room(&p)) goto out;
+    int maxents = (int)fs->blocksize / 12 + 2, n = 0;
+    ents = (dx_ent_t*)malloc(sizeof(dx_ent_t) * (size_t)maxents);
+    if (!ents) { rc = EXT2_ET_NO_MEMORY; goto out; }
+    int version = dx_hash_version(fs, ((struct ext2_dx_root_info*)(p.frames[0].buf + 24))->hash_version);
+    rc = leaf_collect(fs, leaf, version, 0, ents, &n);
+    if (rc) goto out;
+    dx_ent_t* e = &ents[n++];
+    e->hash = p.hash; e->ino = ino; e->len = len;
+    e->ftype = ext2fs_has_feature_filetype(fs->super) ? ftype : EXT2_FT_UNKNOWN;
+    memcpy(e->name, name, (size_t)len); e->name[len] = 0;
+    qsort(ents, (size_t)n, sizeof(dx_ent_t), dx_ent_cmp);
+
+    int total = 0, acc = 0, m = 1;
+    for (int i = 0; i < n; ++i) total += EXT2_DIR_REC_LEN(ents[i].len);
+    for (m = 1; m < n - 1; ++m) {
+        acc += EXT2_DIR_REC_LEN(ents[m - 1].len);
+        if (acc * 2 >= total) break;
+    }
+    ext2_dirhash_t split = ents[m].hash | (ents[m - 1].hash == ents[m].hash ? 1u : 0u);
+
+    blk64_t nl = 0, np = 0;
+    rc = dir_append_block(fs, dir, din, &nl, &np);
+    if (rc) goto out;
+    char* nleaf = (char*)malloc(fs->blocksize);
+    if (!nleaf) { rc = EXT2_ET_NO_MEMORY; goto out; }
+    leaf_fill(fs, leaf, ents, m);
+    leaf_fill(fs, nleaf, ents + m, n - m);
+    rc = ext2fs_write_dir_block4(fs, lpblk, leaf, 0, dir);
+    if (!rc) rc = ext2fs_write_dir_block4(fs, np, nleaf, 0, dir);
+    free(nleaf);
+    if (!rc) rc = dx_insert_index(fs, dir, din, &p, p.levels - 1, split, nl);
+out:
+    free(ents);
+    free(leaf);
+    dx_path_free(&p);
+    return rc;
+}
+
+// Turns a full single-block linear directory into an htree: block 0 becomes
+// the index root, its entries move to a new leaf.
+static errcode_t dx_convert(ext2_filsys fs, ext2_ino_t dir, struct ext2_inode* din) {
+    char *root = NULL, *leaf = NULL;
+    dx_ent_t* ents = NULL;
+    blk64_t rpblk = 0, ll = 0, lp = 0;
+    int n = 0;
+    int version = fs->super->s_def_hash_version;
+    errcode_t rc = dir_read_lblk(fs, dir, din, 0, &rpblk, &root);
+    if (rc) goto out;
+
+    struct ext2_dir_entry* dot = (struct ext2_dir_entry*)root;
+    unsigned int dot_len = 0;
+    ext2fs_get_rec_len(fs, dot, &dot_len);
+    struct ext2_dir_entry* dotdot = (struct ext2_dir_entry*)(root + dot_len);
+    if (dot_len != 12 || ext2fs_dirent_name_len(dot) != 1 || ext2fs_dirent_name_len(dotdot) != 2) { rc = EXT2_ET_DIR_CORRUPTED; goto out; }
+
+    ents = (dx_ent_t*)malloc(sizeof(dx_ent_t) * (size_t)(fs->blocksize / 12 + 1));
+    leaf = (char*)malloc(fs->blocksize);
+    if (!ents || !leaf) { rc = EXT2_ET_NO_MEMORY; goto out; }
+    rc = leaf_collect(fs, root, dx_hash_version(fs, version), 1, ents, &n);
+    if (rc) goto out;
+    qsort(ents, (size_t)n, sizeof(dx_ent_t), dx_ent_cmp);
+
+    rc = dir_append_block(fs, dir, din, &ll, &lp);
+    if (rc) goto out;
+    leaf_fill(fs, leaf, ents, n);
+    rc = ext2fs_write_dir_block4(fs, lp, leaf, 0, dir);
+    if (rc) goto out;
+
+    ext2_ino_t parent = dotdot->inode;
+    int ft = ext2fs_dirent_file_type(dotdot);
+    memset(root + 12, 0, fs->blocksize - 12);
+    dotdot = (struct ext2_dir_entry*)(root + 12);
+    dotdot->inode = parent;
+    ext2fs_set_rec_len(fs, fs->blocksize - 12, dotdot);
+    ext2fs_dirent_set_name_len(dotdot, 2);
+    ext2fs_dirent_set_file_type(dotdot, ft);
+    dotdot->name[0] = dotdot->name[1] = '.';
+    struct ext2_dx_root_info* info = (struct ext2_dx_root_info*)(root + 24);
+    info->hash_version = (__u8)version;
+    info->info_length = 8;
+    struct ext2_dx_entry* ent = (struct ext2_dx_entry*)(root + 32);
+    ((struct ext2_dx_countlimit*)ent)->limit = (__u16)dx_root_limit(fs);
+    ((struct ext2_dx_countlimit*)ent)->count = 1;
+    ent[0].block = (__u32)ll;
+    rc = ext2fs_write_dir_block4(fs, rpblk, root, 0, dir);
+    if (rc) goto out;
+
+    din->i_flags |= EXT2_INDEX_FL;
+    rc = ext2fs_write_inode(fs, dir, din);
+out:
+    free(ents);
+    free(leaf);
+    free(root);
+    return rc;
+}
+
+static int is_dot_name(const char* name) {
+    return name[0] == '.' && (name[1] == 0 || (name[1] == '.' && name[2] == 0));
+}
+
+// out_ftype (optional) is the dirent file type, EXT2_FT_UNKNOWN when the
+// directory is linear or the filesystem has no filetype feature.
+static errcode_t dir_lookup_ft(ext2_filsys fs, ext2_ino_t dir, const char* name, ext2_ino_t* out_ino, int* out_ftype) {
+    shim_fs_t* h = shim_of(fs);
+    if (h) h->stats.lookups++;
+    if (out_ftype) *out_ftype = EXT2_FT_UNKNOWN;
+    struct ext2_inode din;
+    errcode_t rc = ext2fs_read_inode(fs, dir, &din);
+    if (rc) return rc;
+    if (!LINUX_S_ISDIR(din.i_mode)) return EXT2_ET_NO_DIRECTORY;
+    // '.' and '..' live in block 0, which the linear lookup reads first
+    if ((din.i_flags & EXT2_INDEX_FL) && !is_dot_name(name)) return dx_lookup(fs, dir, &din, name, out_ino, out_ftype);
+    return ext2fs_lookup(fs, dir, name, (int)strlen(name), NULL, out_ino);
+}
+
+static errcode_t dir_lookup(ext2_filsys fs, ext2_ino_t dir, const char* name, ext2_ino_t* out_ino) {
+    return dir_lookup_ft(fs, dir, name, out_ino, NULL);
+}
+
+// Indexed directories are maintained here; a linear directory whose single
+// block is full is converted to an htree on dir_index filesystems, otherwise
+// it just grows (ext2fs_link does neither by itself).
+static errcode_t link_entry(ext2_filsys fs, ext2_ino_t dir, const char* name, ext2_ino_t ino, int ftype) {
+    struct ext2_inode din;
+    errcode_t rc = ext2fs_read_inode(fs, dir, &din);
+    if (rc) return rc;
+    if (din.i_flags & EXT2_INDEX_FL) return dx_link(fs, dir, &din, name, ino, ftype);
+
+    rc = ext2fs_link(fs, dir, name, ino, ftype);
+    if (rc != EXT2_ET_DIR_NO_SPACE) return rc;
+    if (ext2fs_has_feature_dir_index(fs->super) && !(din.i_flags & EXT4_INLINE_DATA_FL) &&
+        EXT2_I_SIZE(&din) == fs->blocksize) {
+        rc = dx_convert(fs, dir, &din);
+        if (rc) return rc;
+        return dx_link(fs, dir, &din, name, ino, ftype);
+    }
+    rc = ext2fs_expand_dir(fs, dir);
+    if (rc) return rc;
+    return ext2fs_link(fs, dir, name, ino, ftype);
+}
+
+static errcode_t unlink_entry(ext2_filsys fs, ext2_ino_t dir, const char* name, ext2_ino_t ino) {
+    struct ext2_inode din;
+    errcode_t rc = ext2fs_read_inode(fs, dir, &din);
+    if (rc) return rc;
+    if ((din.i_flags & EXT2_INDEX_FL) && !is_dot_name(name)) return dx_unlink(fs, dir, &din, name, ino);
+    return ext2fs_unlink(fs, dir, name, ino, 0);
+}
+
+// ext2fs_mkdir without inline data: directories stay block-based even on
+// inline_data filesystems, since the directory code here iterates and
+// indexes directory blocks. Only regular files are stored inline.
+static errcode_t mkdir_blocks(ext2_filsys fs, ext2_ino_t parent, ext2_ino_t ino, const char* name) {
+    uint32_t inline_data = fs->super->s_feature_incompat & EXT4_FEATURE_INCOMPAT_INLINE_DATA;
+    fs->super->s_feature_incompat &= ~EXT4_FEATURE_INCOMPAT_INLINE_DATA;
+    errcode_t rc = ext2fs_mkdir(fs, parent, ino, name);
+    fs->super->s_feature_incompat |= inline_data;
+    return rc;
+}
+
+// Creates parent/name as an empty directory. The entry is linked here rather
+// than by ext2fs_mkdir so indexed parents stay consistent.
+static errcode_t make_dir(ext2_filsys fs, ext2_ino_t parent, const char* name, ext2_ino_t* out_ino) {
+    ext2_ino_t ino = 0;
+    errcode_t rc = ext2fs_new_inode(fs, parent, LINUX_S_IFDIR | 0755, 0, &ino);
+    if (rc) return rc;
+    rc = mkdir_blocks(fs, parent, ino, NULL);
+    if (rc) return rc;
+    rc = link_entry(fs, parent, name, ino, EXT2_FT_DIR);
+    if (rc) return rc;
+    *out_ino = ino;
+    return 0;
+}
+
+static int mode_to_ftype(uint16_t mode) {
+    switch (mode & LINUX_S_IFMT) {
+        case LINUX_S_IFREG:  return EXT2_FT_REG_FILE;
+        case LINUX_S_IFDIR:  return EXT2_FT_DIR;
+        case LINUX_S_IFLNK:  return EXT2_FT_SYMLINK;
+        case LINUX_S_IFCHR:  return EXT2_FT_CHRDEV;
+        case LINUX_S_IFBLK:  return EXT2_FT_BLKDEV;
+        case LINUX_S_IFIFO:  return EXT2_FT_FIFO;
+        case LINUX_S_IFSOCK: return EXT2_FT_SOCK;
+        default:             return EXT2_FT_UNKNOWN;
+    }
+}
+
 static int path_to_ino(ext2_filsys fs, const char* abs_path, ext2_ino_t* out_ino, char* err, int errlen) {
     if (!abs_path || abs_path[0] == 0 || (abs_path[0] == '/' && abs_path[1] == 0)) {
         *out_ino = EXT2_ROOT_INO;
@@ -111,10 +830,48 @@ static int path_to_ino(ext2_filsys fs, const char* abs_path, ext2_ino_t* out_ino
         set_err(err, errlen, "Path must be absolute (e.g. /dir/file)");
         return -1;
     }
-    ext2_ino_t ino = 0;
-    errcode_t rc = ext2fs_namei(fs, EXT2_ROOT_INO, EXT2_ROOT_INO, abs_path, &ino);
+    shim_fs_t* h = shim_of(fs);
+    if (h) h->stats.namei++;
+
+    // Walk component by component so indexed directories use the hash tree;
+    // a symlink in the middle of the path falls back to ext2fs_namei.
+    ext2_ino_t cur = EXT2_ROOT_INO;
+    const char* p = abs_path;
+    char seg[256];
+    errcode_t rc = 0;
+    while (*p) {
+        while (*p == '/') ++p;
+        if (!*p) break;
+        int i = 0;
+        while (*p && *p != '/') {
+            if (i == (int)sizeof(seg) - 1) { set_err(err, errlen, "Path component too long"); return -1; }
+            seg[i++] = *p++;
+        }
+        seg[i] = 0;
+        ext2_ino_t next = 0;
+        int ftype = EXT2_FT_UNKNOWN;
+        rc = dir_lookup_ft(fs, cur, seg, &next, &ftype);
+        if (rc) break;
+        while (*p == '/') ++p;
+        if (*p) {
+            int is_link = (ftype == EXT2_FT_SYMLINK);
+            if (ftype == EXT2_FT_UNKNOWN) {
+                struct ext2_inode in;
+                rc = ext2fs_read_inode(fs, next, &in);
+                if (rc) break;
+                is_link = LINUX_S_ISLNK(in.i_mode);
+            }
+            if (is_link) {
+                rc = ext2fs_namei(fs, EXT2_ROOT_INO, EXT2_ROOT_INO, abs_path, &next);
+                if (rc) break;
+                *out_ino = next;
+                return 0;
+            }
+        }
+        cur = next;
+    }
     if (rc) { set_err_rc(err, errlen, "namei failed", rc); return -1; }
-    *out_ino = ino;
+    *out_ino = cur;
     return 0;
 }
 
@@ -149,7 +906,7 @@ static int lookup_parent_and_base(const char* abs_path, char* parent, int parent
 static int ensure_dir(ext2_filsys fs, ext2_ino_t parent, const char* name, uint16_t mode, ext2_ino_t* out_dir, char* err, int errlen) {
     // Does entry exist?
     ext2_ino_t child = 0;
-    errcode_t rc = ext2fs_lookup(fs, parent, name, (int)strlen(name), NULL, &child);
+    errcode_t rc = dir_lookup(fs, parent, name, &child);
     if (rc == 0 && child != 0) {
         struct ext2_inode in; memset(&in, 0, sizeof(in));
         rc = ext2fs_read_inode(fs, child, &in);
@@ -158,13 +915,9 @@ static int ensure_dir(ext2_filsys fs, ext2_ino_t parent, const char* name, uint1
         *out_dir = child;
         return 0;
     }
-    // Create dir using ext2fs_mkdir
-    rc = ext2fs_mkdir(fs, parent, 0, name);
-    if (rc) { set_err_rc(err, errlen, "mkdir failed", rc); return -1; }
-    // Lookup again
     child = 0;
-    rc = ext2fs_lookup(fs, parent, name, (int)strlen(name), NULL, &child);
-    if (rc || child == 0) { set_err(err, errlen, "mkdir succeeded but lookup failed"); return -1; }
+    rc = make_dir(fs, parent, name, &child);
+    if (rc) { set_err_rc(err, errlen, "mkdir failed", rc); return -1; }
     // Set mode (keep type bits)
     struct ext2_inode in2; memset(&in2, 0, sizeof(in2));
     rc = ext2fs_read_inode(fs, child, &in2);
@@ -195,99 +948,1158 @@ static int mkdirs_abs(ext2_filsys fs, const char* abs_path, uint16_t mode, char*
     return 0;
 }
 
-// ------------------------ Open / Close ------------------------
+// ------------------------ Journal ------------------------
+//
+// Metadata goes through the image's jbd2 journal instead of being flushed in
+// place after every op. Once a read-write handle is attached (first
+// mutation), the io hooks capture every block libext2fs writes (inodes,
+// directories, extent nodes, bitmaps, group descriptors, superblock) in
+// memory and overlay them on later reads. shim_commit flushes into that set
+// and, when the commit interval is up, logs it as one transaction written
+// sequentially: descriptor blocks with their data, a sync, the commit block,
+// a sync. Home locations are only written at checkpoint: when the log is
+// full, on ext4_sync(..., checkpoint) and at close. File data is written in
+// place before its metadata commits (ordered mode); the allocators keep away
+// from blocks freed by the uncommitted transaction, and data that still
+// lands on one, or on a block the log holds, is journaled with the metadata.
+// A read-write open replays committed transactions a crash left behind.
 
-SHIM_API int ext4_open(const char* image_path, int rw, void** fs_handle, char* err, int errlen) {
-    if (!image_path || !fs_handle) { set_err(err, errlen, "bad args"); return -1; }
-    *fs_handle = NULL;
+#define JNL_MAGIC           0xC03B3998u
+#define JNL_DESCRIPTOR      1
+#define JNL_COMMIT          2
+#define JNL_SB_V1           3
+#define JNL_SB_V2           4
+#define JNL_REVOKE          5
+#define JNL_COMPAT_CHECKSUM 0x1
+#define JNL_INCOMPAT_64BIT  0x2
+#define JNL_INCOMPAT_ASYNC_COMMIT 0x4
+#define JNL_INCOMPAT_CSUM_V2 0x8
+#define JNL_INCOMPAT_CSUM_V3 0x10
+#define JNL_INCOMPAT_KNOWN  0x1F   // revoke, 64bit, async_commit, csum v2/v3
+#define JNL_FLAG_ESCAPE     0x1
+#define JNL_FLAG_SAME_UUID  0x2
+#define JNL_FLAG_LAST_TAG   0x8
+#define JNL_MEM_MAX         (64u << 20)  // captured bytes that force a commit
+#define JNL_MIN_BLOCKS      64
+#define JNL_HOME_RUN        4    // longest write the io managers pass through their cache
 
-    io_manager io = windows_io_manager;
+// journal superblock fields (big-endian)
+#define JSB_BLOCKSIZE 0x0C
+#define JSB_MAXLEN    0x10
+#define JSB_FIRST     0x14
+#define JSB_SEQUENCE  0x18
+#define JSB_START     0x1C
+#define JSB_COMPAT    0x24
+#define JSB_INCOMPAT  0x28
+#define JSB_UUID      0x30
+#define JSB_CHECKSUM  0xFC
+#define JSB_SIZE      1024
 
-    ext2_filsys fs = NULL;
-    errcode_t rc = ext2fs_open(
-        image_path,
-        (rw ? (EXT2_FLAG_RW | EXT2_FLAG_64BITS) : EXT2_FLAG_64BITS),
-        0, 0, io, &fs
-    );
-    if (rc) { set_err_rc(err, errlen, "ext2fs_open failed", rc); return -1; }
+struct jent {
+    blk64_t blk;
+    jent_t* next;      // hash chain
+    uint8_t* cur;      // latest contents; what reads see
+    uint8_t* logged;   // contents in the log awaiting checkpoint (may be cur)
+    int running;       // changed since the last commit
+};
 
-    rc = ext2fs_read_inode_bitmap(fs);
-    if (rc) { set_err_rc(err, errlen, "read_inode_bitmap failed", rc); ext2fs_close(fs); return -1; }
-    rc = ext2fs_read_block_bitmap(fs);
-    if (rc) { set_err_rc(err, errlen, "read_block_bitmap failed", rc); ext2fs_close(fs); return -1; }
+typedef struct {
+    blk64_t blk;
+    uint32_t seq;
+} jrevoke_t;
 
-    shim_fs_t* h = (shim_fs_t*)calloc(1, sizeof(shim_fs_t));
-    if (!h) { ext2fs_close(fs); set_err(err, errlen, "oom"); return -1; }
-    h->fs = fs;
-    *fs_handle = h;
-    set_err(err, errlen, NULL);
-    return 0;
+static uint32_t get_be32(const uint8_t* p) {
+    return ((uint32_t)p[0] << 24) | ((uint32_t)p[1] << 16) | ((uint32_t)p[2] << 8) | p[3];
 }
 
-SHIM_API int ext4_close(void* fs_handle) {
-    if (!fs_handle) return 0;
-    shim_fs_t* h = (shim_fs_t*)fs_handle;
-    if (h->fs) {
-        ext2fs_mark_super_dirty(h->fs);
-        ext2fs_flush(h->fs);
-        ext2fs_close(h->fs);
-    }
-    free(h);
-    return 0;
+static void put_be32(uint8_t* p, uint32_t v) {
+    p[0] = (uint8_t)(v >> 24); p[1] = (uint8_t)(v >> 16); p[2] = (uint8_t)(v >> 8); p[3] = (uint8_t)v;
 }
 
-// ------------------------ listdir / stat ------------------------
+static int jnl_csum(const journal_t* j) {
+    return (j->incompat & (JNL_INCOMPAT_CSUM_V2 | JNL_INCOMPAT_CSUM_V3)) != 0;
+}
 
-typedef struct {
-    ext2_filsys fs;
-    char* out;
-    int cap;
-    int pos;
-    int first;
-} list_ctx_t;
+static uint32_t jnl_hash(blk64_t blk, uint32_t buckets) {
+    return (uint32_t)((blk * 0x9E3779B97F4A7C15ull) >> 32) & (buckets - 1);
+}
 
-static int append_json(char* out, int cap, int* pos, const char* s) {
-    int n = (int)strlen(s);
-    if (*pos + n + 1 > cap) return -1;
-    memcpy(out + *pos, s, (size_t)n);
-    *pos += n;
-    out[*pos] = 0;
+static jent_t* jnl_find(const journal_t* j, blk64_t blk) {
+    if (!j->count) return NULL;
+    for (jent_t* e = j->table[jnl_hash(blk, j->buckets)]; e; e = e->next)
+        if (e->blk == blk) return e;
+    return NULL;
+}
+
+static int jnl_grow(journal_t* j) {
+    uint32_t nb = j->buckets ? j->buckets * 2 : 1024;
+    jent_t** t = (jent_t**)calloc(nb, sizeof(*t));
+    if (!t) return -1;
+    for (uint32_t i = 0; i < j->buckets; ++i) {
+        for (jent_t *e = j->table[i], *next; e; e = next) {
+            next = e->next;
+            uint32_t s = jnl_hash(e->blk, nb);
+            e->next = t[s];
+            t[s] = e;
+        }
+    }
+    free(j->table);
+    j->table = t;
+    j->buckets = nb;
     return 0;
 }
 
-static int dir_cb(ext2_ino_t dir, int entry, struct ext2_dir_entry *de, int offset, int blocksize, char *buf, void *priv) {
-    (void)dir; (void)entry; (void)offset; (void)blocksize; (void)buf;
-    list_ctx_t* ctx = (list_ctx_t*)priv;
-    if (!de || de->inode == 0 || de->name_len == 0) return 0;
+// Drops captured blocks: all of them, or (keep_running) all but those changed
+// since the last commit, which lose their logged copy.
+static void jnl_drop(journal_t* j, int keep_running) {
+    unsigned bs = j->fs->blocksize;
+    for (uint32_t i = 0; i < j->buckets; ++i) {
+        jent_t** pp = &j->table[i];
+        while (*pp) {
+            jent_t* e = *pp;
+            if (keep_running && e->running) {
+                if (e->logged && e->logged != e->cur) { free(e->logged); j->mem -= bs; }
+                e->logged = NULL;
+                pp = &e->next;
+                continue;
+            }
+            *pp = e->next;
+            if (e->logged && e->logged != e->cur) { free(e->logged); j->mem -= bs; }
+            free(e->cur);
+            j->mem -= bs;
+            free(e);
+            j->count--;
+        }
+    }
+    if (!keep_running) j->nrun = 0;
+}
 
-    // get inode for size/mode/dir type
-    struct ext2_inode in; memset(&in, 0, sizeof(in));
-    if (ext2fs_read_inode(ctx->fs, de->inode, &in)) return 0;
+// The entry for device block blk, joined to the running transaction. A new
+// entry starts from the block's current contents unless the caller is about
+// to overwrite all of it.
+static errcode_t jnl_entry(journal_t* j, io_channel ch, blk64_t blk, int whole, jent_t** out) {
+    unsigned bs = j->fs->blocksize;
+    jent_t* e = jnl_find(j, blk);
+    if (!e) {
+        if (j->count >= j->buckets && jnl_grow(j)) return EXT2_ET_NO_MEMORY;
+        e = (jent_t*)calloc(1, sizeof(*e));
+        if (!e || !(e->cur = (uint8_t*)malloc(bs))) { free(e); return EXT2_ET_NO_MEMORY; }
+        if (!whole) {
+            // ch may be on 1024-byte blocks (superblock writes); bs is a multiple
+            errcode_t rc = j->io->read_blk64(ch, blk * bs / ch->block_size, -(int)bs, e->cur);
+            if (rc) { free(e->cur); free(e); return rc; }
+        }
+        e->blk = blk;
+        uint32_t s = jnl_hash(blk, j->buckets);
+        e->next = j->table[s];
+        j->table[s] = e;
+        j->count++;
+        j->mem += bs;
+    } else if (!e->running && e->cur == e->logged) {
+        // the logged copy stays as it is until checkpoint
+        uint8_t* copy = (uint8_t*)malloc(bs);
+        if (!copy) return EXT2_ET_NO_MEMORY;
+        memcpy(copy, e->logged, bs);
+        e->cur = copy;
+        j->mem += bs;
+    }
+    if (!e->running) {
+        if (j->nrun == j->run_cap) {
+            uint32_t cap = j->run_cap ? j->run_cap * 2 : 256;
+            jent_t** run = (jent_t**)realloc(j->run, cap * sizeof(*run));
+            if (!run) return EXT2_ET_NO_MEMORY;
+            j->run = run;
+            j->run_cap = cap;
+        }
+        j->run[j->nrun++] = e;
+        e->running = 1;
+    }
+    *out = e;
+    return 0;
+}
 
-    char name[260]; memset(name, 0, sizeof(name));
-    memcpy(name, de->name, de->name_len);
+// Captures len bytes at device offset off (data NULL: zeros).
+static errcode_t jnl_capture(journal_t* j, io_channel ch, uint64_t off, uint64_t len, const void* data) {
+    unsigned bs = j->fs->blocksize;
+    const uint8_t* src = (const uint8_t*)data;
+    while (len) {
+        unsigned in = (unsigned)(off % bs);
+        unsigned n = (unsigned)MINU64(bs - in, len);
+        jent_t* e = jnl_find(j, off / bs);
+        // rewriting a committed block unchanged (the flush rewrites every
+        // dirty bitmap and descriptor) adds nothing to the transaction
+        if (!(src && e && !e->running && !memcmp(e->cur + in, src, n))) {
+            errcode_t rc = jnl_entry(j, ch, off / bs, n == bs, &e);
+            if (rc) return rc;
+            if (src) memcpy(e->cur + in, src, n);
+            else memset(e->cur + in, 0, n);
+        }
+        if (src) src += n;
+        off += n;
+        len -= n;
+    }
+    return 0;
+}
 
-    char esc[600];
-    if (json_escape_name(name, esc, sizeof(esc))) return -1;
+// Copies captured blocks over len bytes just read from device offset off.
+static void jnl_overlay(const journal_t* j, uint64_t off, uint64_t len, void* data) {
+    unsigned bs = j->fs->blocksize;
+    uint8_t* dst = (uint8_t*)data;
+    for (blk64_t b = off / bs; (uint64_t)b * bs < off + len; ++b) {
+        jent_t* e = jnl_find(j, b);
+        if (!e) continue;
+        uint64_t s = (uint64_t)b * bs > off ? (uint64_t)b * bs : off;
+        uint64_t t = MINU64((uint64_t)(b + 1) * bs, off + len);
+        memcpy(dst + (s - off), e->cur + (s - (uint64_t)b * bs), (size_t)(t - s));
+    }
+}
 
-    char one[1024];
-    snprintf(one, sizeof(one),
-        "%s{\"name\":%s,\"inode\":%u,\"is_dir\":%s,\"size\":%llu,\"mode\":%u}",
-        (ctx->first ? "" : ","),
-        esc,
-        (unsigned)de->inode,
-        (LINUX_S_ISDIR(in.i_mode) ? "true" : "false"),
-        (unsigned long long)in.i_size,
-        (unsigned)in.i_mode
-    );
-    if (append_json(ctx->out, ctx->cap, &ctx->pos, one)) return -1;
-    ctx->first = 0;
+// Whether an in-place write of [off, off + len) could disturb what the log or
+// the last commit still relies on.
+static int jnl_shadowed(const journal_t* j, uint64_t off, uint64_t len) {
+    unsigned bs = j->fs->blocksize;
+    blk64_t b = off / bs, end = (off + len + bs - 1) / bs;
+    if (!ext2fs_test_block_bitmap_range2(j->reused, b, (unsigned)(end - b))) return 1;
+    for (; j->count && b < end; ++b)
+        if (jnl_find(j, b)) return 1;
     return 0;
 }
 
-SHIM_API int ext4_listdir(void* fs_handle, const char* abs_path, char* json_utf8, int buflen, char* err, int errlen) {
-    if (!fs_handle || !json_utf8 || buflen <= 2) { set_err(err, errlen, "bad args"); return -1; }
-    json_utf8[0] = 0;
+static errcode_t jnl_sync(journal_t* j) {
+    return j->io->flush(j->fs->io);
+}
+
+// Writes n consecutive log blocks from pos, one request per physically
+// contiguous stretch.
+static errcode_t jnl_put(journal_t* j, uint32_t pos, uint32_t n, const uint8_t* buf) {
+    unsigned bs = j->fs->blocksize;
+    while (n) {
+        uint32_t k = 1;
+        while (k < n && j->map[pos + k] == j->map[pos] + k) k++;
+        errcode_t rc = j->io->write_blk64(j->fs->io, j->map[pos], (int)k, buf);
+        if (rc) return rc;
+        pos += k;
+        n -= k;
+        buf += (size_t)k * bs;
+    }
+    return 0;
+}
+
+// start = 0 marks the log empty; otherwise replay begins there with seq.
+static errcode_t jnl_set_start(journal_t* j, uint32_t start, uint32_t seq) {
+    put_be32(j->jsb + JSB_START, start);
+    put_be32(j->jsb + JSB_SEQUENCE, seq);
+    if (jnl_csum(j)) {
+        put_be32(j->jsb + JSB_CHECKSUM, 0);
+        put_be32(j->jsb + JSB_CHECKSUM, ext2fs_crc32c_le(~0u, j->jsb, JSB_SIZE));
+    }
+    return jnl_put(j, 0, 1, j->jsb);
+}
+
+// Sets or clears needs_recovery in the primary superblock on disk. The
+// in-memory copy keeps it set while the journal is attached, so every
+// superblock the log carries has it.
+static errcode_t jnl_mark_home(journal_t* j, int on) {
+    ext2_filsys fs = j->fs;
+    unsigned bs = fs->blocksize;
+    blk64_t blk = 1024 / bs;
+    uint8_t* buf = (uint8_t*)malloc(bs);
+    if (!buf) return EXT2_ET_NO_MEMORY;
+    errcode_t rc = j->io->read_blk64(fs->io, blk, 1, buf);
+    if (!rc) {
+        struct ext2_super_block* sb = (struct ext2_super_block*)(buf + 1024 % bs);
+        if (on) ext2fs_set_feature_journal_needs_recovery(sb);
+        else ext2fs_clear_feature_journal_needs_recovery(sb);
+        ext2fs_superblock_csum_set(fs, sb);
+        rc = j->io->write_blk64(fs->io, blk, 1, buf);
+    }
+    free(buf);
+    return rc;
+}
+
+typedef struct {
+    blk64_t* map;
+    uint64_t n;
+} jmap_ctx_t;
+
+static int jnl_map_cb(ext2_filsys fs, blk64_t* blocknr, e2_blkcnt_t blockcnt, blk64_t ref_blk, int ref_offset, void* priv) {
+    (void)fs; (void)ref_blk; (void)ref_offset;
+    jmap_ctx_t* ctx = (jmap_ctx_t*)priv;
+    if (blockcnt >= 0 && (uint64_t)blockcnt < ctx->n) ctx->map[blockcnt] = *blocknr;
+    return 0;
+}
+
+static void jnl_release(journal_t* j) {
+    if (j->table) jnl_drop(j, 0);
+    free(j->table);
+    free(j->run);
+    free(j->map);
+    free(j->jsb);
+    if (j->busy) ext2fs_free_block_bitmap(j->busy);
+    if (j->reused) ext2fs_free_block_bitmap(j->reused);
+    j->table = j->run = NULL;
+    j->map = NULL;
+    j->jsb = NULL;
+    j->busy = j->reused = NULL;
+    j->buckets = j->count = j->nrun = j->run_cap = 0;
+    j->mem = 0;
+}
+
+// Maps the internal journal and reads its superblock. Fails for images
+// without one (or with an external one), bad geometry and features this code
+// does not know.
+static errcode_t jnl_load(ext2_filsys fs, journal_t* j) {
+    struct ext2_super_block* s = fs->super;
+    unsigned bs = fs->blocksize;
+    j->fs = fs;
+    if (!ext2fs_has_feature_journal(s) || !s->s_journal_inum) return EXT2_ET_NO_JOURNAL_SB;
+    struct ext2_inode in;
+    errcode_t rc = ext2fs_read_inode(fs, s->s_journal_inum, &in);
+    if (rc) return rc;
+    uint64_t nblocks = EXT2_I_SIZE(&in) / bs;
+    if (nblocks < 2 || nblocks > (1u << 30)) return EXT2_ET_CORRUPT_JOURNAL_SB;
+    j->map = (blk64_t*)calloc((size_t)nblocks, sizeof(blk64_t));
+    j->jsb = (uint8_t*)malloc(bs);
+    if (!j->map || !j->jsb) return EXT2_ET_NO_MEMORY;
+    jmap_ctx_t ctx = { j->map, nblocks };
+    rc = ext2fs_block_iterate3(fs, s->s_journal_inum, BLOCK_FLAG_READ_ONLY | BLOCK_FLAG_DATA_ONLY, NULL, jnl_map_cb, &ctx);
+    if (rc) return rc;
+    if (!j->map[0]) return EXT2_ET_CORRUPT_JOURNAL_SB;
+    if ((rc = j->io->read_blk64(fs->io, j->map[0], 1, j->jsb))) return rc;
+
+    uint32_t type = get_be32(j->jsb + 4);
+    if (get_be32(j->jsb) != JNL_MAGIC || (type != JNL_SB_V1 && type != JNL_SB_V2)) return EXT2_ET_CORRUPT_JOURNAL_SB;
+    j->maxlen = get_be32(j->jsb + JSB_MAXLEN);
+    j->first = get_be32(j->jsb + JSB_FIRST);
+    if (get_be32(j->jsb + JSB_BLOCKSIZE) != bs || j->maxlen > nblocks || !j->first || j->first >= j->maxlen)
+        return EXT2_ET_CORRUPT_JOURNAL_SB;
+    for (uint32_t i = 0; i < j->maxlen; ++i)
+        if (!j->map[i]) return EXT2_ET_CORRUPT_JOURNAL_SB;
+    j->incompat = type == JNL_SB_V2 ? get_be32(j->jsb + JSB_INCOMPAT) : 0;
+    if (j->incompat & ~JNL_INCOMPAT_KNOWN) return EXT2_ET_JOURNAL_UNSUPP_VERSION;
+    // an async commit block can land before the blocks it covers; only the
+    // v2/v3 tag checksums tell whether they did
+    if ((j->incompat & JNL_INCOMPAT_ASYNC_COMMIT) && !jnl_csum(j)) return EXT2_ET_JOURNAL_UNSUPP_VERSION;
+
+    if (j->incompat & JNL_INCOMPAT_CSUM_V3) {
+        j->tag_bytes = 16;
+    } else {
+        j->tag_bytes = (j->incompat & JNL_INCOMPAT_CSUM_V2) ? 14 : 12;
+        if (!(j->incompat & JNL_INCOMPAT_64BIT)) j->tag_bytes -= 4;
+    }
+    // the first tag of a descriptor carries the log's uuid; csum adds a tail
+    j->per_desc = (bs - 12 - 16 - (jnl_csum(j) ? 4 : 0)) / j->tag_bytes;
+    j->seed = ext2fs_crc32c_le(~0u, j->jsb + JSB_UUID, 16);
+    j->tid = get_be32(j->jsb + JSB_SEQUENCE);
+    return 0;
+}
+
+static int jrevoke_cmp(const void* a, const void* b) {
+    const jrevoke_t* x = (const jrevoke_t*)a;
+    const jrevoke_t* y = (const jrevoke_t*)b;
+    return x->blk < y->blk ? -1 : x->blk > y->blk;
+}
+
+// Whether a revoke record forbids replaying blk from transaction seq.
+static int jnl_revoked(const jrevoke_t* rv, size_t n, blk64_t blk, uint32_t seq) {
+    size_t lo = 0, hi = n;
+    while (lo < hi) {
+        size_t mid = (lo + hi) / 2;
+        if (rv[mid].blk < blk) lo = mid + 1;
+        else hi = mid;
+    }
+    for (; lo < n && rv[lo].blk == blk; ++lo)
+        if ((int32_t)(rv[lo].seq - seq) >= 0) return 1;
+    return 0;
+}
+
+static uint32_t jnl_next(const journal_t* j, uint32_t pos) {
+    return ++pos >= j->maxlen ? j->first : pos;
+}
+
+// crc32c of a log block whose 4-byte checksum field at off counts as zero.
+static uint32_t jnl_block_csum(const journal_t* j, const uint8_t* buf, unsigned off) {
+    static const uint8_t zero[4];
+    uint32_t c = ext2fs_crc32c_le(j->seed, buf, off);
+    c = ext2fs_crc32c_le(c, zero, 4);
+    return ext2fs_crc32c_le(c, buf + off + 4, j->fs->blocksize - off - 4);
+}
+
+// Whether a logged block matches its descriptor tag's checksum.
+static int jnl_tag_ok(const journal_t* j, const uint8_t* t, uint32_t seq, const uint8_t* data) {
+    uint8_t be[4];
+    put_be32(be, seq);
+    uint32_t sum = ext2fs_crc32c_le(ext2fs_crc32c_le(j->seed, be, 4), data, j->fs->blocksize);
+    if (j->incompat & JNL_INCOMPAT_CSUM_V3) return get_be32(t + 12) == sum;
+    return (uint32_t)((t[4] << 8) | t[5]) == (sum & 0xFFFF);
+}
+
+// Three passes over the log from s_start, as jbd2 recovery does: find the
+// last complete transaction, collect revoke records, write the logged blocks
+// home (or, without home, capture them in j's table). A transaction counts once its commit block is there and, with v2/v3
+// checksums, its descriptor, revoke, data and commit blocks all verify; the
+// first mismatch ends the log. Leaves j->tid past the last transaction seen.
+static errcode_t jnl_recover(journal_t* j, int home) {
+    ext2_filsys fs = j->fs;
+    unsigned bs = fs->blocksize;
+    unsigned tail = jnl_csum(j) ? 4 : 0;
+    int v3 = (j->incompat & JNL_INCOMPAT_CSUM_V3) != 0, wide = (j->incompat & JNL_INCOMPAT_64BIT) != 0;
+    uint32_t start = get_be32(j->jsb + JSB_START), seq0 = get_be32(j->jsb + JSB_SEQUENCE), end = seq0;
+    uint8_t* buf = (uint8_t*)malloc(bs);
+    uint8_t* data = (uint8_t*)malloc(bs);
+    jrevoke_t* rv = NULL;
+    size_t nrv = 0, rv_cap = 0;
+    errcode_t rc = (buf && data) ? 0 : EXT2_ET_NO_MEMORY;
+
+    for (int pass = 0; pass < 3 && !rc; ++pass) {
+        uint32_t pos = start, seq = seq0;
+        while (pass == 0 || seq != end) {
+            if ((rc = j->io->read_blk64(fs->io, j->map[pos], 1, buf))) break;
+            uint32_t type = get_be32(buf + 4);
+            if (get_be32(buf) != JNL_MAGIC || get_be32(buf + 8) != seq ||
+                (type != JNL_DESCRIPTOR && type != JNL_COMMIT && type != JNL_REVOKE)) {
+                // the end of the log; later passes stop before it
+                if (pass) rc = EXT2_ET_CORRUPT_JOURNAL_SB;
+                break;
+            }
+            if (pass == 0 && tail && get_be32(buf + (type == JNL_COMMIT ? 16 : bs - 4)) !=
+                                     jnl_block_csum(j, buf, type == JNL_COMMIT ? 16 : bs - 4))
+                break;
+            pos = jnl_next(j, pos);
+            if (type == JNL_COMMIT) {
+                seq++;
+                if (pass == 0) end = seq;
+            } else if (type == JNL_DESCRIPTOR) {
+                int bad = 0;
+                for (uint32_t off = 12; off + j->tag_bytes <= bs - tail; ) {
+                    const uint8_t* t = buf + off;
+                    uint32_t flags = v3 ? get_be32(t + 4) : (uint32_t)((t[6] << 8) | t[7]);
+                    blk64_t blk = get_be32(t);
+                    if (wide) blk |= (blk64_t)get_be32(t + 8) << 32;
+                    if (pass == 0 && tail) {
+                        if ((rc = j->io->read_blk64(fs->io, j->map[pos], 1, data))) break;
+                        if ((bad = !jnl_tag_ok(j, t, seq, data))) break;
+                    } else if (pass == 2 && blk < ext2fs_blocks_count(fs->super) && !jnl_revoked(rv, nrv, blk, seq)) {
+                        if ((rc = j->io->read_blk64(fs->io, j->map[pos], 1, data))) break;
+                        if (flags & JNL_FLAG_ESCAPE) put_be32(data, JNL_MAGIC);
+                        if (home) {
+                            if ((rc = j->io->write_blk64(fs->io, blk, 1, data))) break;
+                        } else {
+                            jent_t* e;
+                            if ((rc = jnl_entry(j, fs->io, blk, 1, &e))) break;
+                            memcpy(e->cur, data, bs);
+                        }
+                    }
+                    pos = jnl_next(j, pos);
+                    off += j->tag_bytes + ((flags & JNL_FLAG_SAME_UUID) ? 0 : 16);
+                    if (flags & JNL_FLAG_LAST_TAG) break;
+                }
+                if (rc || bad) break;
+            } else if (pass == 1) {
+                uint32_t used = MIN(get_be32(buf + 12), bs - tail), rec = wide ? 8 : 4;
+                for (uint32_t off = 16; off + rec <= used; off += rec) {
+                    if (nrv == rv_cap) {
+                        size_t cap = rv_cap ? rv_cap * 2 : 256;
+                        jrevoke_t* more = (jrevoke_t*)realloc(rv, cap * sizeof(*rv));
+                        if (!more) { rc = EXT2_ET_NO_MEMORY; break; }
+                        rv = more;
+                        rv_cap = cap;
+                    }
+                    rv[nrv].blk = wide ? ((blk64_t)get_be32(buf + off) << 32) | get_be32(buf + off + 4) : get_be32(buf + off);
+                    rv[nrv++].seq = seq;
+                }
+                if (rc) break;
+            }
+        }
+        if (pass == 1 && nrv) qsort(rv, nrv, sizeof(*rv), jrevoke_cmp);
+    }
+    free(rv);
+    free(data);
+    free(buf);
+    j->tid = end + 1;
+    return rc;
+}
+
+// Replays a log left by a crash and marks it empty, as e2fsck would before
+// the image is used read-write. Runs on a freshly opened filesystem without
+// the shim's hooks; the caller reopens it afterwards.
+static errcode_t journal_replay(ext2_filsys fs) {
+    journal_t j;
+    memset(&j, 0, sizeof(j));
+    j.io = fs->io->manager;
+    errcode_t rc = jnl_load(fs, &j);
+    if (!rc && get_be32(j.jsb + JSB_START)) rc = jnl_recover(&j, 1);
+    if (!rc) rc = jnl_set_start(&j, 0, j.tid);
+    if (!rc) rc = jnl_sync(&j);
+    if (!rc) rc = jnl_mark_home(&j, 0);
+    if (!rc) rc = jnl_sync(&j);
+    jnl_release(&j);
+    return rc;
+}
+
+// The read-only counterpart: committed transactions are replayed into the
+// handle's captured blocks, which its reads see, and the image is left as it
+// is. The superblock and group descriptors ext2fs_open read are refreshed
+// from them.
+static errcode_t journal_overlay(shim_fs_t* h) {
+    journal_t* j = &h->j;
+    ext2_filsys fs = h->fs;
+    unsigned bs = fs->blocksize;
+    j->io = h->io_base;
+    errcode_t rc = jnl_load(fs, j);
+    if (!rc && get_be32(j->jsb + JSB_START)) rc = jnl_recover(j, 0);
+    for (uint32_t i = 0; i < j->nrun; ++i) j->run[i]->running = 0;
+    j->nrun = 0;
+    if (rc || !j->count) return rc;
+
+    uint8_t* buf = (uint8_t*)malloc(bs);
+    if (!buf) return EXT2_ET_NO_MEMORY;
+    rc = io_channel_read_blk64(fs->io, SUPERBLOCK_OFFSET / bs, 1, buf);
+    if (!rc) memcpy(fs->super, buf + SUPERBLOCK_OFFSET % bs, SUPERBLOCK_SIZE);
+    free(buf);
+    for (dgrp_t i = 0; i < fs->desc_blocks && !rc; ++i) {
+        blk64_t blk = ext2fs_descriptor_block_loc2(fs, fs->super->s_first_data_block, i);
+        rc = io_channel_read_blk64(fs->io, blk, 1, (char*)fs->group_desc + (size_t)i * bs);
+    }
+    // the journal inode's table block is cached from before
+    ext2fs_flush_icache(fs);
+    return rc;
+}
+
+static int jent_cmp(const void* a, const void* b) {
+    const jent_t* x = *(const jent_t* const*)a;
+    const jent_t* y = *(const jent_t* const*)b;
+    return x->blk < y->blk ? -1 : x->blk > y->blk;
+}
+
+// Writes captured blocks home in block order, coalescing neighbours: the
+// logged copies (checkpoint) or, with current, the latest contents. Runs stay
+// within JNL_HOME_RUN: unix_io (and windows_io) write longer ones straight to
+// the file and keep their cached copies of those blocks, which reads would
+// then return once the captured blocks are dropped.
+static errcode_t jnl_write_home(shim_fs_t* h, int current) {
+    journal_t* j = &h->j;
+    unsigned bs = j->fs->blocksize;
+    const uint32_t chunk = JNL_HOME_RUN;
+    jent_t** list = (jent_t**)malloc((size_t)(j->count ? j->count : 1) * sizeof(*list));
+    uint8_t* buf = (uint8_t*)malloc((size_t)chunk * bs);
+    errcode_t rc = (list && buf) ? 0 : EXT2_ET_NO_MEMORY;
+    uint32_t n = 0;
+    for (uint32_t i = 0; !rc && i < j->buckets; ++i)
+        for (jent_t* e = j->table[i]; e; e = e->next)
+            if (current || e->logged) list[n++] = e;
+    if (!rc) qsort(list, n, sizeof(*list), jent_cmp);
+    for (uint32_t i = 0; !rc && i < n; ) {
+        uint32_t k = 0;
+        do {
+            memcpy(buf + (size_t)k * bs, current ? list[i + k]->cur : list[i + k]->logged, bs);
+            k++;
+        } while (i + k < n && k < chunk && list[i + k]->blk == list[i]->blk + k);
+        rc = j->io->write_blk64(j->fs->io, list[i]->blk, (int)k, buf);
+        h->stats.checkpoint_blocks += k;
+        i += k;
+    }
+    free(buf);
+    free(list);
+    return rc;
+}
+
+// Blocks freed by a committed transaction become allocatable again. If the
+// copy fails they just stay off-limits to the first-choice allocator.
+static void jnl_release_freed(journal_t* j) {
+    ext2fs_block_bitmap busy;
+    if (!ext2fs_copy_bitmap(j->fs->block_map, &busy)) {
+        ext2fs_free_block_bitmap(j->busy);
+        j->busy = busy;
+    }
+    ext2fs_clear_block_bitmap(j->reused);
+}
+
+// Writes the logged blocks home and empties the log.
+static errcode_t jnl_checkpoint(shim_fs_t* h) {
+    journal_t* j = &h->j;
+    if (j->empty) return 0;
+    errcode_t rc = jnl_write_home(h, 0);
+    if (!rc) rc = jnl_sync(j);
+    if (!rc) rc = jnl_set_start(j, 0, j->tid);
+    if (!rc) rc = jnl_mark_home(j, 0);
+    if (!rc) rc = jnl_sync(j);
+    if (rc) return rc;
+    jnl_drop(j, 1);
+    j->empty = 1;
+    j->head = j->first;
+    h->stats.checkpoints++;
+    return 0;
+}
+
+// A transaction bigger than the whole log cannot be atomic: checkpoint, then
+// write the running blocks home directly, as the per-op flush used to.
+static errcode_t jnl_spill(shim_fs_t* h) {
+    journal_t* j = &h->j;
+    errcode_t rc = jnl_checkpoint(h);
+    if (!rc) rc = jnl_write_home(h, 1);
+    if (!rc) rc = jnl_sync(j);
+    if (rc) return rc;
+    jnl_drop(j, 0);
+    jnl_release_freed(j);
+    return 0;
+}
+
+// Logs the running blocks as transaction j->tid: descriptors and data, sync,
+// commit block, sync. Checkpoints first when the rest of the log is too short.
+static errcode_t jnl_log(shim_fs_t* h) {
+    journal_t* j = &h->j;
+    unsigned bs = j->fs->blocksize;
+    uint32_t n = j->nrun, need = n + (n + j->per_desc - 1) / j->per_desc + 1;
+    int csum = jnl_csum(j), v3 = (j->incompat & JNL_INCOMPAT_CSUM_V3) != 0;
+    errcode_t rc = 0;
+    if (need > j->maxlen - j->first) return jnl_spill(h);
+    if (j->head + need > j->maxlen && (rc = jnl_checkpoint(h))) return rc;
+    if (j->empty) {
+        // the first transaction since a checkpoint: needs_recovery goes on
+        // and the log gets a start
+        j->head = j->first;
+        if ((rc = jnl_mark_home(j, 1)) || (rc = jnl_set_start(j, j->first, j->tid))) return rc;
+    }
+
+    uint8_t* buf = (uint8_t*)malloc((size_t)(1 + j->per_desc) * bs);
+    if (!buf) return EXT2_ET_NO_MEMORY;
+    uint8_t seq[4];
+    put_be32(seq, j->tid);
+    for (uint32_t i = 0; i < n && !rc; ) {
+        uint32_t k = MIN(j->per_desc, n - i);
+        uint8_t* d = buf;
+        memset(d, 0, bs);
+        put_be32(d, JNL_MAGIC);
+        put_be32(d + 4, JNL_DESCRIPTOR);
+        put_be32(d + 8, j->tid);
+        uint8_t* t = d + 12;
+        for (uint32_t x = 0; x < k; ++x) {
+            jent_t* e = j->run[i + x];
+            uint8_t* data = buf + (size_t)(1 + x) * bs;
+            uint32_t flags = x ? JNL_FLAG_SAME_UUID : 0;
+            memcpy(data, e->cur, bs);
+            if (get_be32(data) == JNL_MAGIC) { put_be32(data, 0); flags |= JNL_FLAG_ESCAPE; }
+            if (x == k - 1) flags |= JNL_FLAG_LAST_TAG;
+            uint32_t sum = csum ? ext2fs_crc32c_le(ext2fs_crc32c_le(j->seed, seq, 4), data, bs) : 0;
+            put_be32(t, (uint32_t)e->blk);
+            if (v3) {
+                put_be32(t + 4, flags);
+                put_be32(t + 8, (uint32_t)(e->blk >> 32));
+                put_be32(t + 12, sum);
+            } else {
+                t[4] = (uint8_t)(sum >> 8); t[5] = (uint8_t)sum;
+                t[6] = (uint8_t)(flags >> 8); t[7] = (uint8_t)flags;
+                if (j->incompat & JNL_INCOMPAT_64BIT) put_be32(t + 8, (uint32_t)(e->blk >> 32));
+            }
+            t += j->tag_bytes;
+            if (!x) { memcpy(t, j->jsb + JSB_UUID, 16); t += 16; }
+        }
+        if (csum) put_be32(d + bs - 4, ext2fs_crc32c_le(j->seed, d, bs));
+        rc = jnl_put(j, j->head, 1 + k, buf);
+        j->head += 1 + k;
+        h->stats.journal_blocks += 1 + k;
+        i += k;
+    }
+    // data written in place and the log both land before the commit block
+    if (!rc) rc = jnl_sync(j);
+    if (!rc) {
+        memset(buf, 0, bs);
+        put_be32(buf, JNL_MAGIC);
+        put_be32(buf + 4, JNL_COMMIT);
+        put_be32(buf + 8, j->tid);
+        uint64_t now = (uint64_t)time(NULL);
+        put_be32(buf + 48, (uint32_t)(now >> 32));
+        put_be32(buf + 52, (uint32_t)now);
+        if (csum) put_be32(buf + 16, ext2fs_crc32c_le(j->seed, buf, bs));
+        rc = jnl_put(j, j->head, 1, buf);
+        j->head++;
+        h->stats.journal_blocks++;
+    }
+    if (!rc) rc = jnl_sync(j);
+    free(buf);
+    if (rc) return rc;
+
+    for (uint32_t i = 0; i < n; ++i) {
+        jent_t* e = j->run[i];
+        if (e->logged && e->logged != e->cur) { free(e->logged); j->mem -= bs; }
+        e->logged = e->cur;
+        e->running = 0;
+    }
+    j->nrun = 0;
+    j->tid++;
+    j->empty = 0;
+    jnl_release_freed(j);
+    h->stats.journal_commits++;
+    return 0;
+}
+
+// Flushes libext2fs' metadata into the captured set and logs everything
+// changed since the last commit as one transaction.
+static errcode_t journal_commit(shim_fs_t* h) {
+    ext2_filsys fs = h->fs;
+    uint64_t t0 = now_ns();
+    errcode_t rc = 0;
+    if (fs->flags & EXT2_FLAG_DIRTY) {
+        // backup superblocks and descriptors are left to e2fsck/resize, as the kernel does
+        fs->flags |= EXT2_FLAG_MASTER_SB_ONLY;
+        rc = ext2fs_flush2(fs, EXT2_FLAG_FLUSH_NO_SYNC);
+        fs->flags &= ~EXT2_FLAG_MASTER_SB_ONLY;
+    }
+    if (!rc && h->j.nrun) rc = jnl_log(h);
+    h->j.txn_start = 0;
+    h->stats.flushes++;
+    h->stats.flush_ns += now_ns() - t0;
+    return rc;
+}
+
+// Allocation hooks: new blocks come from outside `busy` while there is room,
+// so file data can go in place without overwriting anything the last commit
+// still references. The hooks record what they hand out themselves rather
+// than through the alloc-stats callbacks, whose range variant gets the
+// wrong extent from libext2fs 1.47.0. A block allocated behind their back
+// (explicit block map) is taken into `busy` and skipped.
+static errcode_t jnl_alloc_block(ext2_filsys fs, blk64_t goal, blk64_t* ret) {
+    journal_t* j = &shim_of(fs)->j;
+    errcode_t rc;
+    while (!(rc = ext2fs_new_block2(fs, goal, j->busy, ret))) {
+        int taken = ext2fs_test_block_bitmap2(fs->block_map, *ret);
+        ext2fs_mark_block_bitmap2(j->busy, *ret);
+        if (!taken) return 0;
+    }
+    if (rc != EXT2_ET_BLOCK_ALLOC_FAIL) return rc;
+    rc = ext2fs_new_block2(fs, goal, fs->block_map, ret);
+    if (!rc) ext2fs_mark_block_bitmap2(j->reused, *ret);
+    return rc;
+}
+
+static errcode_t jnl_new_range(ext2_filsys fs, int flags, blk64_t goal, blk64_t len, blk64_t* pblk, blk64_t* plen) {
+    journal_t* j = &shim_of(fs)->j;
+    errcode_t rc;
+    while (!(rc = ext2fs_new_range(fs, flags, goal, len, j->busy, pblk, plen))) {
+        int taken = !ext2fs_test_block_bitmap_range2(fs->block_map, *pblk, (unsigned)*plen);
+        if (!taken) {
+            ext2fs_mark_block_bitmap_range2(j->busy, *pblk, (unsigned)*plen);
+            return 0;
+        }
+        for (blk64_t b = *pblk; b < *pblk + *plen; ++b)
+            if (ext2fs_test_block_bitmap2(fs->block_map, b)) ext2fs_mark_block_bitmap2(j->busy, b);
+    }
+    if (rc != EXT2_ET_BLOCK_ALLOC_FAIL) return rc;
+    rc = ext2fs_new_range(fs, flags, goal, len, fs->block_map, pblk, plen);
+    if (!rc) ext2fs_mark_block_bitmap_range2(j->reused, *pblk, (unsigned)*plen);
+    return rc;
+}
+
+// ------------------------ Instrumentation hooks ------------------------
+
+static shim_fs_t* shim_of_channel(io_channel ch) {
+    return shim_of((ext2_filsys)ch->app_data);
+}
+
+static uint64_t io_bytes(io_channel ch, long long count) {
+    // negative counts are byte lengths (io_channel convention)
+    return count < 0 ? (uint64_t)(-count) : (uint64_t)count * (uint64_t)ch->block_size;
+}
+
+// With the journal attached, writes are captured (see jnl_capture) unless
+// they carry file data that can safely go in place, and reads see the
+// captured blocks.
+static errcode_t journal_write(shim_fs_t* h, io_channel ch, unsigned long long blk, int count, const void* data) {
+    uint64_t off = (uint64_t)blk * ch->block_size, len = io_bytes(ch, count);
+    if (h->j.direct && !jnl_shadowed(&h->j, off, len))
+        return h->io_base->write_blk64(ch, blk, count, data);
+    return jnl_capture(&h->j, ch, off, len, data);
+}
+
+static errcode_t counting_read_blk(io_channel ch, unsigned long blk, int count, void* data) {
+    shim_fs_t* h = shim_of_channel(ch);
+    h->stats.block_reads++;
+    h->stats.bytes_read += io_bytes(ch, count);
+    errcode_t rc = h->io_base->read_blk(ch, blk, count, data);
+    if (!rc && h->j.count) jnl_overlay(&h->j, (uint64_t)blk * ch->block_size, io_bytes(ch, count), data);
+    return rc;
+}
+
+static errcode_t counting_write_blk(io_channel ch, unsigned long blk, int count, const void* data) {
+    shim_fs_t* h = shim_of_channel(ch);
+    h->stats.block_writes++;
+    h->stats.bytes_written += io_bytes(ch, count);
+    if (h->j.active) return journal_write(h, ch, blk, count, data);
+    return h->io_base->write_blk(ch, blk, count, data);
+}
+
+static errcode_t counting_read_blk64(io_channel ch, unsigned long long blk, int count, void* data) {
+    shim_fs_t* h = shim_of_channel(ch);
+    h->stats.block_reads++;
+    h->stats.bytes_read += io_bytes(ch, count);
+    errcode_t rc = h->io_base->read_blk64(ch, blk, count, data);
+    if (!rc && h->j.count) jnl_overlay(&h->j, (uint64_t)blk * ch->block_size, io_bytes(ch, count), data);
+    return rc;
+}
+
+static errcode_t counting_write_blk64(io_channel ch, unsigned long long blk, int count, const void* data) {
+    shim_fs_t* h = shim_of_channel(ch);
+    h->stats.block_writes++;
+    h->stats.bytes_written += io_bytes(ch, count);
+    if (h->j.active) return journal_write(h, ch, blk, count, data);
+    return h->io_base->write_blk64(ch, blk, count, data);
+}
+
+// Only installed while the journal is attached (zeroing new blocks).
+static errcode_t journal_zeroout(io_channel ch, unsigned long long blk, unsigned long long count) {
+    shim_fs_t* h = shim_of_channel(ch);
+    uint64_t off = (uint64_t)blk * ch->block_size, len = (uint64_t)count * ch->block_size;
+    if (!jnl_shadowed(&h->j, off, len)) return h->io_base->zeroout(ch, blk, count);
+    return jnl_capture(&h->j, ch, off, len, NULL);
+}
+
+static errcode_t counting_write_byte(io_channel ch, unsigned long offset, int size, const void* data) {
+    shim_fs_t* h = shim_of_channel(ch);
+    h->stats.block_writes++;
+    h->stats.bytes_written += (uint64_t)(size < 0 ? -size : size);
+    return h->io_base->write_byte(ch, offset, size, data);
+}
+
+// fs->read_inode/write_inode run before libext2fs' own inode code (cache included);
+// returning CALLBACK_NOTHANDLED lets it proceed normally.
+static errcode_t counting_read_inode(ext2_filsys fs, ext2_ino_t ino, struct ext2_inode* inode) {
+    (void)ino; (void)inode;
+    shim_fs_t* h = shim_of(fs);
+    if (h) h->stats.inode_reads++;
+    return EXT2_ET_CALLBACK_NOTHANDLED;
+}
+
+static errcode_t counting_write_inode(ext2_filsys fs, ext2_ino_t ino, struct ext2_inode* inode) {
+    (void)ino; (void)inode;
+    shim_fs_t* h = shim_of(fs);
+    if (h) h->stats.inode_writes++;
+    return EXT2_ET_CALLBACK_NOTHANDLED;
+}
+
+static void install_counters(shim_fs_t* h) {
+    ext2_filsys fs = h->fs;
+    fs->priv_data = h;
+    fs->read_inode = counting_read_inode;
+    fs->write_inode = counting_write_inode;
+
+    h->io_base = fs->io->manager;
+    h->io_counting = *h->io_base;
+    if (h->io_base->read_blk)    h->io_counting.read_blk    = counting_read_blk;
+    if (h->io_base->write_blk)   h->io_counting.write_blk   = counting_write_blk;
+    if (h->io_base->read_blk64)  h->io_counting.read_blk64  = counting_read_blk64;
+    if (h->io_base->write_blk64) h->io_counting.write_blk64 = counting_write_blk64;
+    if (h->io_base->write_byte)  h->io_counting.write_byte  = counting_write_byte;
+    fs->io->manager = &h->io_counting;
+}
+
+// Attaches the image's journal to a read-write handle before its first
+// mutation. Images whose journal this code cannot write (none, external, v1
+// checksums, unknown features, too small) keep flushing in place per op.
+static void journal_attach(shim_fs_t* h) {
+    journal_t* j = &h->j;
+    ext2_filsys fs = h->fs;
+    if (j->tried || !(fs->flags & EXT2_FLAG_RW)) return;
+    j->tried = 1;
+    j->io = h->io_base;
+    if (jnl_load(fs, j) || (get_be32(j->jsb + JSB_COMPAT) & JNL_COMPAT_CHECKSUM) ||
+        j->maxlen - j->first < JNL_MIN_BLOCKS ||
+        (!(j->incompat & JNL_INCOMPAT_64BIT) && (ext2fs_blocks_count(fs->super) >> 32)) ||
+        jnl_grow(j) || ext2fs_copy_bitmap(fs->block_map, &j->busy) ||
+        ext2fs_allocate_block_bitmap(fs, "journal reused blocks", &j->reused)) {
+        jnl_release(j);
+        return;
+    }
+    // a log left non-empty without needs_recovery is discarded; numbering
+    // jumps past anything it could still hold
+    if (get_be32(j->jsb + JSB_START)) j->tid += j->maxlen;
+    j->empty = 1;
+    j->head = j->first;
+    ext2fs_set_alloc_block_callback(fs, jnl_alloc_block, &j->old_alloc);
+    ext2fs_set_new_range_callback(fs, jnl_new_range, &j->old_range);
+    // the superblock then goes through write_blk64 like every other block
+    h->io_counting.write_byte = NULL;
+    if (h->io_base->zeroout) h->io_counting.zeroout = journal_zeroout;
+    ext2fs_set_feature_journal_needs_recovery(fs->super);
+    j->active = 1;
+}
+
+// Back to plain in-place I/O; the caller has committed and checkpointed.
+static void journal_detach(shim_fs_t* h) {
+    journal_t* j = &h->j;
+    ext2_filsys fs = h->fs;
+    if (!j->active) return;
+    ext2fs_set_alloc_block_callback(fs, j->old_alloc, NULL);
+    ext2fs_set_new_range_callback(fs, j->old_range, NULL);
+    h->io_counting.write_byte = h->io_base->write_byte ? counting_write_byte : NULL;
+    h->io_counting.zeroout = h->io_base->zeroout;
+    ext2fs_clear_feature_journal_needs_recovery(fs->super);
+    jnl_release(j);
+    j->active = 0;
+}
+
+// mark_super_dirty + flush, accounted to the handle. Inside ext4_submit only
+// the dirty mark is set; the batch flushes once at the end. With the journal
+// attached the flush is a commit, and ops are grouped until the commit
+// interval is up (or enough has piled up).
+static errcode_t shim_commit(shim_fs_t* h) {
+    if (h->in_batch) { ext2fs_mark_super_dirty(h->fs); return 0; }
+    if (h->j.active) {
+        journal_t* j = &h->j;
+        uint64_t now = now_ns();
+        ext2fs_mark_super_dirty(h->fs);
+        if (!j->txn_start) j->txn_start = now;
+        if (now - j->txn_start < (uint64_t)j->interval_ms * 1000000ull &&
+            j->mem < JNL_MEM_MAX && j->nrun < (j->maxlen - j->first) / 4)
+            return 0;
+        return journal_commit(h);
+    }
+    uint64_t t0 = now_ns();
+    ext2fs_mark_super_dirty(h->fs);
+    errcode_t rc = ext2fs_flush(h->fs);
+    h->stats.flushes++;
+    h->stats.flush_ns += now_ns() - t0;
+    return rc;
+}
+
+// Commits whatever is pending and, with checkpoint, writes the log back to
+// the home locations so that other handles on the image see every change.
+static errcode_t shim_sync(shim_fs_t* h, int checkpoint) {
+    errcode_t rc = 0;
+    if (h->j.active) {
+        if ((h->fs->flags & EXT2_FLAG_DIRTY) || h->j.nrun) rc = journal_commit(h);
+        if (!rc && checkpoint) rc = jnl_checkpoint(h);
+    } else if (h->fs->flags & EXT2_FLAG_DIRTY) {
+        rc = shim_commit(h);
+    }
+    if (!rc) rc = io_channel_flush(h->fs->io);
+    return rc;
+}
+
+// Bitmaps are not read at open: read-only handles never need them, and a
+// read-write handle loads them before its first mutation (allocations and
+// frees both go through them). The journal is attached at the same point.
+static int need_bitmaps(shim_fs_t* h, char* err, int errlen) {
+    ext2_filsys fs = h->fs;
+    if (fs->inode_map && fs->block_map) return 0;
+    uint64_t t0 = now_ns();
+    errcode_t rc = 0;
+    if (!fs->inode_map) rc = ext2fs_read_inode_bitmap(fs);
+    if (!rc && !fs->block_map) rc = ext2fs_read_block_bitmap(fs);
+    h->stats.bitmap_loads++;
+    h->stats.bitmap_ns += now_ns() - t0;
+    if (rc) { set_err_rc(err, errlen, "read_bitmaps failed", rc); return -1; }
+    journal_attach(h);
+    return 0;
+}
+
+SHIM_API int ext4_get_stats(void* fs_handle, char* json_utf8, int buflen, char* err, int errlen) {
+    if (!fs_handle || !json_utf8 || buflen <= 2) { set_err(err, errlen, "bad args"); return -1; }
+    shim_fs_t* h = (shim_fs_t*)fs_handle;
+    const shim_stats_t* st = &h->stats;
+    int pos = 0;
+    char one[256];
+    json_utf8[0] = 0;
+
+    if (append_json(json_utf8, buflen, &pos, "{\"ops\":{")) goto small;
+    for (int i = 0; i < OP_COUNT; ++i) {
+        snprintf(one, sizeof(one), "%s\"%s\":{\"calls\":%llu,\"ns\":%llu}",
+                 (i ? "," : ""), op_names[i],
+                 (unsigned long long)st->ops[i].calls, (unsigned long long)st->ops[i].ns);
+        if (append_json(json_utf8, buflen, &pos, one)) goto small;
+    }
+    snprintf(one, sizeof(one),
+        "},\"namei\":%llu,\"lookups\":%llu,\"inode_reads\":%llu,\"inode_writes\":%llu,",
+        (unsigned long long)st->namei, (unsigned long long)st->lookups,
+        (unsigned long long)st->inode_reads, (unsigned long long)st->inode_writes);
+    if (append_json(json_utf8, buflen, &pos, one)) goto small;
+    snprintf(one, sizeof(one),
+        "\"block_reads\":%llu,\"block_writes\":%llu,\"bytes_read\":%llu,\"bytes_written\":%llu,",
+        (unsigned long long)st->block_reads, (unsigned long long)st->block_writes,
+        (unsigned long long)st->bytes_read, (unsigned long long)st->bytes_written);
+    if (append_json(json_utf8, buflen, &pos, one)) goto small;
+    snprintf(one, sizeof(one), "\"flushes\":%llu,\"flush_ns\":%llu,\"bitmap_loads\":%llu,\"bitmap_ns\":%llu,",
+        (unsigned long long)st->flushes, (unsigned long long)st->flush_ns,
+        (unsigned long long)st->bitmap_loads, (unsigned long long)st->bitmap_ns);
+    if (append_json(json_utf8, buflen, &pos, one)) goto small;
+    snprintf(one, sizeof(one),
+        "\"journal\":%d,\"journal_commits\":%llu,\"journal_blocks\":%llu,\"checkpoints\":%llu,\"checkpoint_blocks\":%llu}",
+        h->j.active, (unsigned long long)st->journal_commits, (unsigned long long)st->journal_blocks,
+        (unsigned long long)st->checkpoints, (unsigned long long)st->checkpoint_blocks);
+    if (append_json(json_utf8, buflen, &pos, one)) goto small;
+
+    set_err(err, errlen, NULL);
+    return 0;
+small:
+    set_err(err, errlen, "buffer too small");
+    return -1;
+}
+
+// Superblock summary as JSON. wtime/mnt_count/kbytes_written change whenever
+// the image is written (by us or anyone else), so callers can use them to
+// tell whether derived data such as a path index is still current.
+SHIM_API int ext4_fs_info(void* fs_handle, char* json_utf8, int buflen, char* err, int errlen) {
+    if (!fs_handle || !json_utf8 || buflen <= 2) { set_err(err, errlen, "bad args"); return -1; }
+    shim_fs_t* h = (shim_fs_t*)fs_handle;
+    struct ext2_super_block* sb = h->fs->super;
+    char label[sizeof(sb->s_volume_name) + 1], esc[2 * sizeof(label) + 8], uuid[40];
+    memcpy(label, sb->s_volume_name, sizeof(sb->s_volume_name));
+    label[sizeof(sb->s_volume_name)] = 0;
+    if (json_escape_name(label, esc, sizeof(esc))) { set_err(err, errlen, "bad label"); return -1; }
+    const uint8_t* u = sb->s_uuid;
+    snprintf(uuid, sizeof(uuid), "%02x%02x%02x%02x-%02x%02x-%02x%02x-%02x%02x-%02x%02x%02x%02x%02x%02x",
+             u[0], u[1], u[2], u[3], u[4], u[5], u[6], u[7], u[8], u[9], u[10], u[11], u[12], u[13], u[14], u[15]);
+    int n = snprintf(json_utf8, (size_t)buflen,
+        "{\"label\":%s,\"uuid\":\"%s\",\"block_size\":%u,\"blocks\":%llu,\"free_blocks\":%llu,"
+        "\"inodes\":%u,\"free_inodes\":%u,\"groups\":%u,\"wtime\":%u,\"mtime\":%u,"
+        "\"mnt_count\":%u,\"kbytes_written\":%llu}",
+        esc, uuid, h->fs->blocksize,
+        (unsigned long long)ext2fs_blocks_count(sb), (unsigned long long)ext2fs_free_blocks_count(sb),
+        sb->s_inodes_count, sb->s_free_inodes_count, (unsigned)h->fs->group_desc_count,
+        sb->s_wtime, sb->s_mtime, (unsigned)sb->s_mnt_count, (unsigned long long)sb->s_kbytes_written);
+    if (n < 0 || n >= buflen) { set_err(err, errlen, "buffer too small"); return -1; }
+    set_err(err, errlen, NULL);
+    return 0;
+}
+
+SHIM_API int ext4_reset_stats(void* fs_handle) {
+    if (!fs_handle) return -1;
+    shim_fs_t* h = (shim_fs_t*)fs_handle;
+    memset(&h->stats, 0, sizeof(h->stats));
+    return 0;
+}
+
+// ------------------------ Open / Close ------------------------
+
+SHIM_API int ext4_open(const char* image_path, int rw, void** fs_handle, char* err, int errlen) {
+    if (!image_path || !fs_handle) { set_err(err, errlen, "bad args"); return -1; }
+    *fs_handle = NULL;
+    uint64_t t0 = now_ns();
+
+    io_manager io = SHIM_IO_MANAGER;
+    int flags = rw ? (EXT2_FLAG_RW | EXT2_FLAG_64BITS) : EXT2_FLAG_64BITS;
+
+    ext2_filsys fs = NULL;
+    errcode_t rc = ext2fs_open(image_path, flags, 0, 0, io, &fs);
+    if (rc) { set_err_rc(err, errlen, "ext2fs_open failed", rc); return -1; }
+    int recover = ext2fs_has_feature_journal_needs_recovery(fs->super);
+    if (rw && recover) {
+        // a crash (or a writer that is still running) left committed
+        // transactions in the log
+        rc = journal_replay(fs);
+        ext2fs_free(fs);
+        fs = NULL;
+        if (rc) { set_err_rc(err, errlen, "journal replay failed", rc); return -1; }
+        rc = ext2fs_open(image_path, flags, 0, 0, io, &fs);
+        if (rc) { set_err_rc(err, errlen, "ext2fs_open failed", rc); return -1; }
+    }
+
+    shim_fs_t* h = (shim_fs_t*)calloc(1, sizeof(shim_fs_t));
+    if (!h) { ext2fs_close(fs); set_err(err, errlen, "oom"); return -1; }
+    h->fs = fs;
+    install_counters(h);
+    if (!rw && recover && (rc = journal_overlay(h))) {
+        jnl_release(&h->j);
+        ext2fs_close(fs);
+        free(h);
+        set_err_rc(err, errlen, "image needs journal recovery; replay failed", rc);
+        return -1;
+    }
+
+    stats_op(h, OP_OPEN, now_ns() - t0);
+    *fs_handle = h;
+    set_err(err, errlen, NULL);
+    return 0;
+}
+
+SHIM_API int ext4_close(void* fs_handle) {
+    if (!fs_handle) return 0;
+    shim_fs_t* h = (shim_fs_t*)fs_handle;
+    if (h->fs) {
+        if (h->j.active) {
+            // on failure the log still holds the last commit for the next open
+            if (shim_sync(h, 1)) h->fs->flags &= ~EXT2_FLAG_DIRTY;
+            journal_detach(h);
+        }
+        jnl_release(&h->j);  // a read-only handle's replayed blocks
+        // mutations commit as they go; an untouched image keeps its s_wtime
+        if (h->fs->flags & EXT2_FLAG_DIRTY) shim_commit(h);
+        ext2fs_close(h->fs);
+    }
+    free(h);
+    return 0;
+}
+
+static int do_sync(void* fs_handle, int checkpoint, char* err, int errlen) {
+    if (!fs_handle) { set_err(err, errlen, "bad args"); return -1; }
+    shim_fs_t* h = (shim_fs_t*)fs_handle;
+    if (h->fs->flags & EXT2_FLAG_RW) {
+        errcode_t rc = shim_sync(h, checkpoint);
+        if (rc) { set_err_rc(err, errlen, "sync failed", rc); return -1; }
+    }
+    set_err(err, errlen, NULL);
+    return 0;
+}
+
+// Commits the ops grouped so far; checkpoint also writes the log home so the
+// image file is complete for other readers (and for copies of it).
+SHIM_API int ext4_sync(void* fs_handle, int checkpoint, char* err, int errlen) {
+    SHIM_TIMED(fs_handle, OP_SYNC, do_sync(fs_handle, checkpoint, err, errlen));
+}
+
+// How long (ms) ops may be grouped into one journal transaction; 0 commits
+// at the end of every op.
+SHIM_API int ext4_set_commit_interval(void* fs_handle, uint32_t ms) {
+    if (!fs_handle) return -1;
+    ((shim_fs_t*)fs_handle)->j.interval_ms = ms;
+    return 0;
+}
+
+// ------------------------ listdir / stat ------------------------
+
+typedef struct {
+    ext2_filsys fs;
+    char* out;
+    int cap;
+    int pos;
+    int first;
+    int overflow;
+} list_ctx_t;
+
+static int dir_cb(ext2_ino_t dir, int entry, struct ext2_dir_entry *de, int offset, int blocksize, char *buf, void *priv) {
+    (void)dir; (void)entry; (void)offset; (void)blocksize; (void)buf;
+    list_ctx_t* ctx = (list_ctx_t*)priv;
+    int name_len = de ? ext2fs_dirent_name_len(de) : 0;  // high byte of name_len is the file type
+    if (!de || de->inode == 0 || name_len == 0) return 0;
+
+    // get inode for size/mode/dir type
+    struct ext2_inode in; memset(&in, 0, sizeof(in));
+    if (ext2fs_read_inode(ctx->fs, de->inode, &in)) return 0;
+
+    char name[260]; memset(name, 0, sizeof(name));
+    memcpy(name, de->name, (size_t)name_len);
+
+    char esc[600];
+    if (json_escape_name(name, esc, sizeof(esc))) return -1;
+
+    char one[1024];
+    snprintf(one, sizeof(one),
+        "%s{\"name\":%s,\"inode\":%u,\"is_dir\":%s,\"size\":%llu,\"mode\":%u}",
+        (ctx->first ? "" : ","),
+        esc,
+        (unsigned)de->inode,
+        (LINUX_S_ISDIR(in.i_mode) ? "true" : "false"),
+        (unsigned long long)EXT2_I_SIZE(&in),
+        (unsigned)in.i_mode
+    );
+    if (append_json(ctx->out, ctx->cap, &ctx->pos, one)) { ctx->overflow = 1; return DIRENT_ABORT; }
+    ctx->first = 0;
+    return 0;
+}
+
+static int do_listdir(void* fs_handle, const char* abs_path, char* json_utf8, int buflen, char* err, int errlen) {
+    if (!fs_handle || !json_utf8 || buflen <= 2) { set_err(err, errlen, "bad args"); return -1; }
+    json_utf8[0] = 0;
 
     shim_fs_t* h = (shim_fs_t*)fs_handle;
     ext2_ino_t ino = 0;
@@ -303,13 +2115,17 @@ SHIM_API int ext4_listdir(void* fs_handle, const char* abs_path, char* json_utf8
     if (append_json(json_utf8, buflen, &ctx.pos, "[")) { set_err(err, errlen, "buffer too small"); return -1; }
     errcode_t rc = ext2fs_dir_iterate2(h->fs, ino, 0, NULL, dir_cb, &ctx);
     if (rc) { set_err_rc(err, errlen, "dir_iterate failed", rc); return -1; }
-    if (append_json(json_utf8, buflen, &ctx.pos, "]")) { set_err(err, errlen, "buffer too small"); return -1; }
+    if (ctx.overflow || append_json(json_utf8, buflen, &ctx.pos, "]")) { set_err(err, errlen, "buffer too small"); return -1; }
 
     set_err(err, errlen, NULL);
     return 0;
 }
 
-SHIM_API int ext4_stat(void* fs_handle, const char* abs_path, char* json_utf8, int buflen, char* err, int errlen) {
+SHIM_API int ext4_listdir(void* fs_handle, const char* abs_path, char* json_utf8, int buflen, char* err, int errlen) {
+    SHIM_TIMED(fs_handle, OP_LISTDIR, do_listdir(fs_handle, abs_path, json_utf8, buflen, err, errlen));
+}
+
+static int do_stat(void* fs_handle, const char* abs_path, char* json_utf8, int buflen, char* err, int errlen) {
     if (!fs_handle || !json_utf8 || buflen < 16) { set_err(err, errlen, "bad args"); return -1; }
     json_utf8[0] = 0;
 
@@ -329,7 +2145,7 @@ SHIM_API int ext4_stat(void* fs_handle, const char* abs_path, char* json_utf8, i
         "\"uid\":%u,\"gid\":%u,\"atime\":%u,\"mtime\":%u,\"ctime\":%u}",
         (unsigned)ino,
         (LINUX_S_ISDIR(in.i_mode) ? "true" : "false"),
-        (unsigned long long)in.i_size,
+        (unsigned long long)EXT2_I_SIZE(&in),
         (unsigned)in.i_mode,
         (unsigned)(in.i_uid | (in.osd2.linux2.l_i_uid_high << 16)),
         (unsigned)(in.i_gid | (in.osd2.linux2.l_i_gid_high << 16)),
@@ -339,9 +2155,98 @@ SHIM_API int ext4_stat(void* fs_handle, const char* abs_path, char* json_utf8, i
     return 0;
 }
 
+SHIM_API int ext4_stat(void* fs_handle, const char* abs_path, char* json_utf8, int buflen, char* err, int errlen) {
+    SHIM_TIMED(fs_handle, OP_STAT, do_stat(fs_handle, abs_path, json_utf8, buflen, err, errlen));
+}
+
 // ------------------------ read / write_overwrite ------------------------
 
-SHIM_API int ext4_read(void* fs_handle, const char* abs_path, uint8_t* out_buf, uint64_t bufsize, uint64_t* out_read, char* err, int errlen) {
+// While on, device writes carry file data only and go in place unless the
+// journal says otherwise (see journal_write).
+static void data_in_place(ext2_filsys fs, int on) {
+    shim_fs_t* h = shim_of(fs);
+    if (h) h->j.direct += on ? 1 : -1;
+}
+
+// Moves len bytes at file offset off of an extent-mapped file between buf
+// and the device with one request per extent rather than one per block. On
+// read, holes and uninitialized extents come back as zeros; on write every
+// block in range must already be allocated (see fallocate in
+// do_write_overwrite), a block only partly covered at the start of the range
+// is read-modify-written and one partly covered at the end is zero-padded, so
+// writes must run up to EOF.
+static errcode_t extent_rw(ext2_filsys fs, ext2_ino_t ino, struct ext2_inode* in, uint64_t off, uint8_t* buf, uint64_t len, int write) {
+    unsigned bs = fs->blocksize;
+    uint8_t* tail = NULL;
+    uint64_t pos = off, stop = off + len;
+    ext2_extent_handle_t eh = NULL;
+    errcode_t rc = ext2fs_extent_open2(fs, ino, in, &eh);
+    if (rc) return rc;
+    if (write) data_in_place(fs, 1);
+
+    struct ext2fs_extent ext;
+    int op = EXT2_EXTENT_ROOT;
+    for (;;) {
+        rc = ext2fs_extent_get(eh, op, &ext);
+        if (rc) { if (rc == EXT2_ET_EXTENT_NO_NEXT) rc = 0; break; }
+        op = EXT2_EXTENT_NEXT;
+        if (!(ext.e_flags & EXT2_EXTENT_FLAGS_LEAF) || (ext.e_flags & EXT2_EXTENT_FLAGS_SECOND_VISIT)) continue;
+        if ((ext.e_flags & EXT2_EXTENT_FLAGS_UNINIT) || ext.e_len == 0) continue;
+        uint64_t estart = (uint64_t)ext.e_lblk * bs;
+        uint64_t eend = estart + (uint64_t)ext.e_len * bs;
+        if (estart >= stop) break;
+        if (eend <= off) continue;
+        uint64_t start = estart > off ? estart : off;
+        uint64_t end = MINU64(eend, stop);
+        if (!write && start > pos) memset(buf + (pos - off), 0, start - pos);
+        blk64_t blk = ext.e_pblk + (start - estart) / bs;
+
+        unsigned head = (unsigned)(start % bs);
+        if (head) {
+            unsigned n = (unsigned)MINU64(bs - head, end - start);
+            if (!tail && (rc = ext2fs_get_mem(bs, &tail))) break;
+            if ((rc = io_channel_read_blk64(fs->io, blk, 1, tail))) break;
+            if (write) {
+                memcpy(tail + head, buf + (start - off), n);
+                if ((rc = io_channel_write_blk64(fs->io, blk, 1, tail))) break;
+            } else {
+                memcpy(buf + (start - off), tail + head, n);
+            }
+            start += n;
+            blk++;
+        }
+        int full = (int)((end - start) / bs);  // an extent is at most 32768 blocks
+        if (full) {
+            rc = write ? io_channel_write_blk64(fs->io, blk, full, buf + (start - off))
+                       : io_channel_read_blk64(fs->io, blk, full, buf + (start - off));
+            if (rc) break;
+        }
+        unsigned part = (unsigned)((end - start) % bs);
+        if (part) {
+            if (!tail && (rc = ext2fs_get_mem(bs, &tail))) break;
+            blk += (blk64_t)full;
+            if (write) {
+                memcpy(tail, buf + (end - part - off), part);
+                memset(tail + part, 0, bs - part);
+                rc = io_channel_write_blk64(fs->io, blk, 1, tail);
+            } else {
+                rc = io_channel_read_blk64(fs->io, blk, 1, tail);
+                if (!rc) memcpy(buf + (end - part - off), tail, part);
+            }
+            if (rc) break;
+        }
+        pos = end;
+    }
+    if (!rc && !write && pos < stop) memset(buf + (pos - off), 0, stop - pos);
+    if (write) data_in_place(fs, 0);
+    if (tail) ext2fs_free_mem(&tail);
+    ext2fs_extent_free(eh);
+    return rc;
+}
+
+// Reads up to bufsize bytes starting at file offset off; *out_read is 0 at
+// or past EOF.
+static int do_read(void* fs_handle, const char* abs_path, uint64_t off, uint8_t* out_buf, uint64_t bufsize, uint64_t* out_read, char* err, int errlen) {
     if (!fs_handle || !abs_path || !out_buf || !out_read) { set_err(err, errlen, "bad args"); return -1; }
     *out_read = 0;
 
@@ -353,12 +2258,25 @@ SHIM_API int ext4_read(void* fs_handle, const char* abs_path, uint8_t* out_buf,
     if (ext2fs_read_inode(h->fs, ino, &in)) { set_err(err, errlen, "read_inode failed"); return -1; }
     if (LINUX_S_ISDIR(in.i_mode)) { set_err(err, errlen, "Is a directory"); return -1; }
 
+    uint64_t size = EXT2_I_SIZE(&in);
+    uint64_t toread = off < size ? MINU64(bufsize, size - off) : 0;
+    if (!toread) { set_err(err, errlen, NULL); return 0; }
+    errcode_t rc;
+    if ((in.i_flags & EXT4_EXTENTS_FL) && !(in.i_flags & EXT4_INLINE_DATA_FL)) {
+        rc = extent_rw(h->fs, ino, &in, off, out_buf, toread, 0);
+        if (rc) { set_err_rc(err, errlen, "read failed", rc); return -1; }
+        *out_read = toread;
+        set_err(err, errlen, NULL);
+        return 0;
+    }
+
     ext2_file_t f = NULL;
-    errcode_t rc = ext2fs_file_open2(h->fs, ino, &in, 0, &f);
+    rc = ext2fs_file_open2(h->fs, ino, &in, 0, &f);
     if (rc) { set_err_rc(err, errlen, "file_open failed", rc); return -1; }
+    if (off && (rc = ext2fs_file_llseek(f, off, EXT2_SEEK_SET, NULL))) {
+        ext2fs_file_close(f); set_err_rc(err, errlen, "file_llseek failed", rc); return -1;
+    }
 
-    uint64_t size = in.i_size;
-    uint64_t toread = (bufsize < size) ? bufsize : size;
     uint64_t done = 0;
 
     while (done < toread) {
@@ -375,50 +2293,169 @@ SHIM_API int ext4_read(void* fs_handle, const char* abs_path, uint8_t* out_buf,
     return 0;
 }
 
-static int create_or_truncate_file(ext2_filsys fs, const char* abs_path, uint16_t mode, ext2_ino_t* out_ino, char* err, int errlen) {
-    char parent[512], base[256];
-    if (lookup_parent_and_base(abs_path, parent, sizeof(parent), base, sizeof(base), err, errlen)) return -1;
-
+SHIM_API int ext4_read(void* fs_handle, const char* abs_path, uint8_t* out_buf, uint64_t bufsize, uint64_t* out_read, char* err, int errlen) {
+    SHIM_TIMED(fs_handle, OP_READ, do_read(fs_handle, abs_path, 0, out_buf, bufsize, out_read, err, errlen));
+}
+
+// Positioned read for streaming a file out in chunks without holding it all.
+SHIM_API int ext4_read_at(void* fs_handle, const char* abs_path, uint64_t offset, uint8_t* out_buf, uint64_t bufsize, uint64_t* out_read, char* err, int errlen) {
+    SHIM_TIMED(fs_handle, OP_READ_AT, do_read(fs_handle, abs_path, offset, out_buf, bufsize, out_read, err, errlen));
+}
+
+// Allocates an inode for a new non-directory and links it as pino/name.
+static int create_inode(ext2_filsys fs, ext2_ino_t pino, const char* name, uint16_t mode, ext2_ino_t* out_ino, char* err, int errlen) {
+    ext2_ino_t ino = 0;
+    errcode_t rc = ext2fs_new_inode(fs, pino, mode, 0, &ino);
+    if (rc) { set_err_rc(err, errlen, "new_inode failed", rc); return -1; }
+
+    struct ext2_inode in; memset(&in, 0, sizeof(in));
+    in.i_mode = mode;
+    in.i_links_count = 1;
+    in.i_atime = in.i_ctime = in.i_mtime = (uint32_t)time(NULL);
+    if (ext2fs_has_feature_extents(fs->super) && LINUX_S_ISREG(mode)) {
+        // empty extent tree in i_block (device nodes keep i_block for rdev)
+        ext2_extent_handle_t eh = NULL;
+        rc = ext2fs_extent_open2(fs, ino, &in, &eh);
+        if (rc) { set_err_rc(err, errlen, "extent_open failed", rc); return -1; }
+        ext2fs_extent_free(eh);
+    }
+    rc = link_entry(fs, pino, name, ino, mode_to_ftype(mode));
+    if (rc) { set_err_rc(err, errlen, "link failed", rc); return -1; }
+    ext2fs_inode_alloc_stats2(fs, ino, +1, 0);
+    rc = ext2fs_write_new_inode(fs, ino, &in);
+    if (rc) { set_err_rc(err, errlen, "write_inode failed", rc); return -1; }
+
+    *out_ino = ino;
+    return 0;
+}
+
+static int create_or_truncate_file(ext2_filsys fs, const char* abs_path, uint16_t mode, ext2_ino_t* out_ino, char* err, int errlen) {
+    char parent[512], base[256];
+    if (lookup_parent_and_base(abs_path, parent, sizeof(parent), base, sizeof(base), err, errlen)) return -1;
+
     ext2_ino_t pino = 0;
     if (path_to_ino(fs, parent, &pino, err, errlen)) return -1;
 
     // existing?
     ext2_ino_t existing = 0;
-    errcode_t rc = ext2fs_lookup(fs, pino, base, (int)strlen(base), NULL, &existing);
+    errcode_t rc = dir_lookup(fs, pino, base, &existing);
     if (rc == 0 && existing != 0) {
         struct ext2_inode in; memset(&in, 0, sizeof(in));
         if (ext2fs_read_inode(fs, existing, &in)) { set_err(err, errlen, "read_inode failed"); return -1; }
         if (LINUX_S_ISDIR(in.i_mode)) { set_err(err, errlen, "Target exists and is a directory"); return -1; }
         // truncate to zero by open+set_size
         ext2_file_t f = NULL;
-        rc = ext2fs_file_open2(fs, existing, &in, 0, &f);
+        rc = ext2fs_file_open2(fs, existing, &in, EXT2_FILE_WRITE, &f);
         if (rc) { set_err_rc(err, errlen, "file_open(write) failed", rc); return -1; }
         rc = ext2fs_file_set_size2(f, 0);
         ext2fs_file_close(f);
         if (rc) { set_err_rc(err, errlen, "set_size(0) failed", rc); return -1; }
+        // new content: mtime/ctime move on like a kernel O_TRUNC write
+        if ((rc = ext2fs_read_inode(fs, existing, &in))) { set_err_rc(err, errlen, "read_inode failed", rc); return -1; }
+        in.i_mtime = in.i_ctime = (uint32_t)time(NULL);
+        if ((rc = ext2fs_write_inode(fs, existing, &in))) { set_err_rc(err, errlen, "write_inode failed", rc); return -1; }
         *out_ino = existing;
         return 0;
     }
 
     // new file
     ext2_ino_t ino = 0;
-    rc = ext2fs_new_inode(fs, pino, LINUX_S_IFREG, 0, &ino);
-    if (rc) { set_err_rc(err, errlen, "new_inode failed", rc); return -1; }
+    if (create_inode(fs, pino, base, (uint16_t)(LINUX_S_IFREG | (mode & 0777)), &ino, err, errlen)) return -1;
 
-    struct ext2_inode in; memset(&in, 0, sizeof(in));
-    in.i_mode = LINUX_S_IFREG | (mode & 0777);
-    if (ext2fs_write_inode(fs, ino, &in)) { set_err(err, errlen, "write_inode failed"); return -1; }
+    *out_ino = ino;
+    return 0;
+}
 
-    rc = ext2fs_link(fs, pino, base, ino, EXT2_FT_REG_FILE);
-    if (rc) { set_err_rc(err, errlen, "link failed", rc); return -1; }
+// With inline_data, a payload that fits in the inode (60 bytes of i_block
+// plus the free in-inode xattr space) is stored there: no data block and no
+// second read. in must be empty (just created or truncated). Returns 1 when
+// stored inline, 0 when the caller should write blocks (an inline inode is
+// turned back into an empty block-mapped one first), -1 on error.
+static int write_inline(ext2_filsys fs, ext2_ino_t ino, struct ext2_inode* in, const uint8_t* data, uint64_t size,
+                        char* err, int errlen) {
+    if (!ext2fs_has_feature_inline_data(fs->super)) return 0;
+    int was_inline = (in->i_flags & EXT4_INLINE_DATA_FL) != 0;
+    size_t room = EXT4_MIN_INLINE_DATA_SIZE, ea = 0;
+    if (size > room && !ext2fs_xattr_inode_max_size(fs, ino, &ea)) room += ea;
+    errcode_t rc = 0;
+    if (size <= room && (was_inline || (size && !ext2fs_inode_data_blocks2(fs, in)))) {
+        if (!was_inline) {
+            in->i_flags = (in->i_flags & ~EXT4_EXTENTS_FL) | EXT4_INLINE_DATA_FL;
+            memset(in->i_block, 0, sizeof(in->i_block));
+            rc = ext2fs_write_inode(fs, ino, in);
+            if (!rc) rc = ext2fs_inline_data_init(fs, ino);
+            if (rc) { set_err_rc(err, errlen, "inline_data_init failed", rc); return -1; }
+            was_inline = 1;
+        }
+        rc = ext2fs_inode_size_set(fs, in, size);
+        if (!rc) rc = ext2fs_inline_data_set(fs, ino, in, (void*)data, (size_t)size);
+        if (!rc) return 1;
+        if (rc != EXT2_ET_INLINE_DATA_NO_SPACE) { set_err_rc(err, errlen, "inline write failed", rc); return -1; }
+    }
+    if (!was_inline) return 0;
 
-    *out_ino = ino;
+    // too big for the inode: drop the inline data and start an empty block map
+    rc = ext2fs_inline_data_ea_remove(fs, ino);
+    if (!rc) rc = ext2fs_read_inode(fs, ino, in);
+    if (!rc) {
+        in->i_flags &= ~EXT4_INLINE_DATA_FL;
+        memset(in->i_block, 0, sizeof(in->i_block));
+        rc = ext2fs_inode_size_set(fs, in, 0);
+    }
+    if (!rc && ext2fs_has_feature_extents(fs->super)) {
+        ext2_extent_handle_t eh = NULL;
+        rc = ext2fs_extent_open2(fs, ino, in, &eh);
+        if (!rc) ext2fs_extent_free(eh);
+    }
+    if (!rc) rc = ext2fs_write_inode(fs, ino, in);
+    if (rc) { set_err_rc(err, errlen, "inline data removal failed", rc); return -1; }
     return 0;
 }
 
-SHIM_API int ext4_write_overwrite(void* fs_handle, const char* abs_path, const uint8_t* data, uint64_t size, uint16_t mode, char* err, int errlen) {
+// Writes the whole content of an empty (just created or truncated) file.
+static int write_file_data(ext2_filsys fs, ext2_ino_t ino, struct ext2_inode* in, const uint8_t* data, uint64_t size,
+                           char* err, int errlen) {
+    int stored = write_inline(fs, ino, in, data, size, err, errlen);
+    if (stored) return stored < 0 ? -1 : 0;
+
+    errcode_t rc;
+    if ((in->i_flags & EXT4_EXTENTS_FL) && !(in->i_flags & EXT4_INLINE_DATA_FL) && size) {
+        // allocate the whole file up front so it lands in as few extents as
+        // the free space allows, then write each extent in one request
+        blk64_t nblk = (size + fs->blocksize - 1) / fs->blocksize;
+        rc = ext2fs_fallocate(fs, EXT2_FALLOCATE_FORCE_INIT, ino, in, ~0ULL, 0, nblk);
+        if (rc) { set_err_rc(err, errlen, "fallocate failed", rc); return -1; }
+        rc = extent_rw(fs, ino, in, 0, (uint8_t*)data, size, 1);
+        if (rc) { set_err_rc(err, errlen, "write failed", rc); return -1; }
+        rc = ext2fs_inode_size_set(fs, in, size);
+        if (!rc) rc = ext2fs_write_inode(fs, ino, in);
+        if (rc) { set_err_rc(err, errlen, "write_inode failed", rc); return -1; }
+        return 0;
+    }
+
+    ext2_file_t f = NULL;
+    rc = ext2fs_file_open2(fs, ino, in, EXT2_FILE_WRITE, &f);
+    if (rc) { set_err_rc(err, errlen, "file_open(write) failed", rc); return -1; }
+
+    uint64_t done = 0;
+    while (done < size) {
+        unsigned int chunk = (unsigned int)MIN(64*1024ULL, size - done);
+        unsigned int wrote = 0;
+        rc = ext2fs_file_write(f, (void*)(data + done), chunk, &wrote);
+        if (rc) { ext2fs_file_close(f); set_err_rc(err, errlen, "file_write failed", rc); return -1; }
+        if (wrote == 0) break;
+        done += wrote;
+    }
+    rc = ext2fs_file_set_size2(f, size);
+    ext2fs_file_close(f);
+    if (rc) { set_err_rc(err, errlen, "set_size(final) failed", rc); return -1; }
+    return 0;
+}
+
+static int do_write_overwrite(void* fs_handle, const char* abs_path, const uint8_t* data, uint64_t size, uint16_t mode, char* err, int errlen) {
     if (!fs_handle || !abs_path || !data) { set_err(err, errlen, "bad args"); return -1; }
     shim_fs_t* h = (shim_fs_t*)fs_handle;
+    if (need_bitmaps(h, err, errlen)) return -1;
 
     // ensure parent dirs exist
     {
@@ -428,98 +2465,1512 @@ SHIM_API int ext4_write_overwrite(void* fs_handle, const char* abs_path, const u
     }
 
     ext2_ino_t ino = 0;
-    if (create_or_truncate_file(h->fs, abs_path, mode, &ino, err, errlen)) return -1;
-
+    if (create_or_truncate_file(h->fs, abs_path, mode, &ino, err, errlen)) return -1;
+
+    struct ext2_inode in; memset(&in, 0, sizeof(in));
+    if (ext2fs_read_inode(h->fs, ino, &in)) { set_err(err, errlen, "read_inode failed"); return -1; }
+
+    if (write_file_data(h->fs, ino, &in, data, size, err, errlen)) return -1;
+    errcode_t rc = shim_commit(h);
+    if (rc) { set_err_rc(err, errlen, "flush failed", rc); return -1; }
+    set_err(err, errlen, NULL);
+    return 0;
+}
+
+SHIM_API int ext4_write_overwrite(void* fs_handle, const char* abs_path, const uint8_t* data, uint64_t size, uint16_t mode, char* err, int errlen) {
+    SHIM_TIMED(fs_handle, OP_WRITE, do_write_overwrite(fs_handle, abs_path, data, size, mode, err, errlen));
+}
+
+// ------------------------ hashing ------------------------
+// Streams file blocks through a digest inside the shim so only the digest
+// crosses the FFI boundary. Supported: "crc32c", "sha256", "xxh64".
+
+#define HASH_BUF_SIZE (1024 * 1024)
+
+enum { HASH_CRC32C = 1, HASH_SHA256 = 2, HASH_XXH64 = 3 };
+
+static uint32_t crc32c_table[8][256];
+static int crc32c_table_ready = 0;
+
+static void crc32c_init_table(void) {
+    if (crc32c_table_ready) return;
+    for (uint32_t i = 0; i < 256; ++i) {
+        uint32_t c = i;
+        for (int k = 0; k < 8; ++k) c = (c & 1) ? (c >> 1) ^ 0x82F63B78u : (c >> 1);
+        crc32c_table[0][i] = c;
+    }
+    for (uint32_t i = 0; i < 256; ++i) {
+        uint32_t c = crc32c_table[0][i];
+        for (int t = 1; t < 8; ++t) {
+            c = crc32c_table[0][c & 0xFF] ^ (c >> 8);
+            crc32c_table[t][i] = c;
+        }
+    }
+    crc32c_table_ready = 1;
+}
+
+static uint32_t crc32c_update(uint32_t crc, const uint8_t* p, size_t n) {
+    // slicing-by-8
+    while (n && ((uintptr_t)p & 7)) { crc = crc32c_table[0][(crc ^ *p++) & 0xFF] ^ (crc >> 8); --n; }
+    while (n >= 8) {
+        uint32_t lo = crc ^ ((uint32_t)p[0] | ((uint32_t)p[1] << 8) | ((uint32_t)p[2] << 16) | ((uint32_t)p[3] << 24));
+        uint32_t hi = (uint32_t)p[4] | ((uint32_t)p[5] << 8) | ((uint32_t)p[6] << 16) | ((uint32_t)p[7] << 24);
+        crc = crc32c_table[7][lo & 0xFF] ^ crc32c_table[6][(lo >> 8) & 0xFF] ^
+              crc32c_table[5][(lo >> 16) & 0xFF] ^ crc32c_table[4][lo >> 24] ^
+              crc32c_table[3][hi & 0xFF] ^ crc32c_table[2][(hi >> 8) & 0xFF] ^
+              crc32c_table[1][(hi >> 16) & 0xFF] ^ crc32c_table[0][hi >> 24];
+        p += 8; n -= 8;
+    }
+    while (n--) crc = crc32c_table[0][(crc ^ *p++) & 0xFF] ^ (crc >> 8);
+    return crc;
+}
+
+typedef struct {
+    uint32_t h[8];
+    uint64_t len;
+    uint8_t buf[64];
+    int fill;
+} sha256_ctx_t;
+
+static const uint32_t sha256_k[64] = {
+    0x428a2f98,0x71374491,0xb5c0fbcf,0xe9b5dba5,0x3956c25b,0x59f111f1,0x923f82a4,0xab1c5ed5,
+    0xd807aa98,0x12835b01,0x243185be,0x550c7dc3,0x72be5d74,0x80deb1fe,0x9bdc06a7,0xc19bf174,
+    0xe49b69c1,0xefbe4786,0x0fc19dc6,0x240ca1cc,0x2de92c6f,0x4a7484aa,0x5cb0a9dc,0x76f988da,
+    0x983e5152,0xa831c66d,0xb00327c8,0xbf597fc7,0xc6e00bf3,0xd5a79147,0x06ca6351,0x14292967,
+    0x27b70a85,0x2e1b2138,0x4d2c6dfc,0x53380d13,0x650a7354,0x766a0abb,0x81c2c92e,0x92722c85,
+    0xa2bfe8a1,0xa81a664b,0xc24b8b70,0xc76c51a3,0xd192e819,0xd6990624,0xf40e3585,0x106aa070,
+    0x19a4c116,0x1e376c08,0x2748774c,0x34b0bcb5,0x391c0cb3,0x4ed8aa4a,0x5b9cca4f,0x682e6ff3,
+    0x748f82ee,0x78a5636f,0x84c87814,0x8cc70208,0x90befffa,0xa4506ceb,0xbef9a3f7,0xc67178f2
+};
+
+#define ROR32(x,n) (((x) >> (n)) | ((x) << (32 - (n))))
+
+static void sha256_block(sha256_ctx_t* c, const uint8_t* p) {
+    uint32_t w[64];
+    for (int i = 0; i < 16; ++i)
+        w[i] = ((uint32_t)p[4*i] << 24) | ((uint32_t)p[4*i+1] << 16) | ((uint32_t)p[4*i+2] << 8) | p[4*i+3];
+    for (int i = 16; i < 64; ++i) {
+        uint32_t s0 = ROR32(w[i-15], 7) ^ ROR32(w[i-15], 18) ^ (w[i-15] >> 3);
+        uint32_t s1 = ROR32(w[i-2], 17) ^ ROR32(w[i-2], 19) ^ (w[i-2] >> 10);
+        w[i] = w[i-16] + s0 + w[i-7] + s1;
+    }
+    uint32_t a = c->h[0], b = c->h[1], cc = c->h[2], d = c->h[3];
+    uint32_t e = c->h[4], f = c->h[5], g = c->h[6], hh = c->h[7];
+    for (int i = 0; i < 64; ++i) {
+        uint32_t t1 = hh + (ROR32(e, 6) ^ ROR32(e, 11) ^ ROR32(e, 25)) + ((e & f) ^ (~e & g)) + sha256_k[i] + w[i];
+        uint32_t t2 = (ROR32(a, 2) ^ ROR32(a, 13) ^ ROR32(a, 22)) + ((a & b) ^ (a & cc) ^ (b & cc));
+        hh = g; g = f; f = e; e = d + t1; d = cc; cc = b; b = a; a = t1 + t2;
+    }
+    c->h[0] += a; c->h[1] += b; c->h[2] += cc; c->h[3] += d;
+    c->h[4] += e; c->h[5] += f; c->h[6] += g; c->h[7] += hh;
+}
+
+static void sha256_init(sha256_ctx_t* c) {
+    static const uint32_t iv[8] = {
+        0x6a09e667,0xbb67ae85,0x3c6ef372,0xa54ff53a,0x510e527f,0x9b05688c,0x1f83d9ab,0x5be0cd19
+    };
+    memcpy(c->h, iv, sizeof(iv));
+    c->len = 0; c->fill = 0;
+}
+
+static void sha256_update(sha256_ctx_t* c, const uint8_t* p, size_t n) {
+    c->len += n;
+    if (c->fill) {
+        size_t take = MIN((size_t)(64 - c->fill), n);
+        memcpy(c->buf + c->fill, p, take);
+        c->fill += (int)take; p += take; n -= take;
+        if (c->fill < 64) return;
+        sha256_block(c, c->buf); c->fill = 0;
+    }
+    while (n >= 64) { sha256_block(c, p); p += 64; n -= 64; }
+    if (n) { memcpy(c->buf, p, n); c->fill = (int)n; }
+}
+
+static void sha256_final(sha256_ctx_t* c, uint8_t out[32]) {
+    uint64_t bits = c->len * 8;
+    uint8_t pad = 0x80, zero = 0, lenbe[8];
+    sha256_update(c, &pad, 1);
+    while (c->fill != 56) sha256_update(c, &zero, 1);
+    for (int i = 0; i < 8; ++i) lenbe[i] = (uint8_t)(bits >> (56 - 8*i));
+    sha256_update(c, lenbe, 8);
+    for (int i = 0; i < 8; ++i) {
+        out[4*i]   = (uint8_t)(c->h[i] >> 24); out[4*i+1] = (uint8_t)(c->h[i] >> 16);
+        out[4*i+2] = (uint8_t)(c->h[i] >> 8);  out[4*i+3] = (uint8_t)(c->h[i]);
+    }
+}
+
+// XXH64, seed 0
+#define XXH_P1 0x9E3779B185EBCA87ULL
+#define XXH_P2 0xC2B2AE3D27D4EB4FULL
+#define XXH_P3 0x165667B19E3779F9ULL
+#define XXH_P4 0x85EBCA77C2B2AE63ULL
+#define XXH_P5 0x27D4EB2F165667C5ULL
+#define ROL64(x,n) (((x) << (n)) | ((x) >> (64 - (n))))
+
+typedef struct {
+    uint64_t v[4];
+    uint64_t len;
+    uint8_t buf[32];
+    int fill;
+} xxh64_ctx_t;
+
+static uint64_t xxh_read64(const uint8_t* p) {
+    uint64_t v = 0;
+    for (int i = 7; i >= 0; --i) v = (v << 8) | p[i];
+    return v;
+}
+
+static uint64_t xxh_round(uint64_t acc, uint64_t in) {
+    acc += in * XXH_P2;
+    acc = ROL64(acc, 31);
+    return acc * XXH_P1;
+}
+
+static uint64_t xxh_merge(uint64_t acc, uint64_t v) {
+    acc ^= xxh_round(0, v);
+    return acc * XXH_P1 + XXH_P4;
+}
+
+static void xxh64_init(xxh64_ctx_t* c) {
+    c->v[0] = XXH_P1 + XXH_P2; c->v[1] = XXH_P2; c->v[2] = 0; c->v[3] = 0 - XXH_P1;
+    c->len = 0; c->fill = 0;
+}
+
+static void xxh64_stripe(xxh64_ctx_t* c, const uint8_t* p) {
+    c->v[0] = xxh_round(c->v[0], xxh_read64(p));
+    c->v[1] = xxh_round(c->v[1], xxh_read64(p + 8));
+    c->v[2] = xxh_round(c->v[2], xxh_read64(p + 16));
+    c->v[3] = xxh_round(c->v[3], xxh_read64(p + 24));
+}
+
+static void xxh64_update(xxh64_ctx_t* c, const uint8_t* p, size_t n) {
+    c->len += n;
+    if (c->fill) {
+        size_t take = MIN((size_t)(32 - c->fill), n);
+        memcpy(c->buf + c->fill, p, take);
+        c->fill += (int)take; p += take; n -= take;
+        if (c->fill < 32) return;
+        xxh64_stripe(c, c->buf); c->fill = 0;
+    }
+    while (n >= 32) { xxh64_stripe(c, p); p += 32; n -= 32; }
+    if (n) { memcpy(c->buf, p, n); c->fill = (int)n; }
+}
+
+static uint64_t xxh64_final(xxh64_ctx_t* c) {
+    uint64_t h;
+    if (c->len >= 32) {
+        h = ROL64(c->v[0], 1) + ROL64(c->v[1], 7) + ROL64(c->v[2], 12) + ROL64(c->v[3], 18);
+        for (int i = 0; i < 4; ++i) h = xxh_merge(h, c->v[i]);
+    } else {
+        h = c->v[2] + XXH_P5;
+    }
+    h += c->len;
+    const uint8_t* p = c->buf;
+    int n = c->fill;
+    while (n >= 8) { h ^= xxh_round(0, xxh_read64(p)); h = ROL64(h, 27) * XXH_P1 + XXH_P4; p += 8; n -= 8; }
+    if (n >= 4) {
+        uint64_t k = (uint64_t)p[0] | ((uint64_t)p[1] << 8) | ((uint64_t)p[2] << 16) | ((uint64_t)p[3] << 24);
+        h ^= k * XXH_P1; h = ROL64(h, 23) * XXH_P2 + XXH_P3; p += 4; n -= 4;
+    }
+    while (n--) { h ^= (*p++) * XXH_P5; h = ROL64(h, 11) * XXH_P1; }
+    h ^= h >> 33; h *= XXH_P2; h ^= h >> 29; h *= XXH_P3; h ^= h >> 32;
+    return h;
+}
+
+typedef struct {
+    int algo;
+    uint32_t crc;
+    sha256_ctx_t sha;
+    xxh64_ctx_t xxh;
+} hasher_t;
+
+static int hasher_init(hasher_t* hs, const char* algo) {
+    memset(hs, 0, sizeof(*hs));
+    if (!algo || !algo[0] || strcmp(algo, "sha256") == 0) { hs->algo = HASH_SHA256; sha256_init(&hs->sha); }
+    else if (strcmp(algo, "crc32c") == 0) { hs->algo = HASH_CRC32C; crc32c_init_table(); hs->crc = 0xFFFFFFFFu; }
+    else if (strcmp(algo, "xxh64") == 0) { hs->algo = HASH_XXH64; xxh64_init(&hs->xxh); }
+    else return -1;
+    return 0;
+}
+
+static void hasher_update(hasher_t* hs, const uint8_t* p, size_t n) {
+    switch (hs->algo) {
+        case HASH_CRC32C: hs->crc = crc32c_update(hs->crc, p, n); break;
+        case HASH_SHA256: sha256_update(&hs->sha, p, n); break;
+        case HASH_XXH64:  xxh64_update(&hs->xxh, p, n); break;
+    }
+}
+
+// Writes lowercase hex digest into out (needs >= 65 bytes).
+static void hasher_hex(hasher_t* hs, char* out) {
+    static const char hexd[] = "0123456789abcdef";
+    uint8_t d[32];
+    int n = 0;
+    switch (hs->algo) {
+        case HASH_CRC32C: {
+            uint32_t v = hs->crc ^ 0xFFFFFFFFu;
+            for (int i = 0; i < 4; ++i) d[i] = (uint8_t)(v >> (24 - 8*i));
+            n = 4; break;
+        }
+        case HASH_SHA256: sha256_final(&hs->sha, d); n = 32; break;
+        case HASH_XXH64: {
+            uint64_t v = xxh64_final(&hs->xxh);
+            for (int i = 0; i < 8; ++i) d[i] = (uint8_t)(v >> (56 - 8*i));
+            n = 8; break;
+        }
+    }
+    for (int i = 0; i < n; ++i) { out[2*i] = hexd[d[i] >> 4]; out[2*i+1] = hexd[d[i] & 15]; }
+    out[2*n] = 0;
+}
+
+static int do_hash(void* fs_handle, const char* abs_path, const char* algo, char* hex_out, int hexlen, char* err, int errlen) {
+    if (!fs_handle || !abs_path || !hex_out || hexlen < 65) { set_err(err, errlen, "bad args"); return -1; }
+    hex_out[0] = 0;
+
+    shim_fs_t* h = (shim_fs_t*)fs_handle;
+    hasher_t hs;
+    if (hasher_init(&hs, algo)) { set_err(err, errlen, "Unknown hash algorithm (crc32c, sha256, xxh64)"); return -1; }
+
+    ext2_ino_t ino = 0;
+    if (path_to_ino(h->fs, abs_path, &ino, err, errlen)) return -1;
+
+    struct ext2_inode in; memset(&in, 0, sizeof(in));
+    if (ext2fs_read_inode(h->fs, ino, &in)) { set_err(err, errlen, "read_inode failed"); return -1; }
+    if (LINUX_S_ISDIR(in.i_mode)) { set_err(err, errlen, "Is a directory"); return -1; }
+
+    ext2_file_t f = NULL;
+    errcode_t rc = ext2fs_file_open2(h->fs, ino, &in, 0, &f);
+    if (rc) { set_err_rc(err, errlen, "file_open failed", rc); return -1; }
+
+    uint8_t* buf = (uint8_t*)malloc(HASH_BUF_SIZE);
+    if (!buf) { ext2fs_file_close(f); set_err(err, errlen, "oom"); return -1; }
+
+    uint64_t size = EXT2_I_SIZE(&in);
+    uint64_t done = 0;
+    while (done < size) {
+        unsigned int chunk = (unsigned int)MINU64(HASH_BUF_SIZE, size - done);
+        unsigned int got = 0;
+        rc = ext2fs_file_read(f, buf, chunk, &got);
+        if (rc) { free(buf); ext2fs_file_close(f); set_err_rc(err, errlen, "file_read failed", rc); return -1; }
+        if (got == 0) break;
+        hasher_update(&hs, buf, got);
+        done += got;
+    }
+    free(buf);
+    ext2fs_file_close(f);
+    // a digest of part of the file would pass for the real one
+    if (done < size) { set_err(err, errlen, "file_read stopped short of i_size"); return -1; }
+
+    hasher_hex(&hs, hex_out);
+    set_err(err, errlen, NULL);
+    return 0;
+}
+
+SHIM_API int ext4_hash(void* fs_handle, const char* abs_path, const char* algo, char* hex_out, int hexlen, char* err, int errlen) {
+    SHIM_TIMED(fs_handle, OP_HASH, do_hash(fs_handle, abs_path, algo, hex_out, hexlen, err, errlen));
+}
+
+// ------------------------ mkdirs / remove / rename ------------------------
+
+static int do_mkdirs(void* fs_handle, const char* abs_path, uint16_t mode, char* err, int errlen) {
+    if (!fs_handle || !abs_path) { set_err(err, errlen, "bad args"); return -1; }
+    shim_fs_t* h = (shim_fs_t*)fs_handle;
+    if (need_bitmaps(h, err, errlen)) return -1;
+    if (mkdirs_abs(h->fs, abs_path, mode, err, errlen)) return -1;
+    errcode_t rc = shim_commit(h);
+    if (rc) { set_err_rc(err, errlen, "flush failed", rc); return -1; }
+    set_err(err, errlen, NULL);
+    return 0;
+}
+
+SHIM_API int ext4_mkdirs(void* fs_handle, const char* abs_path, uint16_t mode, char* err, int errlen) {
+    SHIM_TIMED(fs_handle, OP_MKDIRS, do_mkdirs(fs_handle, abs_path, mode, err, errlen));
+}
+
+// Directory entries collected before mutating the directory (dir_iterate
+// callbacks must not unlink from the directory being walked).
+typedef struct {
+    char** names;
+    int count;
+    int cap;
+} name_list_t;
+
+static void name_list_free(name_list_t* nl) {
+    for (int i = 0; i < nl->count; ++i) free(nl->names[i]);
+    free(nl->names);
+    memset(nl, 0, sizeof(*nl));
+}
+
+static int collect_cb(ext2_ino_t dir, int entry, struct ext2_dir_entry *de, int offset, int blocksize, char *buf, void *priv) {
+    (void)dir; (void)offset; (void)blocksize; (void)buf;
+    name_list_t* nl = (name_list_t*)priv;
+    if (entry == DIRENT_DOT_FILE || entry == DIRENT_DOT_DOT_FILE) return 0;
+    int len = ext2fs_dirent_name_len(de);
+    if (!de->inode || len == 0) return 0;
+    if (nl->count == nl->cap) {
+        int ncap = nl->cap ? nl->cap * 2 : 32;
+        char** nn = (char**)realloc(nl->names, sizeof(char*) * (size_t)ncap);
+        if (!nn) return DIRENT_ABORT;
+        nl->names = nn; nl->cap = ncap;
+    }
+    char* name = (char*)malloc((size_t)len + 1);
+    if (!name) return DIRENT_ABORT;
+    memcpy(name, de->name, (size_t)len); name[len] = 0;
+    nl->names[nl->count++] = name;
+    return 0;
+}
+
+static int list_children(ext2_filsys fs, ext2_ino_t dir, name_list_t* nl, char* err, int errlen) {
+    memset(nl, 0, sizeof(*nl));
+    errcode_t rc = ext2fs_dir_iterate2(fs, dir, 0, NULL, collect_cb, nl);
+    if (rc) { name_list_free(nl); set_err_rc(err, errlen, "dir_iterate failed", rc); return -1; }
+    return 0;
+}
+
+// Drops one link to ino. On the last link the data blocks are punched, the
+// inode gets its dtime and is returned to the bitmap (group counters included).
+static int release_inode(ext2_filsys fs, ext2_ino_t ino, char* err, int errlen) {
+    struct ext2_inode in; memset(&in, 0, sizeof(in));
+    errcode_t rc = ext2fs_read_inode(fs, ino, &in);
+    if (rc) { set_err_rc(err, errlen, "read_inode failed", rc); return -1; }
+
+    int is_dir = LINUX_S_ISDIR(in.i_mode);
+    if (!is_dir && in.i_links_count > 1) {
+        in.i_links_count--;
+        rc = ext2fs_write_inode(fs, ino, &in);
+        if (rc) { set_err_rc(err, errlen, "write_inode failed", rc); return -1; }
+        return 0;
+    }
+
+    if (ext2fs_inode_has_valid_blocks2(fs, &in) || (in.i_flags & EXT4_INLINE_DATA_FL)) {
+        rc = ext2fs_punch(fs, ino, &in, NULL, 0, ~0ULL);
+        if (rc) { set_err_rc(err, errlen, "punch failed", rc); return -1; }
+    }
+    blk64_t acl = ext2fs_file_acl_block(fs, &in);
+    if (acl) {
+        __u32 refs = 0;
+        rc = ext2fs_adjust_ea_refcount3(fs, acl, NULL, -1, &refs, ino);
+        if (rc == 0 && refs == 0) ext2fs_block_alloc_stats2(fs, acl, -1);
+        ext2fs_file_acl_block_set(fs, &in, 0);
+    }
+    in.i_links_count = 0;
+    in.i_dtime = (uint32_t)time(NULL);
+    rc = ext2fs_write_inode(fs, ino, &in);
+    if (rc) { set_err_rc(err, errlen, "write_inode failed", rc); return -1; }
+    ext2fs_inode_alloc_stats2(fs, ino, -1, is_dir);
+    return 0;
+}
+
+// Removes pino/name. Directories must be empty unless recursive, in which
+// case the subtree is released depth-first. Nothing is flushed here.
+static int remove_entry(ext2_filsys fs, ext2_ino_t pino, const char* name, int recursive, char* err, int errlen) {
+    ext2_ino_t child = 0;
+    errcode_t rc = dir_lookup(fs, pino, name, &child);
+    if (rc || child == 0) { set_err(err, errlen, "Not found"); return -1; }
+
+    struct ext2_inode in; memset(&in, 0, sizeof(in));
+    rc = ext2fs_read_inode(fs, child, &in);
+    if (rc) { set_err_rc(err, errlen, "read_inode failed", rc); return -1; }
+
+    if (LINUX_S_ISDIR(in.i_mode)) {
+        name_list_t nl;
+        if (list_children(fs, child, &nl, err, errlen)) return -1;
+        if (nl.count && !recursive) { name_list_free(&nl); set_err(err, errlen, "Directory not empty"); return -1; }
+        for (int i = 0; i < nl.count; ++i) {
+            if (remove_entry(fs, child, nl.names[i], 1, err, errlen)) { name_list_free(&nl); return -1; }
+        }
+        name_list_free(&nl);
+
+        rc = unlink_entry(fs, pino, name, child);
+        if (rc) { set_err_rc(err, errlen, "unlink failed", rc); return -1; }
+
+        // the child's ".." held a link on the parent
+        struct ext2_inode pin; memset(&pin, 0, sizeof(pin));
+        rc = ext2fs_read_inode(fs, pino, &pin);
+        if (rc) { set_err_rc(err, errlen, "read_inode(parent) failed", rc); return -1; }
+        if (pin.i_links_count > 2) pin.i_links_count--;
+        rc = ext2fs_write_inode(fs, pino, &pin);
+        if (rc) { set_err_rc(err, errlen, "write_inode(parent) failed", rc); return -1; }
+    } else {
+        rc = unlink_entry(fs, pino, name, child);
+        if (rc) { set_err_rc(err, errlen, "unlink failed", rc); return -1; }
+    }
+    return release_inode(fs, child, err, errlen);
+}
+
+static int do_remove_path(void* fs_handle, const char* abs_path, int recursive, char* err, int errlen) {
+    if (!fs_handle || !abs_path) { set_err(err, errlen, "bad args"); return -1; }
+    shim_fs_t* h = (shim_fs_t*)fs_handle;
+    if (need_bitmaps(h, err, errlen)) return -1;
+
+    char parent[512], base[256];
+    if (lookup_parent_and_base(abs_path, parent, sizeof(parent), base, sizeof(base), err, errlen)) return -1;
+
+    ext2_ino_t pino = 0;
+    if (path_to_ino(h->fs, parent, &pino, err, errlen)) return -1;
+
+    int ret = remove_entry(h->fs, pino, base, recursive, err, errlen);
+    // commit whatever was released, even if a later entry failed
+    errcode_t rc = shim_commit(h);
+    if (ret) return -1;
+    if (rc) { set_err_rc(err, errlen, "flush failed", rc); return -1; }
+    set_err(err, errlen, NULL);
+    return 0;
+}
+
+SHIM_API int ext4_remove(void* fs_handle, const char* abs_path, char* err, int errlen) {
+    SHIM_TIMED(fs_handle, OP_REMOVE, do_remove_path(fs_handle, abs_path, 0, err, errlen));
+}
+
+SHIM_API int ext4_rmtree(void* fs_handle, const char* abs_path, char* err, int errlen) {
+    SHIM_TIMED(fs_handle, OP_RMTREE, do_remove_path(fs_handle, abs_path, 1, err, errlen));
+}
+
+#define EXT4_MOVE_REPLACE 0x1
+
+typedef struct {
+    const char* name;
+    int name_len;
+    ext2_ino_t ino;
+    int ftype;
+    int done;
+} retarget_ctx_t;
+
+// Points an existing entry (or "..") at a different inode in place.
+static int retarget_cb(ext2_ino_t dir, int entry, struct ext2_dir_entry *de, int offset, int blocksize, char *buf, void *priv) {
+    (void)dir; (void)offset; (void)blocksize; (void)buf;
+    retarget_ctx_t* ctx = (retarget_ctx_t*)priv;
+    if (!de->inode) return 0;
+    if (ctx->name) {
+        if (ext2fs_dirent_name_len(de) != ctx->name_len || memcmp(de->name, ctx->name, (size_t)ctx->name_len) != 0) return 0;
+    } else if (entry != DIRENT_DOT_DOT_FILE) {
+        return 0;
+    }
+    de->inode = ctx->ino;
+    if (ctx->ftype >= 0) ext2fs_dirent_set_file_type(de, ctx->ftype);
+    ctx->done = 1;
+    return DIRENT_CHANGED | DIRENT_ABORT;
+}
+
+static int retarget_entry(ext2_filsys fs, ext2_ino_t dir, const char* name, ext2_ino_t ino, int ftype, char* err, int errlen) {
+    struct ext2_inode din;
+    errcode_t rc = ext2fs_read_inode(fs, dir, &din);
+    if (rc) { set_err_rc(err, errlen, "read_inode failed", rc); return -1; }
+    if (name && (din.i_flags & EXT2_INDEX_FL)) {
+        dx_hit_t hit;
+        rc = dx_find(fs, dir, &din, name, (int)strlen(name), &hit);
+        if (rc) { set_err_rc(err, errlen, "Target entry vanished", rc); return -1; }
+        struct ext2_dir_entry* de = (struct ext2_dir_entry*)(hit.buf + hit.off);
+        de->inode = ino;
+        if (ext2fs_has_feature_filetype(fs->super)) ext2fs_dirent_set_file_type(de, ftype);
+        rc = ext2fs_write_dir_block4(fs, hit.pblk, hit.buf, 0, dir);
+        free(hit.buf);
+        if (rc) { set_err_rc(err, errlen, "write_dir_block failed", rc); return -1; }
+        return 0;
+    }
+
+    retarget_ctx_t ctx;
+    memset(&ctx, 0, sizeof(ctx));
+    ctx.name = name;
+    ctx.name_len = name ? (int)strlen(name) : 0;
+    ctx.ino = ino;
+    ctx.ftype = ext2fs_has_feature_filetype(fs->super) ? ftype : -1;
+    rc = ext2fs_dir_iterate2(fs, dir, 0, NULL, retarget_cb, &ctx);
+    if (rc) { set_err_rc(err, errlen, "dir_iterate failed", rc); return -1; }
+    if (!ctx.done) { set_err(err, errlen, name ? "Target entry vanished" : "Directory has no '..' entry"); return -1; }
+    return 0;
+}
+
+static int adjust_links(ext2_filsys fs, ext2_ino_t ino, int delta, char* err, int errlen) {
+    struct ext2_inode in; memset(&in, 0, sizeof(in));
+    errcode_t rc = ext2fs_read_inode(fs, ino, &in);
+    if (rc) { set_err_rc(err, errlen, "read_inode failed", rc); return -1; }
+    // links_count 1 on a directory means "too many to count" (dir_nlink); leave it
+    if (!(LINUX_S_ISDIR(in.i_mode) && in.i_links_count == 1)) in.i_links_count = (uint16_t)(in.i_links_count + delta);
+    rc = ext2fs_write_inode(fs, ino, &in);
+    if (rc) { set_err_rc(err, errlen, "write_inode failed", rc); return -1; }
+    return 0;
+}
+
+// 1 if anc is dir itself or one of its ancestors.
+static int is_ancestor(ext2_filsys fs, ext2_ino_t anc, ext2_ino_t dir) {
+    ext2_ino_t cur = dir;
+    for (int depth = 0; depth < 4096; ++depth) {
+        if (cur == anc) return 1;
+        if (cur == EXT2_ROOT_INO) return 0;
+        ext2_ino_t up = 0;
+        if (dir_lookup(fs, cur, "..", &up) || up == 0 || up == cur) return 0;
+        cur = up;
+    }
+    return 1;  // refuse on absurd depth / loops
+}
+
+// Relinks src under dst's parent as dst's basename; no data is copied.
+// With EXT4_MOVE_REPLACE an existing target (file, or empty directory) is
+// swapped in place so the name never disappears.
+static int move_entry(ext2_filsys fs, const char* src, const char* dst, int flags, char* err, int errlen) {
+    char sparent[512], sbase[256], dparent[512], dbase[256];
+    if (lookup_parent_and_base(src, sparent, sizeof(sparent), sbase, sizeof(sbase), err, errlen)) return -1;
+    if (lookup_parent_and_base(dst, dparent, sizeof(dparent), dbase, sizeof(dbase), err, errlen)) return -1;
+
+    ext2_ino_t spino = 0, dpino = 0;
+    if (path_to_ino(fs, sparent, &spino, err, errlen)) return -1;
+    if (path_to_ino(fs, dparent, &dpino, err, errlen)) return -1;
+
+    struct ext2_inode dpin; memset(&dpin, 0, sizeof(dpin));
+    errcode_t rc = ext2fs_read_inode(fs, dpino, &dpin);
+    if (rc) { set_err_rc(err, errlen, "read_inode failed", rc); return -1; }
+    if (!LINUX_S_ISDIR(dpin.i_mode)) { set_err(err, errlen, "Target parent is not a directory"); return -1; }
+
+    ext2_ino_t child = 0;
+    rc = dir_lookup(fs, spino, sbase, &child);
+    if (rc || child == 0) { set_err(err, errlen, "Not found"); return -1; }
+
+    struct ext2_inode in; memset(&in, 0, sizeof(in));
+    rc = ext2fs_read_inode(fs, child, &in);
+    if (rc) { set_err_rc(err, errlen, "read_inode failed", rc); return -1; }
+    int is_dir = LINUX_S_ISDIR(in.i_mode);
+    int ftype = mode_to_ftype(in.i_mode);
+
+    if (is_dir && is_ancestor(fs, child, dpino)) { set_err(err, errlen, "Cannot move a directory into itself"); return -1; }
+
+    ext2_ino_t existing = 0;
+    rc = dir_lookup(fs, dpino, dbase, &existing);
+    if (rc == 0 && existing == child) return 0;  // same entry (or a hard link to it)
+
+    if (rc == 0 && existing != 0) {
+        if (!(flags & EXT4_MOVE_REPLACE)) { set_err(err, errlen, "Target name already exists"); return -1; }
+        struct ext2_inode ein; memset(&ein, 0, sizeof(ein));
+        rc = ext2fs_read_inode(fs, existing, &ein);
+        if (rc) { set_err_rc(err, errlen, "read_inode failed", rc); return -1; }
+        int e_dir = LINUX_S_ISDIR(ein.i_mode);
+        if (is_dir && !e_dir) { set_err(err, errlen, "Cannot replace a non-directory with a directory"); return -1; }
+        if (!is_dir && e_dir) { set_err(err, errlen, "Cannot replace a directory with a non-directory"); return -1; }
+        if (e_dir) {
+            name_list_t nl;
+            if (list_children(fs, existing, &nl, err, errlen)) return -1;
+            int n = nl.count;
+            name_list_free(&nl);
+            if (n) { set_err(err, errlen, "Target directory not empty"); return -1; }
+        }
+        if (retarget_entry(fs, dpino, dbase, child, ftype, err, errlen)) return -1;
+        if (e_dir && adjust_links(fs, dpino, -1, err, errlen)) return -1;
+        if (release_inode(fs, existing, err, errlen)) return -1;
+    } else {
+        rc = link_entry(fs, dpino, dbase, child, ftype);
+        if (rc) { set_err_rc(err, errlen, "link(new) failed", rc); return -1; }
+    }
+
+    rc = unlink_entry(fs, spino, sbase, child);
+    if (rc) { set_err_rc(err, errlen, "unlink(old) failed", rc); return -1; }
+
+    if (is_dir && spino != dpino) {
+        if (retarget_entry(fs, child, NULL, dpino, EXT2_FT_DIR, err, errlen)) return -1;
+        if (adjust_links(fs, spino, -1, err, errlen)) return -1;
+        if (adjust_links(fs, dpino, +1, err, errlen)) return -1;
+    }
+    return 0;
+}
+
+static int do_move(void* fs_handle, const char* src_abs_path, const char* dst_abs_path, int flags, char* err, int errlen) {
+    if (!fs_handle || !src_abs_path || !dst_abs_path) { set_err(err, errlen, "bad args"); return -1; }
+    shim_fs_t* h = (shim_fs_t*)fs_handle;
+    if (need_bitmaps(h, err, errlen)) return -1;
+    if (move_entry(h->fs, src_abs_path, dst_abs_path, flags, err, errlen)) return -1;
+    errcode_t rc = shim_commit(h);
+    if (rc) { set_err_rc(err, errlen, "flush failed", rc); return -1; }
+    set_err(err, errlen, NULL);
+    return 0;
+}
+
+static int do_rename(void* fs_handle, const char* old_abs_path, const char* new_basename, char* err, int errlen) {
+    if (!fs_handle || !old_abs_path || !new_basename || new_basename[0]==0) { set_err(err, errlen, "bad args"); return -1; }
+    if (strchr(new_basename, '/')) { set_err(err, errlen, "New name must not contain '/'"); return -1; }
+
+    char parent[512], base[256], dst[1024];
+    if (lookup_parent_and_base(old_abs_path, parent, sizeof(parent), base, sizeof(base), err, errlen)) return -1;
+    snprintf(dst, sizeof(dst), "%s/%s", (strcmp(parent, "/") == 0 ? "" : parent), new_basename);
+    return do_move(fs_handle, old_abs_path, dst, 0, err, errlen);
+}
+
+SHIM_API int ext4_rename(void* fs_handle, const char* old_abs_path, const char* new_basename, char* err, int errlen) {
+    SHIM_TIMED(fs_handle, OP_RENAME, do_rename(fs_handle, old_abs_path, new_basename, err, errlen));
+}
+
+SHIM_API int ext4_move(void* fs_handle, const char* src_abs_path, const char* dst_abs_path, int flags, char* err, int errlen) {
+    SHIM_TIMED(fs_handle, OP_MOVE, do_move(fs_handle, src_abs_path, dst_abs_path, flags, err, errlen));
+}
+
+// ------------------------ copy / copytree ------------------------
+
+#define COPY_BUF_BYTES (1u << 20)
+
+// One mapped stretch of the source: lblk..lblk+len-1 at pblk (0 = read
+// through the file API, e.g. inline data). Holes are simply absent.
+typedef struct {
+    blk64_t lblk;
+    blk64_t pblk;
+    blk64_t len;
+} copy_run_t;
+
+typedef struct {
+    copy_run_t* runs;
+    int count;
+    int cap;
+    uint8_t* buf;  // COPY_BUF_BYTES, block aligned, shared by the whole tree
+    // copytree: source inode -> its copy, for inodes with several links
+    // (open addressing, link_cap is a power of two)
+    ext2_ino_t* link_src;
+    ext2_ino_t* link_dst;
+    uint32_t nlinks, link_cap;
+} copy_ctx_t;
+
+static ext2_ino_t* link_slot(copy_ctx_t* cx, ext2_ino_t sino) {
+    uint32_t i = (sino * 2654435761u) & (cx->link_cap - 1);
+    while (cx->link_src[i] && cx->link_src[i] != sino) i = (i + 1) & (cx->link_cap - 1);
+    return &cx->link_src[i];
+}
+
+// The copy of sino made earlier in this copytree, or 0.
+static ext2_ino_t link_find(copy_ctx_t* cx, ext2_ino_t sino) {
+    if (!cx->nlinks) return 0;
+    ext2_ino_t* slot = link_slot(cx, sino);
+    return *slot ? cx->link_dst[slot - cx->link_src] : 0;
+}
+
+static errcode_t link_add(copy_ctx_t* cx, ext2_ino_t sino, ext2_ino_t dino) {
+    if (2 * (cx->nlinks + 1) > cx->link_cap) {
+        copy_ctx_t grown = *cx;
+        grown.link_cap = cx->link_cap ? cx->link_cap * 2 : 64;
+        grown.link_src = (ext2_ino_t*)calloc(grown.link_cap, sizeof(ext2_ino_t));
+        grown.link_dst = (ext2_ino_t*)calloc(grown.link_cap, sizeof(ext2_ino_t));
+        if (!grown.link_src || !grown.link_dst) {
+            free(grown.link_src); free(grown.link_dst);
+            return EXT2_ET_NO_MEMORY;
+        }
+        for (uint32_t i = 0; i < cx->link_cap; ++i) {
+            if (!cx->link_src[i]) continue;
+            ext2_ino_t* slot = link_slot(&grown, cx->link_src[i]);
+            *slot = cx->link_src[i];
+            grown.link_dst[slot - grown.link_src] = cx->link_dst[i];
+        }
+        free(cx->link_src); free(cx->link_dst);
+        *cx = grown;
+    }
+    ext2_ino_t* slot = link_slot(cx, sino);
+    *slot = sino;
+    cx->link_dst[slot - cx->link_src] = dino;
+    cx->nlinks++;
+    return 0;
+}
+
+static int add_run(copy_ctx_t* cx, blk64_t lblk, blk64_t pblk, blk64_t len) {
+    if (cx->count) {
+        copy_run_t* last = &cx->runs[cx->count - 1];
+        if (last->pblk && pblk && last->lblk + last->len == lblk && last->pblk + last->len == pblk) {
+            last->len += len;
+            return 0;
+        }
+    }
+    if (cx->count == cx->cap) {
+        int ncap = cx->cap ? cx->cap * 2 : 64;
+        copy_run_t* nr = (copy_run_t*)realloc(cx->runs, sizeof(copy_run_t) * (size_t)ncap);
+        if (!nr) return -1;
+        cx->runs = nr; cx->cap = ncap;
+    }
+    cx->runs[cx->count].lblk = lblk;
+    cx->runs[cx->count].pblk = pblk;
+    cx->runs[cx->count].len = len;
+    cx->count++;
+    return 0;
+}
+
+static int run_block_cb(ext2_filsys fs, blk64_t* blocknr, e2_blkcnt_t blockcnt, blk64_t ref_blk, int ref_offset, void* priv) {
+    (void)fs; (void)ref_blk; (void)ref_offset;
+    if (blockcnt < 0 || *blocknr == 0) return 0;
+    return add_run((copy_ctx_t*)priv, (blk64_t)blockcnt, *blocknr, 1) ? BLOCK_ABORT : 0;
+}
+
+// Fills cx->runs with the allocated data runs of ino. Uninitialized extents
+// read as zeros, so they are treated as holes.
+static int collect_runs(ext2_filsys fs, ext2_ino_t ino, struct ext2_inode* in, copy_ctx_t* cx, char* err, int errlen) {
+    cx->count = 0;
+    uint64_t size = EXT2_I_SIZE(in);
+    if (size == 0) return 0;
+
+    if (in->i_flags & EXT4_INLINE_DATA_FL) {
+        blk64_t nblk = (size + fs->blocksize - 1) / fs->blocksize;
+        if (add_run(cx, 0, 0, nblk)) { set_err(err, errlen, "out of memory"); return -1; }
+        return 0;
+    }
+
+    errcode_t rc;
+    if (in->i_flags & EXT4_EXTENTS_FL) {
+        ext2_extent_handle_t eh = NULL;
+        rc = ext2fs_extent_open2(fs, ino, in, &eh);
+        if (rc) { set_err_rc(err, errlen, "extent_open failed", rc); return -1; }
+        struct ext2fs_extent ext;
+        int op = EXT2_EXTENT_ROOT;
+        for (;;) {
+            rc = ext2fs_extent_get(eh, op, &ext);
+            if (rc) break;
+            op = EXT2_EXTENT_NEXT;
+            if (!(ext.e_flags & EXT2_EXTENT_FLAGS_LEAF) || (ext.e_flags & EXT2_EXTENT_FLAGS_SECOND_VISIT)) continue;
+            if ((ext.e_flags & EXT2_EXTENT_FLAGS_UNINIT) || ext.e_len == 0) continue;
+            if (add_run(cx, ext.e_lblk, ext.e_pblk, ext.e_len)) { rc = EXT2_ET_NO_MEMORY; break; }
+        }
+        ext2fs_extent_free(eh);
+        if (rc && rc != EXT2_ET_EXTENT_NO_NEXT) { set_err_rc(err, errlen, "extent walk failed", rc); return -1; }
+        return 0;
+    }
+
+    rc = ext2fs_block_iterate3(fs, ino, BLOCK_FLAG_READ_ONLY | BLOCK_FLAG_DATA_ONLY, NULL, run_block_cb, cx);
+    if (rc) { set_err_rc(err, errlen, "block_iterate failed", rc); return -1; }
+    return 0;
+}
+
+// Copies the data runs of sino into the freshly created dino. Source runs are
+// read straight off the device in COPY_BUF_BYTES requests; the destination is
+// preallocated run by run (extent files) so writes land in contiguous space.
+static int copy_data(ext2_filsys fs, ext2_ino_t sino, struct ext2_inode* sin, ext2_ino_t dino, copy_ctx_t* cx, char* err, int errlen) {
+    uint64_t size = EXT2_I_SIZE(sin);
+    unsigned bs = fs->blocksize;
+
+    struct ext2_inode din; memset(&din, 0, sizeof(din));
+    errcode_t rc = ext2fs_read_inode(fs, dino, &din);
+    if (rc) { set_err_rc(err, errlen, "read_inode failed", rc); return -1; }
+
+    if (ext2fs_has_feature_inline_data(fs->super) && size && size <= EXT2_INODE_SIZE(fs->super)) {
+        // small enough that the copy may fit in its inode, as write does
+        ext2_file_t sf = NULL;
+        unsigned int got = 0, have = 0;
+        rc = ext2fs_file_open2(fs, sino, sin, 0, &sf);
+        while (!rc && have < size) {
+            rc = ext2fs_file_read(sf, cx->buf + have, (unsigned int)size - have, &got);
+            if (!rc && got == 0) break;
+            have += got;
+        }
+        if (sf) ext2fs_file_close(sf);
+        if (rc) { set_err_rc(err, errlen, "file_read failed", rc); return -1; }
+        if (have < size) memset(cx->buf + have, 0, (size_t)(size - have));
+        int stored = write_inline(fs, dino, &din, cx->buf, size, err, errlen);
+        if (stored) return stored < 0 ? -1 : 0;
+    }
+
+    if (collect_runs(fs, sino, sin, cx, err, errlen)) return -1;
+    if (din.i_flags & EXT4_EXTENTS_FL) {
+        for (int i = 0; i < cx->count; ++i) {
+            rc = ext2fs_fallocate(fs, EXT2_FALLOCATE_FORCE_INIT, dino, &din, ~0ULL, cx->runs[i].lblk, cx->runs[i].len);
+            if (rc) { set_err_rc(err, errlen, "fallocate failed", rc); return -1; }
+        }
+        rc = ext2fs_write_inode(fs, dino, &din);
+        if (rc) { set_err_rc(err, errlen, "write_inode failed", rc); return -1; }
+    }
+
+    ext2_file_t sf = NULL, df = NULL;
+    rc = ext2fs_file_open2(fs, dino, &din, EXT2_FILE_WRITE, &df);
+    if (rc) { set_err_rc(err, errlen, "file_open(write) failed", rc); return -1; }
+
+    int ret = -1;
+    for (int i = 0; i < cx->count; ++i) {
+        copy_run_t* r = &cx->runs[i];
+        uint64_t off = r->lblk * bs;
+        uint64_t end = MINU64(off + r->len * bs, size);
+        if (!r->pblk && !sf) {
+            rc = ext2fs_file_open2(fs, sino, sin, 0, &sf);
+            if (rc) { set_err_rc(err, errlen, "file_open failed", rc); goto out; }
+        }
+        rc = ext2fs_file_llseek(df, off, EXT2_SEEK_SET, NULL);
+        if (rc) { set_err_rc(err, errlen, "llseek failed", rc); goto out; }
+        while (off < end) {
+            unsigned int n = (unsigned int)MINU64(COPY_BUF_BYTES, end - off);
+            if (r->pblk) {
+                blk64_t blk = r->pblk + (off / bs - r->lblk);
+                rc = io_channel_read_blk64(fs->io, blk, (int)((n + bs - 1) / bs), cx->buf);
+                if (rc) { set_err_rc(err, errlen, "read_blk failed", rc); goto out; }
+            } else {
+                unsigned int got = 0, have = 0;
+                rc = ext2fs_file_llseek(sf, off, EXT2_SEEK_SET, NULL);
+                while (!rc && have < n) {
+                    rc = ext2fs_file_read(sf, cx->buf + have, n - have, &got);
+                    if (!rc && got == 0) break;
+                    have += got;
+                }
+                if (rc) { set_err_rc(err, errlen, "file_read failed", rc); goto out; }
+                if (have < n) memset(cx->buf + have, 0, n - have);
+            }
+            // the extents were allocated above and the new inode is already
+            // captured, so only data blocks are written here
+            unsigned int done = 0, wrote = 0;
+            if (din.i_flags & EXT4_EXTENTS_FL) data_in_place(fs, 1);
+            while (done < n) {
+                rc = ext2fs_file_write(df, cx->buf + done, n - done, &wrote);
+                if (rc || wrote == 0) break;
+                done += wrote;
+            }
+            if (din.i_flags & EXT4_EXTENTS_FL) data_in_place(fs, 0);
+            if (rc) { set_err_rc(err, errlen, "file_write failed", rc); goto out; }
+            off += n;
+        }
+    }
+    rc = ext2fs_file_set_size2(df, size);
+    if (rc) { set_err_rc(err, errlen, "set_size failed", rc); goto out; }
+    ret = 0;
+out:
+    if (sf) ext2fs_file_close(sf);
+    rc = ext2fs_file_close(df);
+    if (rc && ret == 0) { set_err_rc(err, errlen, "file_close failed", rc); ret = -1; }
+    return ret;
+}
+
+static int copy_xattr_cb(char* name, char* value, size_t value_len, void* data) {
+    // inline file data; copy_data has already stored the copy's own
+    if (!strcmp(name, "system.data")) return 0;
+    return ext2fs_xattr_set((struct ext2_xattr_handle*)data, name, value, value_len) ? XATTR_ABORT : 0;
+}
+
+static int copy_xattrs(ext2_filsys fs, ext2_ino_t sino, ext2_ino_t dino, char* err, int errlen) {
+    if (!ext2fs_has_feature_xattr(fs->super)) return 0;
+    struct ext2_xattr_handle *sh = NULL, *dh = NULL;
+    errcode_t rc = ext2fs_xattrs_open(fs, sino, &sh);
+    if (rc == EXT2_ET_MISSING_EA_FEATURE) return 0;
+    if (!rc) rc = ext2fs_xattrs_read(sh);
+    if (!rc) rc = ext2fs_xattrs_open(fs, dino, &dh);
+    if (!rc) rc = ext2fs_xattrs_iterate(sh, copy_xattr_cb, dh);
+    if (dh) {
+        errcode_t rc2 = ext2fs_xattrs_close(&dh);  // writes the attributes out
+        if (!rc) rc = rc2;
+    }
+    if (sh) ext2fs_xattrs_close(&sh);
+    if (rc) { set_err_rc(err, errlen, "xattr copy failed", rc); return -1; }
+    return 0;
+}
+
+// Mode, owner and atime/mtime follow the source; ctime is the copy time.
+static int copy_attrs(ext2_filsys fs, const struct ext2_inode* sin, ext2_ino_t dino, char* err, int errlen) {
+    struct ext2_inode din; memset(&din, 0, sizeof(din));
+    errcode_t rc = ext2fs_read_inode(fs, dino, &din);
+    if (rc) { set_err_rc(err, errlen, "read_inode failed", rc); return -1; }
+    din.i_mode = sin->i_mode;
+    din.i_uid = sin->i_uid;
+    din.i_gid = sin->i_gid;
+    din.osd2.linux2.l_i_uid_high = sin->osd2.linux2.l_i_uid_high;
+    din.osd2.linux2.l_i_gid_high = sin->osd2.linux2.l_i_gid_high;
+    din.i_atime = sin->i_atime;
+    din.i_mtime = sin->i_mtime;
+    din.i_ctime = (uint32_t)time(NULL);
+    rc = ext2fs_write_inode(fs, dino, &din);
+    if (rc) { set_err_rc(err, errlen, "write_inode failed", rc); return -1; }
+    return 0;
+}
+
+static int copy_symlink(ext2_filsys fs, ext2_ino_t sino, struct ext2_inode* sin, ext2_ino_t dpino, const char* dname, ext2_ino_t* out_ino, char* err, int errlen) {
+    char target[4096];
+    uint64_t len = EXT2_I_SIZE(sin);
+    if (len == 0 || len >= sizeof(target)) { set_err(err, errlen, "Unsupported symlink length"); return -1; }
+    errcode_t rc;
+    if (ext2fs_is_fast_symlink(sin)) {
+        memcpy(target, (const char*)sin->i_block, (size_t)len);
+    } else {
+        ext2_file_t f = NULL;
+        unsigned int got = 0;
+        rc = ext2fs_file_open2(fs, sino, sin, 0, &f);
+        if (rc) { set_err_rc(err, errlen, "file_open failed", rc); return -1; }
+        rc = ext2fs_file_read(f, target, (unsigned int)len, &got);
+        ext2fs_file_close(f);
+        if (rc || got != len) { set_err_rc(err, errlen, "symlink read failed", rc); return -1; }
+    }
+    target[len] = 0;
+    ext2_ino_t ino = 0;
+    rc = ext2fs_new_inode(fs, dpino, LINUX_S_IFLNK | 0777, 0, &ino);
+    if (!rc) rc = ext2fs_symlink(fs, dpino, ino, NULL, target);
+    if (rc) { set_err_rc(err, errlen, "symlink failed", rc); return -1; }
+    rc = link_entry(fs, dpino, dname, ino, EXT2_FT_SYMLINK);
+    if (rc) { set_err_rc(err, errlen, "link failed", rc); return -1; }
+    *out_ino = ino;
+    return 0;
+}
+
+// Copies sino as dpino/dname; directories are copied depth-first. Within one
+// copytree, further links to an inode already copied link to that copy.
+// Nothing is flushed here.
+static int copy_node(ext2_filsys fs, ext2_ino_t sino, ext2_ino_t dpino, const char* dname, copy_ctx_t* cx, char* err, int errlen) {
+    struct ext2_inode sin; memset(&sin, 0, sizeof(sin));
+    errcode_t rc = ext2fs_read_inode(fs, sino, &sin);
+    if (rc) { set_err_rc(err, errlen, "read_inode failed", rc); return -1; }
+
+    int multi = !LINUX_S_ISDIR(sin.i_mode) && sin.i_links_count > 1;
+    ext2_ino_t dino = multi ? link_find(cx, sino) : 0;
+    if (dino) {
+        struct ext2_inode din; memset(&din, 0, sizeof(din));
+        rc = link_entry(fs, dpino, dname, dino, mode_to_ftype(sin.i_mode));
+        if (rc) { set_err_rc(err, errlen, "link failed", rc); return -1; }
+        rc = ext2fs_read_inode(fs, dino, &din);
+        if (!rc) {
+            din.i_links_count++;
+            rc = ext2fs_write_inode(fs, dino, &din);
+        }
+        if (rc) { set_err_rc(err, errlen, "write_inode failed", rc); return -1; }
+        return 0;
+    }
+
+    if (LINUX_S_ISDIR(sin.i_mode)) {
+        rc = make_dir(fs, dpino, dname, &dino);
+        if (rc) { set_err_rc(err, errlen, "mkdir failed", rc); return -1; }
+
+        name_list_t nl;
+        if (list_children(fs, sino, &nl, err, errlen)) return -1;
+        for (int i = 0; i < nl.count; ++i) {
+            ext2_ino_t child = 0;
+            rc = dir_lookup(fs, sino, nl.names[i], &child);
+            if (rc || child == 0) { name_list_free(&nl); set_err(err, errlen, "Source entry vanished"); return -1; }
+            if (copy_node(fs, child, dino, nl.names[i], cx, err, errlen)) { name_list_free(&nl); return -1; }
+        }
+        name_list_free(&nl);
+    } else if (LINUX_S_ISLNK(sin.i_mode)) {
+        if (copy_symlink(fs, sino, &sin, dpino, dname, &dino, err, errlen)) return -1;
+    } else {
+        if (create_inode(fs, dpino, dname, sin.i_mode, &dino, err, errlen)) return -1;
+        if (LINUX_S_ISREG(sin.i_mode)) {
+            if (copy_data(fs, sino, &sin, dino, cx, err, errlen)) return -1;
+        } else {
+            // device numbers live in i_block
+            struct ext2_inode din; memset(&din, 0, sizeof(din));
+            rc = ext2fs_read_inode(fs, dino, &din);
+            if (!rc) {
+                memcpy(din.i_block, sin.i_block, sizeof(din.i_block));
+                rc = ext2fs_write_inode(fs, dino, &din);
+            }
+            if (rc) { set_err_rc(err, errlen, "write_inode failed", rc); return -1; }
+        }
+    }
+
+    if (multi && (rc = link_add(cx, sino, dino))) { set_err_rc(err, errlen, "link map failed", rc); return -1; }
+    if (copy_attrs(fs, &sin, dino, err, errlen)) return -1;
+    return copy_xattrs(fs, sino, dino, err, errlen);
+}
+
+static int do_copy(void* fs_handle, const char* src_abs_path, const char* dst_abs_path, int recursive, char* err, int errlen) {
+    if (!fs_handle || !src_abs_path || !dst_abs_path) { set_err(err, errlen, "bad args"); return -1; }
+    shim_fs_t* h = (shim_fs_t*)fs_handle;
+    ext2_filsys fs = h->fs;
+    if (need_bitmaps(h, err, errlen)) return -1;
+
+    ext2_ino_t sino = 0;
+    if (path_to_ino(fs, src_abs_path, &sino, err, errlen)) return -1;
+    struct ext2_inode sin; memset(&sin, 0, sizeof(sin));
+    errcode_t rc = ext2fs_read_inode(fs, sino, &sin);
+    if (rc) { set_err_rc(err, errlen, "read_inode failed", rc); return -1; }
+    if (LINUX_S_ISDIR(sin.i_mode) && !recursive) { set_err(err, errlen, "Is a directory"); return -1; }
+
+    char parent[512], base[256];
+    if (lookup_parent_and_base(dst_abs_path, parent, sizeof(parent), base, sizeof(base), err, errlen)) return -1;
+    if (mkdirs_abs(fs, parent, 0755, err, errlen)) return -1;
+    ext2_ino_t dpino = 0;
+    if (path_to_ino(fs, parent, &dpino, err, errlen)) return -1;
+
+    ext2_ino_t existing = 0;
+    if (dir_lookup(fs, dpino, base, &existing) == 0 && existing) { set_err(err, errlen, "Target name already exists"); return -1; }
+    if (LINUX_S_ISDIR(sin.i_mode) && is_ancestor(fs, sino, dpino)) { set_err(err, errlen, "Cannot copy a directory into itself"); return -1; }
+
+    copy_ctx_t cx; memset(&cx, 0, sizeof(cx));
+    rc = ext2fs_get_memalign(COPY_BUF_BYTES, fs->blocksize, &cx.buf);
+    if (rc) { set_err_rc(err, errlen, "buffer allocation failed", rc); return -1; }
+
+    int ret = copy_node(fs, sino, dpino, base, &cx, err, errlen);
+    ext2fs_free_mem(&cx.buf);
+    free(cx.runs);
+    free(cx.link_src);
+    free(cx.link_dst);
+    // one commit for the whole tree, including a partial one on failure
+    rc = shim_commit(h);
+    if (ret) return -1;
+    if (rc) { set_err_rc(err, errlen, "flush failed", rc); return -1; }
+    set_err(err, errlen, NULL);
+    return 0;
+}
+
+SHIM_API int ext4_copy(void* fs_handle, const char* src_abs_path, const char* dst_abs_path, char* err, int errlen) {
+    SHIM_TIMED(fs_handle, OP_COPY, do_copy(fs_handle, src_abs_path, dst_abs_path, 0, err, errlen));
+}
+
+SHIM_API int ext4_copytree(void* fs_handle, const char* src_abs_path, const char* dst_abs_path, char* err, int errlen) {
+    SHIM_TIMED(fs_handle, OP_COPYTREE, do_copy(fs_handle, src_abs_path, dst_abs_path, 1, err, errlen));
+}
+
+// ------------------------ batched submit ------------------------
+// Runs many small mutations from one packed buffer in a single call, with one
+// flush at the end. Each record is
+//   u32 op, u32 mode, u32 path_len, u32 arg_len, path bytes, arg bytes
+// padded to a multiple of 8. arg is the payload for WRITE and APPEND, the new
+// basename for RENAME, the destination path for MOVE and u32 uid, gid, mtime
+// for SETATTR; paths are not NUL-terminated.
+// status[i] is 0 on success, -1 on failure and 1 when skipped after an
+// earlier failure under EXT4_SUBMIT_STOP. Returns the number of failed ops
+// (err holds the first failure); -1 if the batch itself is malformed, which
+// is checked before any op runs; or EXT4_SUBMIT_FLUSH_FAILED when the ops
+// ran (status is filled in) but the final commit failed.
+
+enum {
+    SUBMIT_MKDIRS = 1, SUBMIT_WRITE = 2, SUBMIT_REMOVE = 3, SUBMIT_RMTREE = 4,
+    SUBMIT_RENAME = 5, SUBMIT_MOVE = 6, SUBMIT_CHMOD = 7, SUBMIT_APPEND = 8,
+    SUBMIT_SETATTR = 9
+};
+#define EXT4_SUBMIT_STOP 0x1
+#define EXT4_SUBMIT_FLUSH_FAILED (-2)
+
+static int chmod_path(ext2_filsys fs, const char* abs_path, uint16_t mode, char* err, int errlen) {
+    ext2_ino_t ino = 0;
+    if (path_to_ino(fs, abs_path, &ino, err, errlen)) return -1;
+    struct ext2_inode in; memset(&in, 0, sizeof(in));
+    errcode_t rc = ext2fs_read_inode(fs, ino, &in);
+    if (rc) { set_err_rc(err, errlen, "read_inode failed", rc); return -1; }
+    in.i_mode = (in.i_mode & ~07777) | (mode & 07777);
+    in.i_ctime = (uint32_t)time(NULL);
+    rc = ext2fs_write_inode(fs, ino, &in);
+    if (rc) { set_err_rc(err, errlen, "write_inode failed", rc); return -1; }
+    return 0;
+}
+
+// Sets permission bits, owner and mtime (atime follows mtime) in one write.
+static int setattr_path(ext2_filsys fs, const char* abs_path, uint16_t mode, uint32_t uid, uint32_t gid,
+                        uint32_t mtime, char* err, int errlen) {
+    ext2_ino_t ino = 0;
+    if (path_to_ino(fs, abs_path, &ino, err, errlen)) return -1;
+    struct ext2_inode in; memset(&in, 0, sizeof(in));
+    errcode_t rc = ext2fs_read_inode(fs, ino, &in);
+    if (rc) { set_err_rc(err, errlen, "read_inode failed", rc); return -1; }
+    in.i_mode = (in.i_mode & ~07777) | (mode & 07777);
+    in.i_uid = (uint16_t)uid;
+    in.osd2.linux2.l_i_uid_high = (uint16_t)(uid >> 16);
+    in.i_gid = (uint16_t)gid;
+    in.osd2.linux2.l_i_gid_high = (uint16_t)(gid >> 16);
+    in.i_atime = in.i_mtime = mtime;
+    in.i_ctime = (uint32_t)time(NULL);
+    rc = ext2fs_write_inode(fs, ino, &in);
+    if (rc) { set_err_rc(err, errlen, "write_inode failed", rc); return -1; }
+    return 0;
+}
+
+// Appends size bytes at EOF of an existing regular file, so a stream can be
+// written in chunks without holding the whole file. Times are left alone.
+static int append_path(ext2_filsys fs, const char* abs_path, const uint8_t* data, uint64_t size, char* err, int errlen) {
+    ext2_ino_t ino = 0;
+    if (path_to_ino(fs, abs_path, &ino, err, errlen)) return -1;
     struct ext2_inode in; memset(&in, 0, sizeof(in));
-    if (ext2fs_read_inode(h->fs, ino, &in)) { set_err(err, errlen, "read_inode failed"); return -1; }
+    errcode_t rc = ext2fs_read_inode(fs, ino, &in);
+    if (rc) { set_err_rc(err, errlen, "read_inode failed", rc); return -1; }
+    if (!LINUX_S_ISREG(in.i_mode)) { set_err(err, errlen, "Not a regular file"); return -1; }
+    uint64_t old = EXT2_I_SIZE(&in);
+    if (!size) return 0;
+
+    if (in.i_flags & EXT4_INLINE_DATA_FL) {
+        // the file API cannot write at an offset into inline data; rewrite the
+        // (small) file whole, which moves it to blocks once it no longer fits
+        // inline_data_get always copies all 60 bytes of i_block
+        uint8_t* all = (uint8_t*)malloc((size_t)(old + size) + EXT4_MIN_INLINE_DATA_SIZE);
+        if (!all) { set_err(err, errlen, "out of memory"); return -1; }
+        size_t got = 0;
+        rc = ext2fs_inline_data_get(fs, ino, &in, all, &got);
+        if (rc) { free(all); set_err_rc(err, errlen, "inline_data_get failed", rc); return -1; }
+        memcpy(all + old, data, (size_t)size);
+        int ret = write_file_data(fs, ino, &in, all, old + size, err, errlen);
+        free(all);
+        return ret;
+    }
+
+    if ((in.i_flags & EXT4_EXTENTS_FL) && !(in.i_flags & EXT4_INLINE_DATA_FL)) {
+        // only the blocks past the current last one are new; extent_rw
+        // read-modify-writes the partly used block at the old EOF
+        unsigned bs = fs->blocksize;
+        blk64_t first = (old + bs - 1) / bs, last = (old + size + bs - 1) / bs;
+        if (last > first) {
+            rc = ext2fs_fallocate(fs, EXT2_FALLOCATE_FORCE_INIT, ino, &in, ~0ULL, first, last - first);
+            if (rc) { set_err_rc(err, errlen, "fallocate failed", rc); return -1; }
+        }
+        rc = extent_rw(fs, ino, &in, old, (uint8_t*)data, size, 1);
+        if (rc) { set_err_rc(err, errlen, "write failed", rc); return -1; }
+        rc = ext2fs_inode_size_set(fs, &in, old + size);
+        if (!rc) rc = ext2fs_write_inode(fs, ino, &in);
+        if (rc) { set_err_rc(err, errlen, "write_inode failed", rc); return -1; }
+        return 0;
+    }
 
     ext2_file_t f = NULL;
-    errcode_t rc = ext2fs_file_open2(h->fs, ino, &in, 0, &f);
+    rc = ext2fs_file_open2(fs, ino, &in, EXT2_FILE_WRITE, &f);
     if (rc) { set_err_rc(err, errlen, "file_open(write) failed", rc); return -1; }
-
+    rc = ext2fs_file_llseek(f, old, EXT2_SEEK_SET, NULL);
     uint64_t done = 0;
-    while (done < size) {
+    while (!rc && done < size) {
         unsigned int chunk = (unsigned int)MIN(64*1024ULL, size - done);
         unsigned int wrote = 0;
         rc = ext2fs_file_write(f, (void*)(data + done), chunk, &wrote);
-        if (rc) { ext2fs_file_close(f); set_err_rc(err, errlen, "file_write failed", rc); return -1; }
-        if (wrote == 0) break;
+        if (!rc && wrote == 0) break;
         done += wrote;
     }
-    rc = ext2fs_file_set_size2(f, size);
+    if (!rc) rc = ext2fs_file_set_size2(f, old + done);
     ext2fs_file_close(f);
-    if (rc) { set_err_rc(err, errlen, "set_size(final) failed", rc); return -1; }
-
-    ext2fs_mark_super_dirty(h->fs);
-    ext2fs_flush(h->fs);
-    set_err(err, errlen, NULL);
+    if (rc) { set_err_rc(err, errlen, "file_write failed", rc); return -1; }
     return 0;
 }
 
-// ------------------------ mkdirs / remove / rename ------------------------
+static int submit_one(shim_fs_t* h, uint32_t op, uint16_t mode, const char* path,
+                      const uint8_t* arg, uint32_t arg_len, char* err, int errlen) {
+    char name[1024];
+    errcode_t rc;
+    switch (op) {
+    case SUBMIT_MKDIRS:
+        return do_mkdirs(h, path, mode, err, errlen);
+    case SUBMIT_WRITE:
+        return do_write_overwrite(h, path, arg_len ? arg : (const uint8_t*)"", arg_len, mode, err, errlen);
+    case SUBMIT_REMOVE:
+    case SUBMIT_RMTREE:
+        return do_remove_path(h, path, op == SUBMIT_RMTREE, err, errlen);
+    case SUBMIT_RENAME:
+    case SUBMIT_MOVE:
+        if (arg_len >= sizeof(name)) { set_err(err, errlen, "path too long"); return -1; }
+        memcpy(name, arg, arg_len); name[arg_len] = 0;
+        return op == SUBMIT_RENAME ? do_rename(h, path, name, err, errlen)
+                                   : do_move(h, path, name, 0, err, errlen);
+    case SUBMIT_CHMOD:
+        if (need_bitmaps(h, err, errlen)) return -1;
+        if (chmod_path(h->fs, path, mode, err, errlen)) return -1;
+        if ((rc = shim_commit(h))) { set_err_rc(err, errlen, "flush failed", rc); return -1; }
+        set_err(err, errlen, NULL);
+        return 0;
+    case SUBMIT_APPEND:
+        if (need_bitmaps(h, err, errlen)) return -1;
+        if (append_path(h->fs, path, arg, arg_len, err, errlen)) return -1;
+        if ((rc = shim_commit(h))) { set_err_rc(err, errlen, "flush failed", rc); return -1; }
+        set_err(err, errlen, NULL);
+        return 0;
+    case SUBMIT_SETATTR: {
+        uint32_t ids[3];
+        if (arg_len != sizeof(ids)) { set_err(err, errlen, "bad setattr args"); return -1; }
+        memcpy(ids, arg, sizeof(ids));
+        if (need_bitmaps(h, err, errlen)) return -1;
+        if (setattr_path(h->fs, path, mode, ids[0], ids[1], ids[2], err, errlen)) return -1;
+        if ((rc = shim_commit(h))) { set_err_rc(err, errlen, "flush failed", rc); return -1; }
+        set_err(err, errlen, NULL);
+        return 0;
+    }
+    default:
+        set_err(err, errlen, "unknown op");
+        return -1;
+    }
+}
 
-SHIM_API int ext4_mkdirs(void* fs_handle, const char* abs_path, uint16_t mode, char* err, int errlen) {
-    if (!fs_handle || !abs_path) { set_err(err, errlen, "bad args"); return -1; }
+static int do_submit(void* fs_handle, const uint8_t* ops, uint64_t ops_len, uint32_t count,
+                     int32_t* status, uint32_t flags, char* err, int errlen) {
+    if (!fs_handle || (!ops && count) || (!status && count)) { set_err(err, errlen, "bad args"); return -1; }
     shim_fs_t* h = (shim_fs_t*)fs_handle;
-    if (mkdirs_abs(h->fs, abs_path, mode, err, errlen)) return -1;
-    ext2fs_mark_super_dirty(h->fs);
-    ext2fs_flush(h->fs);
+    char path[1024], operr[512];
+    uint64_t off = 0;
+    int failed = 0;
+
+    // every record is checked before the first op runs, so a bad one cannot
+    // leave the batch half applied
+    for (uint32_t i = 0; i < count; i++) {
+        uint32_t hdr[4];
+        status[i] = 1;
+        if (ops_len - off < sizeof(hdr)) { set_err(err, errlen, "truncated batch"); return -1; }
+        memcpy(hdr, ops + off, sizeof(hdr));
+        uint64_t rec = (sizeof(hdr) + (uint64_t)hdr[2] + hdr[3] + 7) & ~7ULL;
+        if (rec > ops_len - off || hdr[2] >= sizeof(path)) {
+            snprintf(err, errlen, "malformed batch record %u", i);
+            return -1;
+        }
+        off += rec;
+    }
+
     set_err(err, errlen, NULL);
-    return 0;
+    off = 0;
+    h->in_batch = 1;
+    for (uint32_t i = 0; i < count; i++) {
+        uint32_t hdr[4];
+        memcpy(hdr, ops + off, sizeof(hdr));
+        uint64_t rec = (sizeof(hdr) + (uint64_t)hdr[2] + hdr[3] + 7) & ~7ULL;
+        if (failed && (flags & EXT4_SUBMIT_STOP)) { status[i] = 1; off += rec; continue; }
+        memcpy(path, ops + off + sizeof(hdr), hdr[2]);
+        path[hdr[2]] = 0;
+        status[i] = submit_one(h, hdr[0], (uint16_t)hdr[1], path,
+                               ops + off + sizeof(hdr) + hdr[2], hdr[3], operr, sizeof(operr));
+        if (status[i] && !failed++)
+            snprintf(err, errlen, "op %u (%s): %s", i, path, operr);
+        off += rec;
+    }
+    h->in_batch = 0;
+    // one flush for everything that went through, failures included
+    if (h->fs->flags & EXT2_FLAG_DIRTY) {
+        errcode_t rc = shim_commit(h);
+        if (rc) { set_err_rc(err, errlen, "flush failed", rc); return EXT4_SUBMIT_FLUSH_FAILED; }
+    }
+    return failed;
 }
 
-SHIM_API int ext4_remove(void* fs_handle, const char* abs_path, char* err, int errlen) {
-    if (!fs_handle || !abs_path) { set_err(err, errlen, "bad args"); return -1; }
+SHIM_API int ext4_submit(void* fs_handle, const uint8_t* ops, uint64_t ops_len, uint32_t count,
+                         int32_t* status, uint32_t flags, char* err, int errlen) {
+    SHIM_TIMED(fs_handle, OP_SUBMIT, do_submit(fs_handle, ops, ops_len, count, status, flags, err, errlen));
+}
+
+// ------------------------ inode table scan ------------------------
+// Reads the inode tables group by group in on-disk order, without any path
+// lookups, into caller-provided columns. Groups with no inodes in use are
+// skipped without touching their table, and a group is left as soon as all of
+// its in-use inodes (per the group descriptor) have been seen.
+//
+// cols holds cap entries of each column back to back, in this order:
+//   u64 size, blocks (512-byte units)
+//   u32 ino, mode, uid, gid, links, flags, atime, mtime, ctime
+// *cursor is 0 to start at group_start, otherwise the inode to resume from; on
+// return it is the next inode to scan, or 0 once [group_start, group_end) is
+// done. *out_groups always receives the block group count. Reserved inodes
+// other than the root are not reported.
+
+// Stores inode ino as row n of cap-entry columns laid out as above.
+static void put_inode_row(ext2_filsys fs, void* cols, uint32_t cap, uint32_t n, ext2_ino_t ino, struct ext2_inode* in) {
+    uint64_t* c_size = (uint64_t*)cols;
+    uint64_t* c_blocks = c_size + cap;
+    uint32_t* c_ino = (uint32_t*)(c_blocks + cap);
+    uint32_t* c_mode = c_ino + cap;
+    uint32_t* c_uid = c_mode + cap;
+    uint32_t* c_gid = c_uid + cap;
+    uint32_t* c_links = c_gid + cap;
+    uint32_t* c_flags = c_links + cap;
+    uint32_t* c_atime = c_flags + cap;
+    uint32_t* c_mtime = c_atime + cap;
+    uint32_t* c_ctime = c_mtime + cap;
+    c_size[n] = EXT2_I_SIZE(in);
+    c_blocks[n] = ext2fs_get_stat_i_blocks(fs, in);
+    c_ino[n] = ino;
+    c_mode[n] = in->i_mode;
+    c_uid[n] = in->i_uid | ((uint32_t)in->osd2.linux2.l_i_uid_high << 16);
+    c_gid[n] = in->i_gid | ((uint32_t)in->osd2.linux2.l_i_gid_high << 16);
+    c_links[n] = in->i_links_count;
+    c_flags[n] = in->i_flags;
+    c_atime[n] = in->i_atime;
+    c_mtime[n] = in->i_mtime;
+    c_ctime[n] = in->i_ctime;
+}
+
+static int do_scan_inodes(void* fs_handle, uint32_t group_start, uint32_t group_end, uint32_t* cursor,
+                          void* cols, uint32_t cap, uint32_t* out_count, uint32_t* out_groups, char* err, int errlen) {
+    if (!fs_handle || !cursor || !out_count || !out_groups || (cap && !cols)) { set_err(err, errlen, "bad args"); return -1; }
     shim_fs_t* h = (shim_fs_t*)fs_handle;
+    ext2_filsys fs = h->fs;
+    uint32_t ipg = fs->super->s_inodes_per_group;
+    *out_count = 0;
+    *out_groups = fs->group_desc_count;
+    if (group_end > fs->group_desc_count) group_end = fs->group_desc_count;
+    ext2_ino_t next = *cursor ? *cursor : (ext2_ino_t)group_start * ipg + 1;
+    *cursor = 0;
+    if (group_start >= group_end || next > (ext2_ino_t)group_end * ipg) { set_err(err, errlen, NULL); return 0; }
+    if (!cap) { set_err(err, errlen, "batch capacity is zero"); return -1; }
 
-    char parent[512], base[256];
-    if (lookup_parent_and_base(abs_path, parent, sizeof(parent), base, sizeof(base), err, errlen)) return -1;
+    errcode_t rc = 0;
+    if (!fs->inode_map && (rc = ext2fs_read_inode_bitmap(fs))) {
+        set_err_rc(err, errlen, "read_inode_bitmap failed", rc); return -1;
+    }
+    ext2_inode_scan scan = NULL;
+    rc = ext2fs_open_inode_scan(fs, (int)MIN(fs->inode_blocks_per_group, 1024u), &scan);
+    if (rc) { set_err_rc(err, errlen, "open_inode_scan failed", rc); return -1; }
+    ext2fs_inode_scan_flags(scan, EXT2_SF_SKIP_MISSING_ITABLE | EXT2_SF_DO_LAZY, 0);
 
-    ext2_ino_t pino = 0;
-    if (path_to_ino(h->fs, parent, &pino, err, errlen)) return -1;
+    uint32_t n = 0;
+    ext2_ino_t resume = 0;
+    for (dgrp_t g = (next - 1) / ipg; g < group_end && !resume && !rc; ++g) {
+        uint32_t used = ipg - ext2fs_bg_free_inodes_count(fs, g);
+        if (!used || ext2fs_bg_flags_test(fs, g, EXT2_BG_INODE_UNINIT)) continue;
+        rc = ext2fs_inode_scan_goto_blockgroup(scan, (int)g);
+        for (uint32_t seen = 0; !rc && seen < used; ) {
+            ext2_ino_t ino = 0;
+            struct ext2_inode in;
+            rc = ext2fs_get_next_inode_full(scan, &ino, &in, (int)sizeof(in));
+            if (rc || ino == 0 || ino > (ext2_ino_t)(g + 1) * ipg) break;
+            if (!ext2fs_test_inode_bitmap2(fs->inode_map, ino)) continue;
+            seen++;
+            if (ino < next) continue;
+            if (ino < EXT2_FIRST_INODE(fs->super) && ino != EXT2_ROOT_INO) continue;
+            if (n == cap) { resume = ino; break; }
+            put_inode_row(fs, cols, cap, n++, ino, &in);
+        }
+    }
+    ext2fs_close_inode_scan(scan);
+    if (rc) { set_err_rc(err, errlen, "inode scan failed", rc); return -1; }
 
-    ext2_ino_t child = 0;
-    errcode_t rc = ext2fs_lookup(h->fs, pino, base, (int)strlen(base), NULL, &child);
-    if (rc || child == 0) { set_err(err, errlen, "Not found"); return -1; }
+    *out_count = n;
+    *cursor = resume;
+    set_err(err, errlen, NULL);
+    return 0;
+}
 
-    rc = ext2fs_unlink(h->fs, pino, base, child, 0);
-    if (rc) { set_err_rc(err, errlen, "unlink failed", rc); return -1; }
+SHIM_API int ext4_scan_inodes(void* fs_handle, uint32_t group_start, uint32_t group_end, uint32_t* cursor,
+                              void* cols, uint32_t cap, uint32_t* out_count, uint32_t* out_groups, char* err, int errlen) {
+    SHIM_TIMED(fs_handle, OP_SCAN_INODES, do_scan_inodes(fs_handle, group_start, group_end, cursor, cols, cap, out_count, out_groups, err, errlen));
+}
 
-    ext2fs_mark_super_dirty(h->fs);
-    ext2fs_flush(h->fs);
+// The same columns for the given inodes (count entries each, in that order),
+// read one by one: metadata for a directory's entries without a full scan.
+static int do_read_inodes(void* fs_handle, const uint32_t* inos, uint32_t count, void* cols, char* err, int errlen) {
+    if (!fs_handle || (count && (!inos || !cols))) { set_err(err, errlen, "bad args"); return -1; }
+    ext2_filsys fs = ((shim_fs_t*)fs_handle)->fs;
+    for (uint32_t i = 0; i < count; ++i) {
+        struct ext2_inode in; memset(&in, 0, sizeof(in));
+        if (!inos[i] || inos[i] > fs->super->s_inodes_count) { set_err(err, errlen, "bad inode number"); return -1; }
+        errcode_t rc = ext2fs_read_inode(fs, inos[i], &in);
+        if (rc) { set_err_rc(err, errlen, "read_inode failed", rc); return -1; }
+        put_inode_row(fs, cols, count, i, inos[i], &in);
+    }
     set_err(err, errlen, NULL);
     return 0;
 }
 
-SHIM_API int ext4_rename(void* fs_handle, const char* old_abs_path, const char* new_basename, char* err, int errlen) {
-    if (!fs_handle || !old_abs_path || !new_basename || new_basename[0]==0) { set_err(err, errlen, "bad args"); return -1; }
-    shim_fs_t* h = (shim_fs_t*)fs_handle;
+SHIM_API int ext4_read_inodes(void* fs_handle, const uint32_t* inos, uint32_t count, void* cols, char* err, int errlen) {
+    SHIM_TIMED(fs_handle, OP_READ_INODES, do_read_inodes(fs_handle, inos, count, cols, err, errlen));
+}
 
-    char parent[512], base[256];
-    if (lookup_parent_and_base(old_abs_path, parent, sizeof(parent), base, sizeof(base), err, errlen)) return -1;
+// ------------------------ trim ------------------------
+// Hands free space back to the host: every run of free blocks of at least
+// min_bytes is punched out of the image file (FALLOC_FL_PUNCH_HOLE on Linux,
+// FSCTL_SET_ZERO_DATA on a sparse NTFS file), or with EXT4_TRIM_ZERO written
+// with zeros for backends that cannot punch holes. Filesystem metadata is not
+// touched. *out_trimmed is the size of the runs processed, *out_reclaimed the
+// drop in host allocation (0 if it grew or is unknown).
 
-    ext2_ino_t pino = 0;
-    if (path_to_ino(h->fs, parent, &pino, err, errlen)) return -1;
+#define EXT4_TRIM_ZERO 0x1
 
-    ext2_ino_t child = 0;
-    errcode_t rc = ext2fs_lookup(h->fs, pino, base, (int)strlen(base), NULL, &child);
-    if (rc || child == 0) { set_err(err, errlen, "Not found"); return -1; }
+static int64_t host_allocated(const char* path) {
+#ifdef _WIN32
+    DWORD hi = 0;
+    DWORD lo = GetCompressedFileSizeA(path, &hi);
+    if (lo == INVALID_FILE_SIZE && GetLastError() != NO_ERROR) return -1;
+    return ((int64_t)hi << 32) | lo;
+#else
+    struct stat st;
+    if (stat(path, &st) != 0) return -1;
+    return (int64_t)st.st_blocks * 512;
+#endif
+}
+
+#ifdef _WIN32
+typedef HANDLE host_file_t;
+#define HOST_FILE_NONE INVALID_HANDLE_VALUE
 
-    // new name must not exist
-    ext2_ino_t exists = 0;
-    rc = ext2fs_lookup(h->fs, pino, new_basename, (int)strlen(new_basename), NULL, &exists);
-    if (rc == 0 && exists != 0) { set_err(err, errlen, "Target name already exists"); return -1; }
+static host_file_t host_open(const char* path) {
+    HANDLE f = CreateFileA(path, GENERIC_READ | GENERIC_WRITE, FILE_SHARE_READ | FILE_SHARE_WRITE,
+                           NULL, OPEN_EXISTING, FILE_ATTRIBUTE_NORMAL, NULL);
+    DWORD ret = 0;
+    // ranges are only deallocated in sparse files
+    if (f != INVALID_HANDLE_VALUE && !DeviceIoControl(f, FSCTL_SET_SPARSE, NULL, 0, NULL, 0, &ret, NULL)) {
+        CloseHandle(f);
+        return INVALID_HANDLE_VALUE;
+    }
+    return f;
+}
 
-    rc = ext2fs_link(h->fs, pino, new_basename, child, 0);
-    if (rc) { set_err_rc(err, errlen, "link(new) failed", rc); return -1; }
+static int host_punch(host_file_t f, uint64_t off, uint64_t len) {
+    FILE_ZERO_DATA_INFORMATION z;
+    DWORD ret = 0;
+    z.FileOffset.QuadPart = (LONGLONG)off;
+    z.BeyondFinalZero.QuadPart = (LONGLONG)(off + len);
+    return DeviceIoControl(f, FSCTL_SET_ZERO_DATA, &z, sizeof(z), NULL, 0, &ret, NULL) ? 0 : -1;
+}
 
-    rc = ext2fs_unlink(h->fs, pino, base, child, 0);
-    if (rc) { set_err_rc(err, errlen, "unlink(old) failed", rc); return -1; }
+static void host_close(host_file_t f) { CloseHandle(f); }
+#else
+typedef int host_file_t;
+#define HOST_FILE_NONE (-1)
 
-    ext2fs_mark_super_dirty(h->fs);
-    ext2fs_flush(h->fs);
-    set_err(err, errlen, NULL);
-    return 0;
+static host_file_t host_open(const char* path) { return open(path, O_RDWR); }
+
+static int host_punch(host_file_t f, uint64_t off, uint64_t len) {
+#ifdef FALLOC_FL_PUNCH_HOLE
+    return fallocate(f, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, (off_t)off, (off_t)len);
+#else
+    (void)f; (void)off; (void)len;
+    errno = EOPNOTSUPP;
+    return -1;
+#endif
+}
+
+static void host_close(host_file_t f) { close(f); }
+#endif
+
+static errcode_t zero_run(ext2_filsys fs, blk64_t blk, blk64_t count) {
+    static const blk64_t chunk = 256;
+    void* zeros = calloc((size_t)chunk, fs->blocksize);
+    if (!zeros) return EXT2_ET_NO_MEMORY;
+    errcode_t rc = 0;
+    while (count && !rc) {
+        blk64_t n = MINU64(chunk, count);
+        rc = io_channel_write_blk64(fs->io, blk, (int)n, zeros);
+        blk += n;
+        count -= n;
+    }
+    free(zeros);
+    return rc;
+}
+
+static int do_trim(void* fs_handle, uint64_t min_bytes, uint32_t flags, uint64_t* out_trimmed,
+                   uint64_t* out_reclaimed, char* err, int errlen) {
+    if (!fs_handle || !out_trimmed || !out_reclaimed) { set_err(err, errlen, "bad args"); return -1; }
+    shim_fs_t* h = (shim_fs_t*)fs_handle;
+    ext2_filsys fs = h->fs;
+    *out_trimmed = *out_reclaimed = 0;
+    if (!(fs->flags & EXT2_FLAG_RW)) { set_err(err, errlen, "trim needs a read-write handle"); return -1; }
+    if (need_bitmaps(h, err, errlen)) return -1;
+
+    // everything pending reaches the image before its free space is dropped
+    errcode_t rc = shim_sync(h, 1);
+    if (rc) { set_err_rc(err, errlen, "flush failed", rc); return -1; }
+
+    int zero = (flags & EXT4_TRIM_ZERO) != 0;
+    host_file_t f = HOST_FILE_NONE;
+    if (!zero && (f = host_open(fs->device_name)) == HOST_FILE_NONE) {
+        set_err(err, errlen, "Cannot open image file for hole punching");
+        return -1;
+    }
+    int64_t before = host_allocated(fs->device_name);
+
+    blk64_t min_blocks = (min_bytes + fs->blocksize - 1) / fs->blocksize;
+    if (!min_blocks) min_blocks = 1;
+    blk64_t last = ext2fs_blocks_count(fs->super) - 1;
+    blk64_t blk = fs->super->s_first_data_block;
+    int ret = 0;
+    while (blk <= last) {
+        blk64_t start, end;
+        if (ext2fs_find_first_zero_block_bitmap2(fs->block_map, blk, last, &start)) break;
+        if (ext2fs_find_first_set_block_bitmap2(fs->block_map, start, last, &end)) end = last + 1;
+        blk = end;
+        if (end - start < min_blocks) continue;
+        if (zero) {
+            data_in_place(fs, 1);
+            rc = zero_run(fs, start, end - start);
+            data_in_place(fs, 0);
+            if (rc) { set_err_rc(err, errlen, "zero fill failed", rc); ret = -1; break; }
+        } else if (host_punch(f, (uint64_t)start * fs->blocksize, (uint64_t)(end - start) * fs->blocksize)) {
+            set_err(err, errlen, errno == EOPNOTSUPP ? "Hole punching not supported by the host filesystem"
+                                                     : "Hole punching failed");
+            ret = -1;
+            break;
+        }
+        *out_trimmed += (uint64_t)(end - start) * fs->blocksize;
+    }
+    if (zero) {
+        rc = io_channel_flush(fs->io);
+        if (rc && !ret) { set_err_rc(err, errlen, "flush failed", rc); ret = -1; }
+    } else {
+        host_close(f);
+    }
+    int64_t after = host_allocated(fs->device_name);
+    if (before >= 0 && after >= 0 && after < before) *out_reclaimed = (uint64_t)(before - after);
+    if (!ret) set_err(err, errlen, NULL);
+    return ret;
+}
+
+SHIM_API int ext4_trim(void* fs_handle, uint64_t min_bytes, uint32_t flags, uint64_t* out_trimmed,
+                       uint64_t* out_reclaimed, char* err, int errlen) {
+    SHIM_TIMED(fs_handle, OP_TRIM, do_trim(fs_handle, min_bytes, flags, out_trimmed, out_reclaimed, err, errlen));
 }
 
 // ------------------------ mkfs (with feature fallback) ------------------------
@@ -554,15 +4005,30 @@ static void fill_sb_basic(struct ext2_super_block* s,
                           uint32_t block_size,
                           int enable_64bit,
                           int enable_csum,
+                          int enable_extents,
+                          int enable_inline,
                           const char* label)
 {
     memset(s, 0, sizeof(*s));
     s->s_rev_level = EXT2_DYNAMIC_REV;
     s->s_feature_incompat = EXT2_FEATURE_INCOMPAT_FILETYPE |
                             (enable_64bit ? EXT4_FEATURE_INCOMPAT_64BIT : 0);
-    s->s_feature_compat   = EXT2_FEATURE_COMPAT_DIR_PREALLOC;
+    s->s_feature_compat   = EXT2_FEATURE_COMPAT_DIR_PREALLOC | EXT2_FEATURE_COMPAT_DIR_INDEX;
     s->s_feature_ro_compat = EXT2_FEATURE_RO_COMPAT_SPARSE_SUPER |
                              (enable_csum ? EXT4_FEATURE_RO_COMPAT_METADATA_CSUM : 0);
+    if (enable_extents) {
+        // extent-mapped files, inode tables/bitmaps packed per flex group of
+        // 16 block groups, and i_blocks counted in fs blocks past 2^32 sectors
+        s->s_feature_incompat |= EXT3_FEATURE_INCOMPAT_EXTENTS | EXT4_FEATURE_INCOMPAT_FLEX_BG;
+        s->s_feature_ro_compat |= EXT2_FEATURE_RO_COMPAT_LARGE_FILE | EXT4_FEATURE_RO_COMPAT_HUGE_FILE;
+        s->s_log_groups_per_flex = 4;
+    }
+    if (enable_inline) {
+        // small files live in i_block and the system.data xattr, which needs
+        // room after the 128-byte base inode
+        s->s_feature_compat |= EXT2_FEATURE_COMPAT_EXT_ATTR;
+        s->s_feature_incompat |= EXT4_FEATURE_INCOMPAT_INLINE_DATA;
+    }
 
     s->s_log_block_size = (block_size == 1024 ? 0 : (block_size == 2048 ? 1 : 2));
 
@@ -572,10 +4038,11 @@ static void fill_sb_basic(struct ext2_super_block* s,
     if (blocks_per_group == 0) blocks_per_group = 32768;
 
     uint32_t group_count = (uint32_t)((blocks_total + blocks_per_group - 1) / blocks_per_group);
-    uint32_t inodes_per_group = 8192;
-    if (inodes_per_group * group_count * sizeof(struct ext2_inode) > blocks_per_group * block_size) {
-        inodes_per_group = (uint32_t)((blocks_per_group * block_size) / sizeof(struct ext2_inode));
-    }
+    // one inode per 16 KiB like mke2fs, bounded by what an inode bitmap block covers
+    uint64_t inodes_total = image_bytes / 16384;
+    uint32_t inodes_per_group = (uint32_t)((inodes_total + group_count - 1) / group_count);
+    if (inodes_per_group > block_size * 8) inodes_per_group = block_size * 8;
+    if (inodes_per_group < 16) inodes_per_group = 16;
 
     s->s_blocks_count = (uint32_t)(blocks_total & 0xFFFFFFFFu);
     s->s_inodes_count = inodes_per_group * group_count;
@@ -597,7 +4064,7 @@ static void fill_sb_basic(struct ext2_super_block* s,
     s->s_def_resuid = EXT2_DEF_RESUID;
     s->s_def_resgid = EXT2_DEF_RESGID;
     s->s_first_ino = EXT2_GOOD_OLD_FIRST_INO;
-    s->s_inode_size = EXT2_GOOD_OLD_INODE_SIZE;
+    s->s_inode_size = enable_inline ? 256 : EXT2_GOOD_OLD_INODE_SIZE;
     s->s_block_group_nr = 0;
     s->s_flags = 0;
     if (label && label[0]) {
@@ -605,26 +4072,75 @@ static void fill_sb_basic(struct ext2_super_block* s,
     }
 }
 
+static void random_fill(void* out, size_t n) {
+    static uint64_t x = 0;
+    if (!x) x = now_ns() ^ ((uint64_t)time(NULL) << 32) ^ (uint64_t)(uintptr_t)&x;
+    uint8_t* p = (uint8_t*)out;
+    while (n) {
+        // splitmix64
+        x += 0x9E3779B97F4A7C15ull;
+        uint64_t z = x;
+        z = (z ^ (z >> 30)) * 0xBF58476D1CE4E5B9ull;
+        z = (z ^ (z >> 27)) * 0x94D049BB133111EBull;
+        z ^= z >> 31;
+        size_t k = n < 8 ? n : 8;
+        memcpy(p, &z, k);
+        p += k; n -= k;
+    }
+}
+
+// Identity and checksum/htree parameters the way mke2fs sets them after
+// ext2fs_initialize: random UUID, crc32c, half_md4 with a random seed and
+// the signedness of char on this platform.
+static void setup_identity(ext2_filsys fs) {
+    struct ext2_super_block* s = fs->super;
+    random_fill(s->s_uuid, sizeof(s->s_uuid));
+    s->s_uuid[6] = (uint8_t)((s->s_uuid[6] & 0x0F) | 0x40);  // RFC 4122 version 4
+    s->s_uuid[8] = (uint8_t)((s->s_uuid[8] & 0x3F) | 0x80);
+    if (ext2fs_has_feature_metadata_csum(s)) {
+        s->s_checksum_type = EXT2_CRC32C_CHKSUM;
+        ext2fs_init_csum_seed(fs);
+    }
+    random_fill(s->s_hash_seed, sizeof(s->s_hash_seed));
+    s->s_def_hash_version = EXT2_HASH_HALF_MD4;
+    char c = (char)255;
+    s->s_flags |= (((int)c) == -1) ? EXT2_FLAGS_SIGNED_HASH : EXT2_FLAGS_UNSIGNED_HASH;
+}
+
 static int do_initialize_fs(const char* target_path,
                             uint64_t image_bytes,
                             uint32_t block_size,
                             int enable_64bit,
                             int enable_csum,
+                            int enable_extents,
+                            int enable_inline,
                             io_manager io,
                             char* err, int errlen)
 {
     struct ext2_super_block s;
-    fill_sb_basic(&s, image_bytes, block_size, enable_64bit, enable_csum, NULL);
+    fill_sb_basic(&s, image_bytes, block_size, enable_64bit, enable_csum, enable_extents, enable_inline, NULL);
 
     ext2_filsys fs = NULL;
     errcode_t rc = ext2fs_initialize(target_path, EXT2_FLAG_RW | (enable_64bit ? EXT2_FLAG_64BITS : 0), &s, io, &fs);
     if (rc) { set_err_rc(err, errlen, "ext2fs_initialize failed", rc); return -1; }
+    setup_identity(fs);
 
     rc = ext2fs_allocate_tables(fs);
     if (rc) { ext2fs_close(fs); set_err_rc(err, errlen, "allocate_tables failed", rc); return -1; }
 
-    // journal (best effort)
-    rc = ext2fs_add_journal_inode(fs, 0, 0); (void)rc;
+    // reserved inodes, root and lost+found (ext2fs_initialize leaves these to mke2fs)
+    for (ext2_ino_t i = 1; i < EXT2_FIRST_INODE(fs->super); ++i) {
+        if (i != EXT2_ROOT_INO) ext2fs_inode_alloc_stats2(fs, i, +1, 0);
+    }
+    rc = mkdir_blocks(fs, EXT2_ROOT_INO, EXT2_ROOT_INO, 0);
+    if (rc) { ext2fs_close(fs); set_err_rc(err, errlen, "create root dir failed", rc); return -1; }
+    rc = mkdir_blocks(fs, EXT2_ROOT_INO, 0, "lost+found"); (void)rc;
+
+    // journal (best effort; too small an image simply goes without). The
+    // file was just created sparse, so the journal blocks read as zeros
+    // without being written.
+    int jblocks = ext2fs_default_journal_size(ext2fs_blocks_count(fs->super));
+    if (jblocks > 0) { rc = ext2fs_add_journal_inode(fs, (blk_t)jblocks, EXT2_MKJOURNAL_LAZYINIT); (void)rc; }
 
     ext2fs_mark_super_dirty(fs);
     rc = ext2fs_write_bitmaps(fs);
@@ -635,7 +4151,13 @@ static int do_initialize_fs(const char* target_path,
     return 0;
 }
 
-SHIM_API int ext4_mkfs(const char* target_path, uint64_t image_bytes, uint32_t block_size, const char* label, const char* opt_uuid, char* err, int errlen) {
+// With EXT4_MKFS_LEGACY_LAYOUT the image gets the pre-extents layout (block
+// maps, no flex_bg/huge_file, no 64bit), mainly to compare against.
+// EXT4_MKFS_INLINE_DATA adds inline_data with 256-byte inodes.
+#define EXT4_MKFS_LEGACY_LAYOUT 0x1
+#define EXT4_MKFS_INLINE_DATA   0x2
+
+SHIM_API int ext4_mkfs_ex(const char* target_path, uint64_t image_bytes, uint32_t block_size, const char* label, const char* opt_uuid, uint32_t flags, char* err, int errlen) {
     (void)opt_uuid; // optional; not parsed here
     if (!target_path || image_bytes < 16ull * 1024 * 1024) {
         set_err(err, errlen, "image too small (>=16MiB)"); return -1;
@@ -644,17 +4166,20 @@ SHIM_API int ext4_mkfs(const char* target_path, uint64_t image_bytes, uint32_t b
 
     if (create_sparse_file(target_path, image_bytes, err, errlen)) return -1;
 
-    io_manager io = windows_io_manager;
+    io_manager io = SHIM_IO_MANAGER;
 
     // Try a cascade of feature sets to avoid ext2 71 on some builds
+    // (64bit is only used together with extents; block maps cannot address it)
+    int ext = !(flags & EXT4_MKFS_LEGACY_LAYOUT);
+    int inl = (flags & EXT4_MKFS_INLINE_DATA) != 0;
     // 1) 64bit + metadata_csum
-    if (do_initialize_fs(target_path, image_bytes, block_size, 1, 1, io, err, errlen) == 0) goto label_set;
+    if (ext && do_initialize_fs(target_path, image_bytes, block_size, 1, 1, ext, inl, io, err, errlen) == 0) goto label_set;
     // 2) metadata_csum only
-    if (do_initialize_fs(target_path, image_bytes, block_size, 0, 1, io, err, errlen) == 0) goto label_set;
+    if (do_initialize_fs(target_path, image_bytes, block_size, 0, 1, ext, inl, io, err, errlen) == 0) goto label_set;
     // 3) 64bit only
-    if (do_initialize_fs(target_path, image_bytes, block_size, 1, 0, io, err, errlen) == 0) goto label_set;
+    if (ext && do_initialize_fs(target_path, image_bytes, block_size, 1, 0, ext, inl, io, err, errlen) == 0) goto label_set;
     // 4) basic (no advanced features)
-    if (do_initialize_fs(target_path, image_bytes, block_size, 0, 0, io, err, errlen) == 0) goto label_set;
+    if (do_initialize_fs(target_path, image_bytes, block_size, 0, 0, ext, inl, io, err, errlen) == 0) goto label_set;
     // All failed
     return -1;
 
@@ -671,3 +4196,538 @@ label_set:
     set_err(err, errlen, NULL);
     return 0;
 }
+
+SHIM_API int ext4_mkfs(const char* target_path, uint64_t image_bytes, uint32_t block_size, const char* label, const char* opt_uuid, char* err, int errlen) {
+    return ext4_mkfs_ex(target_path, image_bytes, block_size, label, opt_uuid, 0, err, errlen);
+}
+
+// ------------------------ clone ------------------------
+// Copies the image to dst_path, but only the blocks the block bitmap marks in
+// use (metadata included): each run of used blocks is read and written in
+// chunks of up to CLONE_CHUNK bytes, and everything else stays a hole in the
+// new sparse file. A larger new_size_bytes then grows the clone in place: the
+// last group is filled out and block groups are added, as far as the existing
+// group descriptor blocks allow. Shrinking is not supported.
+
+#define CLONE_CHUNK (8u << 20)
+
+static int grow_fs(ext2_filsys fs, blk64_t new_blocks, char* err, int errlen) {
+    struct ext2_super_block* sb = fs->super;
+    blk64_t bpg = EXT2_BLOCKS_PER_GROUP(sb);
+    dgrp_t old_groups = fs->group_desc_count;
+    dgrp_t groups = (dgrp_t)ext2fs_div64_ceil(new_blocks - sb->s_first_data_block, bpg);
+
+    // like resize2fs, leave out a trailing group too small for its own tables
+    blk64_t rem = (new_blocks - sb->s_first_data_block) % bpg;
+    if (rem && groups > old_groups) {
+        blk64_t overhead = 2 + fs->inode_blocks_per_group +
+                           (ext2fs_bg_has_super(fs, groups - 1) ? 1 + fs->desc_blocks : 0);
+        if (rem < overhead + 50) { new_blocks -= rem; groups--; }
+    }
+    if (new_blocks <= ext2fs_blocks_count(sb)) return 0;
+    if (!ext2fs_has_feature_64bit(sb) && new_blocks > 0xFFFFFFFFull) {
+        set_err(err, errlen, "clone size needs the 64bit feature"); return -1;
+    }
+    if (ext2fs_div64_ceil(groups, EXT2_DESC_PER_BLOCK(sb)) > fs->desc_blocks) {
+        set_err(err, errlen, "clone size needs more group descriptor blocks than the image has"); return -1;
+    }
+
+    errcode_t rc = ext2fs_read_inode_bitmap(fs);
+    if (!rc) rc = ext2fs_read_block_bitmap(fs);
+    if (rc) { set_err_rc(err, errlen, "read_bitmaps failed", rc); return -1; }
+
+    ext2fs_blocks_count_set(sb, new_blocks);
+    sb->s_inodes_count = sb->s_inodes_per_group * groups;
+    fs->group_desc_count = groups;
+    rc = ext2fs_resize_inode_bitmap2(sb->s_inodes_count, sb->s_inodes_count, fs->inode_map);
+    if (!rc) rc = ext2fs_resize_block_bitmap2(new_blocks - 1, (blk64_t)groups * bpg + sb->s_first_data_block - 1,
+                                              fs->block_map);
+    if (rc) { set_err_rc(err, errlen, "resize bitmaps failed", rc); return -1; }
+
+    for (dgrp_t g = old_groups; g < groups; g++) {
+        memset(ext2fs_group_desc(fs, fs->group_desc, g), 0, EXT2_DESC_SIZE(sb));
+        ext2fs_bg_free_inodes_count_set(fs, g, sb->s_inodes_per_group);
+        ext2fs_reserve_super_and_bgd(fs, g, fs->block_map);
+        rc = ext2fs_allocate_group_table(fs, g, fs->block_map);
+        if (rc) { set_err_rc(err, errlen, "allocate_group_table failed", rc); return -1; }
+        // the new inode tables sit in blocks the clone never wrote, so they read as zeros
+    }
+
+    // recount free blocks from the bitmap: the old last group grew and the
+    // new tables may have landed in any group
+    blk64_t free_total = 0;
+    for (dgrp_t g = 0; g < groups; g++) {
+        blk64_t first = ext2fs_group_first_block2(fs, g), last = ext2fs_group_last_block2(fs, g), used = 0;
+        rc = ext2fs_count_used_clusters(fs, first, last, &used);
+        if (rc) { set_err_rc(err, errlen, "count_used_clusters failed", rc); return -1; }
+        ext2fs_bg_free_blocks_count_set(fs, g, (__u32)(last - first + 1 - used));
+        free_total += last - first + 1 - used;
+    }
+    ext2fs_free_blocks_count_set(sb, free_total);
+    sb->s_free_inodes_count += (groups - old_groups) * sb->s_inodes_per_group;
+
+    rc = ext2fs_set_gdt_csum(fs);
+    if (rc) { set_err_rc(err, errlen, "set_gdt_csum failed", rc); return -1; }
+    ext2fs_mark_super_dirty(fs);
+    ext2fs_mark_bb_dirty(fs);
+    ext2fs_mark_ib_dirty(fs);
+    return 0;
+}
+
+static int do_clone(void* fs_handle, const char* dst_path, uint64_t new_size_bytes, uint64_t* out_copied,
+                    uint64_t* out_size, char* err, int errlen) {
+    if (!fs_handle || !dst_path || !dst_path[0] || !out_copied || !out_size) { set_err(err, errlen, "bad args"); return -1; }
+    shim_fs_t* h = (shim_fs_t*)fs_handle;
+    ext2_filsys fs = h->fs;
+    *out_copied = *out_size = 0;
+    if (strcmp(dst_path, fs->device_name) == 0) { set_err(err, errlen, "clone target is the source image"); return -1; }
+
+    errcode_t rc = (fs->flags & EXT2_FLAG_RW) ? shim_sync(h, 1) : 0;
+    if (rc) { set_err_rc(err, errlen, "flush failed", rc); return -1; }
+    if (need_bitmaps(h, err, errlen)) return -1;
+
+    uint64_t size = ext2fs_blocks_count(fs->super) * (uint64_t)fs->blocksize;
+    if (new_size_bytes && new_size_bytes < size) { set_err(err, errlen, "shrinking a clone is not supported"); return -1; }
+    if (create_sparse_file(dst_path, new_size_bytes ? new_size_bytes : size, err, errlen)) return -1;
+
+    io_channel out = NULL;
+    rc = SHIM_IO_MANAGER->open(dst_path, IO_FLAG_RW, &out);
+    if (!rc) rc = io_channel_set_blksize(out, fs->blocksize);
+    if (rc) {
+        if (out) io_channel_close(out);
+        set_err_rc(err, errlen, "open clone failed", rc);
+        goto fail;
+    }
+    blk64_t chunk = CLONE_CHUNK / fs->blocksize;
+    uint8_t* buf = (uint8_t*)malloc(CLONE_CHUNK);
+    if (!buf) { io_channel_close(out); set_err(err, errlen, "out of memory"); goto fail; }
+
+    // maximal runs of used blocks, each copied with as few requests as possible
+    blk64_t last = ext2fs_blocks_count(fs->super) - 1;
+    blk64_t blk = fs->super->s_first_data_block;
+    while (!rc && blk <= last) {
+        blk64_t start, end;
+        if (ext2fs_find_first_set_block_bitmap2(fs->block_map, blk, last, &start)) break;
+        if (ext2fs_find_first_zero_block_bitmap2(fs->block_map, start, last, &end)) end = last + 1;
+        for (blk64_t b = start; !rc && b < end; b += chunk) {
+            int n = (int)MINU64(chunk, end - b);
+            rc = io_channel_read_blk64(fs->io, b, n, buf);
+            if (rc) { set_err_rc(err, errlen, "read failed", rc); break; }
+            rc = io_channel_write_blk64(out, b, n, buf);
+            if (rc) { set_err_rc(err, errlen, "write clone failed", rc); break; }
+            *out_copied += (uint64_t)n * fs->blocksize;
+        }
+        blk = end;
+    }
+    free(buf);
+    if (!rc) {
+        rc = io_channel_flush(out);
+        if (rc) set_err_rc(err, errlen, "flush clone failed", rc);
+    }
+    io_channel_close(out);
+    if (rc) goto fail;
+
+    *out_size = size;
+    if (new_size_bytes > size) {
+        ext2_filsys cfs = NULL;
+        rc = ext2fs_open(dst_path, EXT2_FLAG_RW | EXT2_FLAG_64BITS, 0, 0, SHIM_IO_MANAGER, &cfs);
+        if (rc) { set_err_rc(err, errlen, "open clone failed", rc); goto fail; }
+        if (grow_fs(cfs, new_size_bytes / cfs->blocksize, err, errlen)) { ext2fs_close(cfs); goto fail; }
+        *out_size = ext2fs_blocks_count(cfs->super) * (uint64_t)cfs->blocksize;
+        rc = ext2fs_close(cfs);
+        if (rc) { set_err_rc(err, errlen, "close clone failed", rc); goto fail; }
+    }
+    set_err(err, errlen, NULL);
+    return 0;
+
+fail:
+    // no half-made clone is left behind
+    remove(dst_path);
+    return -1;
+}
+
+SHIM_API int ext4_clone(void* fs_handle, const char* dst_path, uint64_t new_size_bytes, uint64_t* out_copied,
+                        uint64_t* out_size, char* err, int errlen) {
+    SHIM_TIMED(fs_handle, OP_CLONE, do_clone(fs_handle, dst_path, new_size_bytes, out_copied, out_size, err, errlen));
+}
+
+// ------------------------ disk usage ------------------------
+// Walks a subtree by inode and sums apparent size (i_size) and allocated
+// bytes (i_blocks) per directory. Each inode is counted once, so extra hard
+// links add nothing (they are counted in "hardlinks"). Output JSON:
+//   {"dir_totals":[{"path","size","alloc","files","dirs"},...],
+//    "top":[{"path","size","alloc"},...],
+//    "size","alloc","files","dirs","hardlinks"}
+// dir_totals is in post-order (the root comes last); files/dirs are counts
+// below each directory. top holds the top_n largest files by allocated bytes.
+
+#define DU_PATH_MAX 4096
+
+typedef struct {
+    char* path;
+    uint64_t size;
+    uint64_t alloc;
+} du_file_t;
+
+typedef struct {
+    uint64_t size, alloc, files, dirs;
+} du_sum_t;
+
+typedef struct {
+    ext2_filsys fs;
+    ext2fs_inode_bitmap seen;
+    char path[DU_PATH_MAX];
+    int plen;
+    du_file_t* top;        // min-heap on alloc, top_n slots
+    uint32_t top_n;
+    uint32_t top_count;
+    uint64_t hardlinks;
+    char* out;
+    int cap;
+    int pos;
+    int first;
+    int overflow;
+    errcode_t rc;
+    const char* what;      // set on failure, with rc when libext2fs reported one
+} du_ctx_t;
+
+typedef struct {
+    du_ctx_t* ctx;
+    du_sum_t* sum;
+} du_frame_t;
+
+static int du_less(const du_file_t* a, const du_file_t* b) {
+    return a->alloc != b->alloc ? a->alloc < b->alloc : a->size < b->size;
+}
+
+static void du_heap_down(du_file_t* heap, uint32_t n, uint32_t i) {
+    for (;;) {
+        uint32_t m = i, l = 2 * i + 1, r = l + 1;
+        if (l < n && du_less(&heap[l], &heap[m])) m = l;
+        if (r < n && du_less(&heap[r], &heap[m])) m = r;
+        if (m == i) return;
+        du_file_t t = heap[i]; heap[i] = heap[m]; heap[m] = t;
+        i = m;
+    }
+}
+
+static int du_offer(du_ctx_t* ctx, uint64_t size, uint64_t alloc) {
+    if (!ctx->top_n) return 0;
+    du_file_t f = { NULL, size, alloc };
+    if (ctx->top_count == ctx->top_n && !du_less(&ctx->top[0], &f)) return 0;
+    f.path = strdup(ctx->path);
+    if (!f.path) return -1;
+    if (ctx->top_count < ctx->top_n) {
+        uint32_t i = ctx->top_count++;
+        ctx->top[i] = f;
+        while (i && du_less(&ctx->top[i], &ctx->top[(i - 1) / 2])) {
+            du_file_t t = ctx->top[i]; ctx->top[i] = ctx->top[(i - 1) / 2]; ctx->top[(i - 1) / 2] = t;
+            i = (i - 1) / 2;
+        }
+    } else {
+        free(ctx->top[0].path);
+        ctx->top[0] = f;
+        du_heap_down(ctx->top, ctx->top_count, 0);
+    }
+    return 0;
+}
+
+// Appends {"path":...,"size":...,"alloc":...[,"files","dirs"]}.
+static void du_emit(du_ctx_t* ctx, const char* path, uint64_t size, uint64_t alloc, const du_sum_t* counts) {
+    if (ctx->overflow) return;
+    char esc[2 * DU_PATH_MAX + 8];
+    char one[2 * DU_PATH_MAX + 160];
+    if (json_escape_name(path, esc, sizeof(esc))) { ctx->overflow = 1; return; }
+    int n = snprintf(one, sizeof(one), "%s{\"path\":%s,\"size\":%llu,\"alloc\":%llu",
+                     ctx->first ? "" : ",", esc, (unsigned long long)size, (unsigned long long)alloc);
+    if (counts)
+        snprintf(one + n, sizeof(one) - (size_t)n, ",\"files\":%llu,\"dirs\":%llu}",
+                 (unsigned long long)counts->files, (unsigned long long)counts->dirs);
+    else
+        snprintf(one + n, sizeof(one) - (size_t)n, "}");
+    if (append_json(ctx->out, ctx->cap, &ctx->pos, one)) ctx->overflow = 1;
+    ctx->first = 0;
+}
+
+static int du_dir(du_ctx_t* ctx, ext2_ino_t dir, du_sum_t* sum);
+
+static int du_cb(ext2_ino_t dir, int entry, struct ext2_dir_entry *de, int offset, int blocksize, char *buf, void *priv) {
+    (void)dir; (void)offset; (void)blocksize; (void)buf;
+    du_frame_t* fr = (du_frame_t*)priv;
+    du_ctx_t* ctx = fr->ctx;
+    if (entry == DIRENT_DOT_FILE || entry == DIRENT_DOT_DOT_FILE) return 0;
+    int len = ext2fs_dirent_name_len(de);
+    if (!de->inode || len == 0) return 0;
+    if (ext2fs_test_inode_bitmap2(ctx->seen, de->inode)) { ctx->hardlinks++; return 0; }
+    ext2fs_mark_inode_bitmap2(ctx->seen, de->inode);
+
+    struct ext2_inode in; memset(&in, 0, sizeof(in));
+    if ((ctx->rc = ext2fs_read_inode(ctx->fs, de->inode, &in))) { ctx->what = "read_inode failed"; return DIRENT_ABORT; }
+    int plen = ctx->plen;
+    if (plen + 1 + len >= DU_PATH_MAX) { ctx->what = "path too long"; return DIRENT_ABORT; }
+    if (plen > 1) ctx->path[ctx->plen++] = '/';
+    memcpy(ctx->path + ctx->plen, de->name, (size_t)len);
+    ctx->plen += len;
+    ctx->path[ctx->plen] = 0;
+
+    uint64_t size = EXT2_I_SIZE(&in);
+    uint64_t alloc = (uint64_t)ext2fs_get_stat_i_blocks(ctx->fs, &in) * 512;
+    int rc = 0;
+    if (LINUX_S_ISDIR(in.i_mode)) {
+        du_sum_t sub = { size, alloc, 0, 0 };
+        rc = du_dir(ctx, de->inode, &sub);
+        fr->sum->size += sub.size;
+        fr->sum->alloc += sub.alloc;
+        fr->sum->files += sub.files;
+        fr->sum->dirs += sub.dirs + 1;
+    } else {
+        fr->sum->size += size;
+        fr->sum->alloc += alloc;
+        fr->sum->files++;
+        if (du_offer(ctx, size, alloc)) { ctx->what = "out of memory"; rc = -1; }
+    }
+    ctx->plen = plen;
+    ctx->path[plen] = 0;
+    return rc ? DIRENT_ABORT : 0;
+}
+
+// Adds everything below dir (path in ctx->path) to sum and emits its total.
+static int du_dir(du_ctx_t* ctx, ext2_ino_t dir, du_sum_t* sum) {
+    du_frame_t fr = { ctx, sum };
+    errcode_t rc = ext2fs_dir_iterate2(ctx->fs, dir, 0, NULL, du_cb, &fr);
+    if (ctx->what) return -1;
+    if (rc) { ctx->rc = rc; ctx->what = "dir_iterate failed"; return -1; }
+    du_emit(ctx, ctx->path, sum->size, sum->alloc, sum);
+    return 0;
+}
+
+static int du_cmp_desc(const void* a, const void* b) {
+    const du_file_t* x = (const du_file_t*)a;
+    const du_file_t* y = (const du_file_t*)b;
+    return du_less(y, x) ? -1 : du_less(x, y) ? 1 : strcmp(x->path, y->path);
+}
+
+static int do_du(void* fs_handle, const char* abs_path, uint32_t top_n, char* json_utf8, int buflen, char* err, int errlen) {
+    if (!fs_handle || !json_utf8 || buflen <= 2) { set_err(err, errlen, "bad args"); return -1; }
+    json_utf8[0] = 0;
+    shim_fs_t* h = (shim_fs_t*)fs_handle;
+    const char* path = (abs_path && abs_path[0]) ? abs_path : "/";
+    ext2_ino_t ino = 0;
+    if (path_to_ino(h->fs, path, &ino, err, errlen)) return -1;
+    struct ext2_inode in; memset(&in, 0, sizeof(in));
+    errcode_t rc = ext2fs_read_inode(h->fs, ino, &in);
+    if (rc) { set_err_rc(err, errlen, "read_inode failed", rc); return -1; }
+
+    du_ctx_t* ctx = (du_ctx_t*)calloc(1, sizeof(du_ctx_t));
+    if (!ctx) { set_err(err, errlen, "out of memory"); return -1; }
+    ctx->fs = h->fs;
+    ctx->out = json_utf8; ctx->cap = buflen; ctx->first = 1;
+    ctx->top_n = top_n;
+    if (top_n && !(ctx->top = (du_file_t*)calloc(top_n, sizeof(du_file_t)))) {
+        free(ctx); set_err(err, errlen, "out of memory"); return -1;
+    }
+    rc = ext2fs_allocate_inode_bitmap(h->fs, "du seen", &ctx->seen);
+    if (rc) { free(ctx->top); free(ctx); set_err_rc(err, errlen, "allocate_inode_bitmap failed", rc); return -1; }
+    ext2fs_mark_inode_bitmap2(ctx->seen, ino);
+
+    // normalized path without a trailing slash ("/" stays)
+    for (const char* p = path; *p && ctx->plen < DU_PATH_MAX - 1; ++p)
+        if (*p != '/' || (ctx->plen == 0 || ctx->path[ctx->plen - 1] != '/')) ctx->path[ctx->plen++] = *p;
+    if (ctx->plen > 1 && ctx->path[ctx->plen - 1] == '/') ctx->plen--;
+    ctx->path[ctx->plen] = 0;
+
+    du_sum_t sum = { EXT2_I_SIZE(&in), (uint64_t)ext2fs_get_stat_i_blocks(h->fs, &in) * 512, 0, 0 };
+    append_json(json_utf8, buflen, &ctx->pos, "{\"dir_totals\":[");
+    int ret = 0;
+    if (LINUX_S_ISDIR(in.i_mode)) {
+        ret = du_dir(ctx, ino, &sum);
+    } else {
+        sum.files = 1;
+        if (du_offer(ctx, sum.size, sum.alloc)) { ctx->what = "out of memory"; ret = -1; }
+    }
+    if (ret) {
+        if (ctx->rc) set_err_rc(err, errlen, ctx->what, ctx->rc);
+        else set_err(err, errlen, ctx->what);
+    } else {
+        qsort(ctx->top, ctx->top_count, sizeof(du_file_t), du_cmp_desc);
+        if (append_json(json_utf8, buflen, &ctx->pos, "],\"top\":[")) ctx->overflow = 1;
+        ctx->first = 1;
+        for (uint32_t i = 0; i < ctx->top_count; ++i)
+            du_emit(ctx, ctx->top[i].path, ctx->top[i].size, ctx->top[i].alloc, NULL);
+        char tail[256];
+        snprintf(tail, sizeof(tail), "],\"size\":%llu,\"alloc\":%llu,\"files\":%llu,\"dirs\":%llu,\"hardlinks\":%llu}",
+                 (unsigned long long)sum.size, (unsigned long long)sum.alloc, (unsigned long long)sum.files,
+                 (unsigned long long)sum.dirs, (unsigned long long)ctx->hardlinks);
+        if (ctx->overflow || append_json(json_utf8, buflen, &ctx->pos, tail)) {
+            set_err(err, errlen, "buffer too small");
+            ret = -1;
+        } else {
+            set_err(err, errlen, NULL);
+        }
+    }
+    for (uint32_t i = 0; i < ctx->top_count; ++i) free(ctx->top[i].path);
+    free(ctx->top);
+    ext2fs_free_inode_bitmap(ctx->seen);
+    free(ctx);
+    return ret;
+}
+
+SHIM_API int ext4_du(void* fs_handle, const char* abs_path, uint32_t top_n, char* json_utf8, int buflen, char* err, int errlen) {
+    SHIM_TIMED(fs_handle, OP_DU, do_du(fs_handle, abs_path, top_n, json_utf8, buflen, err, errlen));
+}
+
+// ------------------------ walk / map digest (image diff) ------------------------
+
+// Path -> inode listing of a whole subtree in one call: inode numbers go to
+// inos[], absolute paths to paths as NUL-terminated strings in the same order.
+// Directories are told apart by the dirent file type, so only entries without
+// one cost an inode read. When either buffer runs out the walk keeps counting
+// and fails with "buffer too small"; out_count/out_paths_len are then the
+// sizes needed.
+
+typedef struct {
+    ext2_filsys fs;
+    char path[DU_PATH_MAX];
+    int plen;
+    uint32_t* inos;
+    uint32_t max_entries;
+    char* paths;
+    uint64_t paths_cap;
+    uint32_t count;
+    uint64_t paths_len;
+    errcode_t rc;
+    const char* what;
+} walk_ctx_t;
+
+static int walk_dir(walk_ctx_t* ctx, ext2_ino_t dir);
+
+static int walk_cb(ext2_ino_t dir, int entry, struct ext2_dir_entry *de, int offset, int blocksize, char *buf, void *priv) {
+    (void)dir; (void)offset; (void)blocksize; (void)buf;
+    walk_ctx_t* ctx = (walk_ctx_t*)priv;
+    if (entry == DIRENT_DOT_FILE || entry == DIRENT_DOT_DOT_FILE) return 0;
+    int len = ext2fs_dirent_name_len(de);
+    if (!de->inode || len == 0) return 0;
+
+    int is_dir;
+    int ft = ext2fs_has_feature_filetype(ctx->fs->super) ? ext2fs_dirent_file_type(de) : EXT2_FT_UNKNOWN;
+    if (ft == EXT2_FT_UNKNOWN) {
+        struct ext2_inode in; memset(&in, 0, sizeof(in));
+        if ((ctx->rc = ext2fs_read_inode(ctx->fs, de->inode, &in))) { ctx->what = "read_inode failed"; return DIRENT_ABORT; }
+        is_dir = LINUX_S_ISDIR(in.i_mode);
+    } else {
+        is_dir = ft == EXT2_FT_DIR;
+    }
+
+    int plen = ctx->plen;
+    if (plen + 1 + len >= DU_PATH_MAX) { ctx->what = "path too long"; return DIRENT_ABORT; }
+    if (plen > 1) ctx->path[ctx->plen++] = '/';
+    memcpy(ctx->path + ctx->plen, de->name, (size_t)len);
+    ctx->plen += len;
+    ctx->path[ctx->plen] = 0;
+
+    uint64_t need = (uint64_t)ctx->plen + 1;
+    if (ctx->count < ctx->max_entries && ctx->paths_len + need <= ctx->paths_cap) {
+        ctx->inos[ctx->count] = de->inode;
+        memcpy(ctx->paths + ctx->paths_len, ctx->path, (size_t)need);
+    }
+    ctx->count++;
+    ctx->paths_len += need;
+
+    int rc = is_dir ? walk_dir(ctx, de->inode) : 0;
+    ctx->plen = plen;
+    ctx->path[plen] = 0;
+    return rc ? DIRENT_ABORT : 0;
+}
+
+static int walk_dir(walk_ctx_t* ctx, ext2_ino_t dir) {
+    errcode_t rc = ext2fs_dir_iterate2(ctx->fs, dir, 0, NULL, walk_cb, ctx);
+    if (ctx->what) return -1;
+    if (rc) { ctx->rc = rc; ctx->what = "dir_iterate failed"; return -1; }
+    return 0;
+}
+
+static int do_walk(void* fs_handle, const char* abs_path, uint32_t* inos, uint32_t max_entries, char* paths,
+                   uint64_t paths_cap, uint32_t* out_count, uint64_t* out_paths_len, char* err, int errlen) {
+    if (!fs_handle || !out_count || !out_paths_len || (max_entries && !inos) || (paths_cap && !paths)) {
+        set_err(err, errlen, "bad args"); return -1;
+    }
+    *out_count = 0; *out_paths_len = 0;
+    shim_fs_t* h = (shim_fs_t*)fs_handle;
+    const char* path = (abs_path && abs_path[0]) ? abs_path : "/";
+    ext2_ino_t ino = 0;
+    if (path_to_ino(h->fs, path, &ino, err, errlen)) return -1;
+
+    walk_ctx_t* ctx = (walk_ctx_t*)calloc(1, sizeof(walk_ctx_t));
+    if (!ctx) { set_err(err, errlen, "out of memory"); return -1; }
+    ctx->fs = h->fs;
+    ctx->inos = inos; ctx->max_entries = max_entries;
+    ctx->paths = paths; ctx->paths_cap = paths_cap;
+    // normalized path without a trailing slash ("/" stays)
+    for (const char* p = path; *p && ctx->plen < DU_PATH_MAX - 1; ++p)
+        if (*p != '/' || (ctx->plen == 0 || ctx->path[ctx->plen - 1] != '/')) ctx->path[ctx->plen++] = *p;
+    if (ctx->plen > 1 && ctx->path[ctx->plen - 1] == '/') ctx->plen--;
+    ctx->path[ctx->plen] = 0;
+
+    int ret = walk_dir(ctx, ino);
+    if (ret) {
+        if (ctx->rc) set_err_rc(err, errlen, ctx->what, ctx->rc);
+        else set_err(err, errlen, ctx->what);
+    } else if (ctx->count > max_entries || ctx->paths_len > paths_cap) {
+        set_err(err, errlen, "buffer too small");
+        ret = -1;
+    } else {
+        set_err(err, errlen, NULL);
+    }
+    *out_count = ctx->count;
+    *out_paths_len = ctx->paths_len;
+    free(ctx);
+    return ret;
+}
+
+SHIM_API int ext4_walk(void* fs_handle, const char* abs_path, uint32_t* inos, uint32_t max_entries, char* paths,
+                       uint64_t paths_cap, uint32_t* out_count, uint64_t* out_paths_len, char* err, int errlen) {
+    SHIM_TIMED(fs_handle, OP_WALK, do_walk(fs_handle, abs_path, inos, max_entries, paths, paths_cap,
+                                           out_count, out_paths_len, err, errlen));
+}
+
+// One 64-bit fingerprint per inode of where its data lives: XXH64 over the
+// merged (lblk, pblk, len) runs, so extent-mapped and block-mapped files with
+// the same placement agree. Inline data and fast symlinks have no blocks and
+// fingerprint the in-inode bytes instead. Equal size, mtime and fingerprint
+// on two images means the data was not rewritten; 0 is written for inodes
+// that are not in use.
+static int do_map_digest(void* fs_handle, const uint32_t* inos, uint32_t count, uint64_t* out, char* err, int errlen) {
+    if (!fs_handle || (count && (!inos || !out))) { set_err(err, errlen, "bad args"); return -1; }
+    shim_fs_t* h = (shim_fs_t*)fs_handle;
+    ext2_filsys fs = h->fs;
+    copy_ctx_t cx; memset(&cx, 0, sizeof(cx));
+    int ret = 0;
+    for (uint32_t i = 0; i < count && !ret; ++i) {
+        out[i] = 0;
+        if (!inos[i] || inos[i] > fs->super->s_inodes_count) continue;
+        struct ext2_inode in; memset(&in, 0, sizeof(in));
+        errcode_t rc = ext2fs_read_inode(fs, inos[i], &in);
+        if (rc) { set_err_rc(err, errlen, "read_inode failed", rc); ret = -1; break; }
+        if (!in.i_links_count || in.i_dtime) continue;
+        xxh64_ctx_t x; xxh64_init(&x);
+        uint64_t size = EXT2_I_SIZE(&in);
+        xxh64_update(&x, (const uint8_t*)&size, sizeof(size));
+        if ((in.i_flags & EXT4_INLINE_DATA_FL) || ext2fs_is_fast_symlink(&in)) {
+            xxh64_update(&x, (const uint8_t*)in.i_block, sizeof(in.i_block));
+        } else if (!LINUX_S_ISDIR(in.i_mode)) {
+            if (collect_runs(fs, inos[i], &in, &cx, err, errlen)) { ret = -1; break; }
+            for (int r = 0; r < cx.count; ++r) {
+                uint64_t rec[3] = { cx.runs[r].lblk, cx.runs[r].pblk, cx.runs[r].len };
+                xxh64_update(&x, (const uint8_t*)rec, sizeof(rec));
+            }
+        }
+        out[i] = xxh64_final(&x) | 1;
+    }
+    free(cx.runs);
+    if (!ret) set_err(err, errlen, NULL);
+    return ret;
+}
+
+SHIM_API int ext4_map_digest(void* fs_handle, const uint32_t* inos, uint32_t count, uint64_t* out, char* err, int errlen) {
+    SHIM_TIMED(fs_handle, OP_MAP_DIGEST, do_map_digest(fs_handle, inos, count, out, err, errlen));
+}
@@ -0,0 +1,282 @@
+# ext4cli.py
+# Command-line front end for ext4fs: runs one command across many images.
+#
+#   python src/ext4cli.py ls / a.img b.img
+#   python src/ext4cli.py -j 8 --manifest images.txt hash /etc
+#   python src/ext4cli.py get /etc/hostname out/{image}.hostname *.img
+#
+# Each image is one job. Jobs run on a process pool whose workers each keep a
+# single Ext4FS (one loaded shim), and every finished job is written to stdout
+# as one JSON line with its result or error and open/op/close timings.
+import argparse
+import base64
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import asdict
+
+from ext4fs import Ext4FS
+
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+# commands that open the image read-write
+RW_COMMANDS = ('put', 'import-tree', 'import-tar', 'trim')
+
+_fs = None
+
+
+def parse_size(text):
+    """'64M', '2G', '4096' -> bytes."""
+    text = text.strip().upper().rstrip('B')
+    unit = text[-1:] if text[-1:] in SIZE_UNITS else ''
+    try:
+        return int(text[:len(text) - len(unit)]) * SIZE_UNITS[unit]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'bad size: {text!r}')
+
+
+def read_manifest(path):
+    """Image paths, one per line; blank lines and '#' comments are skipped."""
+    f = sys.stdin if path == '-' else open(path, encoding='utf-8')
+    try:
+        return [line.strip() for line in f if line.strip() and not line.lstrip().startswith('#')]
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def host_path(template, image):
+    """Expand {image} (image file name without extension) in a host path."""
+    return template.replace('{image}', os.path.splitext(os.path.basename(image))[0])
+
+
+# ---------- Commands (run inside a worker, image already open) ----------
+
+def cmd_ls(fs, args, image):
+    return [asdict(e) for e in fs.listdir(args.path) if e.name not in ('.', '..')]
+
+
+def cmd_stat(fs, args, image):
+    return asdict(fs.stat(args.path))
+
+
+def cmd_cat(fs, args, image):
+    data = fs.read(args.path)
+    try:
+        return {'size': len(data), 'data': data.decode('utf-8')}
+    except UnicodeDecodeError:
+        return {'size': len(data), 'data_b64': base64.b64encode(data).decode('ascii')}
+
+
+def cmd_get(fs, args, image):
+    data = fs.read(args.path)
+    dest = host_path(args.dest, image)
+    os.makedirs(os.path.dirname(os.path.abspath(dest)), exist_ok=True)
+    with open(dest, 'wb') as f:
+        f.write(data)
+    return {'dest': dest, 'bytes': len(data)}
+
+
+def cmd_put(fs, args, image):
+    with open(args.src, 'rb') as f:
+        data = f.read()
+    fs.write_overwrite(args.path, data, args.mode)
+    return {'bytes': len(data)}
+
+
+def cmd_import_tree(fs, args, image):
+    files, nbytes = fs.import_tree(args.src, args.path)
+    return {'files': files, 'bytes': nbytes}
+
+
+def cmd_extract_tree(fs, args, image):
+    dest = host_path(args.dest, image)
+    files, nbytes = fs.extract_tree(args.path, dest)
+    return {'dest': dest, 'files': files, 'bytes': nbytes}
+
+
+def cmd_export_tar(fs, args, image):
+    dest = host_path(args.dest, image)
+    os.makedirs(os.path.dirname(os.path.abspath(dest)), exist_ok=True)
+    with open(dest, 'wb') as f:
+        return dict(fs.export_tar(args.path, f), dest=dest)
+
+
+def cmd_import_tar(fs, args, image):
+    with open(args.src, 'rb') as f:
+        return fs.import_tar(f, args.path)
+
+
+def cmd_hash(fs, args, image):
+    if fs.stat(args.path).is_dir:
+        # the pool already spreads images over cores; stay on this handle's worker
+        return fs.hash_tree(args.path, args.algo, workers=1)
+    return {args.path: fs.hash(args.path, args.algo)}
+
+
+def cmd_du(fs, args, image):
+    return fs.du(args.path, args.top)
+
+
+def cmd_diff(fs, args, image):
+    other = host_path(args.other, image)
+    return [asdict(e) for e in fs.diff(other, args.algo, verify=args.verify)]
+
+
+def cmd_clone(fs, args, image):
+    return fs.clone_image(host_path(args.dest, image), args.size)
+
+
+def cmd_trim(fs, args, image):
+    return fs.trim(args.min_bytes, zero_fill=args.zero_fill)
+
+
+def cmd_mkfs(fs, args, image):
+    Ext4FS.mkfs(image, args.size, block_size=args.block_size, label=args.label,
+                dll_path=args.dll, legacy_layout=args.legacy_layout, inline_data=args.inline_data)
+    return {'size': args.size}
+
+
+COMMANDS = {
+    'ls': cmd_ls, 'stat': cmd_stat, 'cat': cmd_cat, 'get': cmd_get, 'put': cmd_put,
+    'import-tree': cmd_import_tree, 'extract-tree': cmd_extract_tree,
+    'export-tar': cmd_export_tar, 'import-tar': cmd_import_tar,
+    'hash': cmd_hash, 'du': cmd_du, 'diff': cmd_diff, 'clone': cmd_clone, 'trim': cmd_trim, 'mkfs': cmd_mkfs,
+}
+
+
+# ---------- Worker ----------
+
+def _init_worker(dll_path):
+    global _fs
+    _fs = Ext4FS(dll_path)
+
+
+def run_job(args, image):
+    """Run args.command against one image; returns the JSON-lines record."""
+    if _fs is None:
+        _init_worker(args.dll)
+    rec = {'image': image, 'command': args.command, 'pid': os.getpid()}
+    t0 = time.perf_counter()
+    opened = False
+    try:
+        if args.command != 'mkfs':
+            _fs.open(image, rw=args.command in RW_COMMANDS)
+            opened = True
+        t1 = time.perf_counter()
+        rec['result'] = COMMANDS[args.command](_fs, args, image)
+        t2 = time.perf_counter()
+        if args.stats and opened:
+            rec['stats'] = {k: v for k, v in _fs.stats().items() if k != 'ops'}
+        if opened:
+            opened = False
+            _fs.close()
+        t3 = time.perf_counter()
+        rec['ok'] = True
+        rec['open_ms'] = round((t1 - t0) * 1e3, 3)
+        rec['op_ms'] = round((t2 - t1) * 1e3, 3)
+        rec['close_ms'] = round((t3 - t2) * 1e3, 3)
+    except Exception as e:
+        # any failure stays with its image; the other jobs still report
+        rec['ok'] = False
+        rec['error'] = str(e)
+        rec['error_type'] = type(e).__name__
+    finally:
+        if opened:
+            _fs.close()
+    rec['total_ms'] = round((time.perf_counter() - t0) * 1e3, 3)
+    return rec
+
+
+# ---------- Entry point ----------
+
+def build_parser():
+    p = argparse.ArgumentParser(prog='ext4fs', description='Run an ext4fs command across many images.')
+    p.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                   help='worker processes (default: CPU count; 1 runs in-process)')
+    p.add_argument('--manifest', help="file listing image paths, one per line ('-' for stdin)")
+    p.add_argument('--dll', help='path to ext4shim.dll / libext4shim.so')
+    p.add_argument('--stats', action='store_true', help='include shim I/O counters in each record')
+    sub = p.add_subparsers(dest='command', required=True)
+
+    def add(name, help, *positionals):
+        sp = sub.add_parser(name, help=help)
+        for arg, arg_help in positionals:
+            sp.add_argument(arg, help=arg_help)
+        sp.add_argument('images', nargs='*', metavar='IMAGE')
+        return sp
+
+    add('ls', 'list a directory', ('path', 'directory in the image'))
+    add('stat', 'stat a path', ('path', 'path in the image'))
+    add('cat', 'read a file into the record', ('path', 'file in the image'))
+    add('get', 'copy a file out', ('path', 'file in the image'),
+        ('dest', 'host file; {image} expands to the image name'))
+    put = add('put', 'copy a host file in', ('src', 'host file'), ('path', 'destination in the image'))
+    put.add_argument('--mode', type=lambda s: int(s, 8), default=0o644, help='octal permissions')
+    add('import-tree', 'copy a host directory tree in', ('src', 'host directory'),
+        ('path', 'destination directory in the image'))
+    add('extract-tree', 'copy a directory tree out', ('path', 'directory in the image'),
+        ('dest', 'host directory; {image} expands to the image name'))
+    add('export-tar', 'stream a directory tree out as a tar archive', ('path', 'directory in the image'),
+        ('dest', 'host tar file or FIFO; {image} expands to the image name'))
+    add('import-tar', 'unpack a tar archive (plain or compressed) into the image',
+        ('src', 'host tar file or FIFO'), ('path', 'destination directory in the image'))
+    h = add('hash', 'hash a file or every file under a directory', ('path', 'path in the image'))
+    h.add_argument('--algo', choices=Ext4FS.HASH_ALGOS, default='sha256')
+    d = add('du', 'disk usage of a subtree, per directory', ('path', 'path in the image'))
+    d.add_argument('--top', type=int, default=20, help='how many of the largest files to list')
+    df = add('diff', 'list paths added, removed or modified in another image',
+             ('other', 'newer image; {image} expands to the image name'))
+    df.add_argument('--algo', choices=Ext4FS.HASH_ALGOS, default='xxh64', help='hash for same-size files')
+    df.add_argument('--verify', action='store_true', help='hash every same-size file, not just changed ones')
+    c = add('clone', 'copy the used blocks into a new sparse image',
+            ('dest', 'new image file; {image} expands to the image name'))
+    c.add_argument('--size', type=parse_size, help='grow the clone to this size')
+    t = add('trim', 'punch holes in the image files for free space')
+    t.add_argument('--min-bytes', type=parse_size, default=64 * 1024, help='smallest free run to trim')
+    t.add_argument('--zero-fill', action='store_true', help='write zeros instead of punching holes')
+    m = add('mkfs', 'create new images')
+    m.add_argument('--size', type=parse_size, required=True, help='image size, e.g. 64M or 2G')
+    m.add_argument('--block-size', type=int, default=4096)
+    m.add_argument('--label', default='')
+    m.add_argument('--legacy-layout', action='store_true', help='block-map layout without extents')
+    m.add_argument('--inline-data', action='store_true', help='store files up to 128 bytes inside the inode')
+    return p
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    images = list(args.images)
+    if args.manifest:
+        images += read_manifest(args.manifest)
+    if not images:
+        parser.error('no images given (pass paths or --manifest)')
+    dest = getattr(args, 'dest', None)
+    if dest and len(images) > 1 and '{image}' not in dest:
+        parser.error('with several images the destination must contain {image}')
+
+    failed = 0
+
+    def emit(rec):
+        nonlocal failed
+        failed += not rec['ok']
+        sys.stdout.write(json.dumps(rec, ensure_ascii=False) + '\n')
+        sys.stdout.flush()
+
+    jobs = max(1, min(args.jobs, len(images)))
+    if jobs == 1:
+        for image in images:
+            emit(run_job(args, image))
+    else:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                                 initargs=(args.dll,)) as pool:
+            futures = [pool.submit(run_job, args, image) for image in images]
+            for fut in as_completed(futures):
+                emit(fut.result())
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,10 +5,20 @@ from __future__ import annotations
 
 import ctypes as C
 import json
+import mmap
 import os
+import re
+import struct
 import sys
-from dataclasses import dataclass
-from typing import List, Optional, Tuple
+import tarfile
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
+from fnmatch import fnmatchcase
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
 
 # ---------- Errors ----------
@@ -27,13 +37,16 @@ def _b(s: Optional[str]) -> C.c_char_p:
     return C.c_char_p(s.encode("utf-8", errors="strict"))
 
 
+_SHIM_NAME = "ext4shim.dll" if os.name == "nt" else "libext4shim.so"
+
+
 def _load_dll(explicit_path: Optional[str] = None) -> C.CDLL:
     """
-    Load ext4shim.dll. Search order:
+    Load ext4shim.dll (libext4shim.so on Linux). Search order:
     1. explicit_path (if given)
     2. ENV EXT4SHIM_DLL
-    3. ./native/ext4shim/bin/ext4shim.dll relative to this file
-    4. ./ext4shim.dll (cwd)
+    3. ./native/ext4shim/bin/<shim> relative to this file
+    4. ./<shim> (cwd)
     """
     candidates: List[str] = []
     if explicit_path:
@@ -43,20 +56,21 @@ def _load_dll(explicit_path: Optional[str] = None) -> C.CDLL:
         candidates.append(envp)
 
     here = os.path.abspath(os.path.dirname(__file__))
-    candidates.append(os.path.join(here, "..", "native", "ext4shim", "bin", "ext4shim.dll"))
-    candidates.append(os.path.join(here, "ext4shim.dll"))
-    candidates.append(os.path.join(os.getcwd(), "ext4shim.dll"))
+    candidates.append(os.path.join(here, "..", "native", "ext4shim", "bin", _SHIM_NAME))
+    candidates.append(os.path.join(here, _SHIM_NAME))
+    candidates.append(os.path.join(os.getcwd(), _SHIM_NAME))
 
+    # WinDLL for stdcall-like semantics; our shim uses C-style exports: WinDLL is fine.
+    loader = C.WinDLL if os.name == "nt" else C.CDLL
     for p in candidates:
         p = os.path.abspath(p)
         if os.path.exists(p):
             try:
-                # WinDLL for stdcall-like semantics; our shim uses C-style exports: WinDLL is fine.
-                return C.WinDLL(p)
+                return loader(p)
             except Exception as e:
                 last_err = f"Failed to load '{p}': {e}"
                 continue
-    raise Ext4Error("ext4shim.dll not found. Set EXT4SHIM_DLL or put DLL under native/ext4shim/bin/.")
+    raise Ext4Error(f"{_SHIM_NAME} not found. Set EXT4SHIM_DLL or put it under native/ext4shim/bin/.")
 
 
 # ---------- ctypes bindings ----------
@@ -94,14 +108,100 @@ def _bind(dll: C.CDLL):
     dll.ext4_remove.argtypes = [C.c_void_p, C.c_char_p, C.c_char_p, C.c_int]
     dll.ext4_remove.restype = C.c_int
 
+    # int ext4_rmtree(void* fs_handle, const char* abs_path, char* err, int errlen)
+    dll.ext4_rmtree.argtypes = [C.c_void_p, C.c_char_p, C.c_char_p, C.c_int]
+    dll.ext4_rmtree.restype = C.c_int
+
     # int ext4_rename(void* fs_handle, const char* old_abs_path, const char* new_basename, char* err, int errlen)
     dll.ext4_rename.argtypes = [C.c_void_p, C.c_char_p, C.c_char_p, C.c_char_p, C.c_int]
     dll.ext4_rename.restype = C.c_int
 
+    # int ext4_move(void* fs_handle, const char* src_abs_path, const char* dst_abs_path, int flags, char* err, int errlen)
+    dll.ext4_move.argtypes = [C.c_void_p, C.c_char_p, C.c_char_p, C.c_int, C.c_char_p, C.c_int]
+    dll.ext4_move.restype = C.c_int
+
+    # int ext4_copy(void* fs_handle, const char* src_abs_path, const char* dst_abs_path, char* err, int errlen)
+    dll.ext4_copy.argtypes = [C.c_void_p, C.c_char_p, C.c_char_p, C.c_char_p, C.c_int]
+    dll.ext4_copy.restype = C.c_int
+
+    # int ext4_copytree(void* fs_handle, const char* src_abs_path, const char* dst_abs_path, char* err, int errlen)
+    dll.ext4_copytree.argtypes = [C.c_void_p, C.c_char_p, C.c_char_p, C.c_char_p, C.c_int]
+    dll.ext4_copytree.restype = C.c_int
+
     # int ext4_mkfs(const char* target_path, uint64_t image_bytes, uint32_t block_size, const char* label, const char* opt_uuid, char* err, int errlen)
     dll.ext4_mkfs.argtypes = [C.c_char_p, C.c_uint64, C.c_uint32, C.c_char_p, C.c_char_p, C.c_char_p, C.c_int]
     dll.ext4_mkfs.restype = C.c_int
 
+    # int ext4_mkfs_ex(const char* target_path, uint64_t image_bytes, uint32_t block_size, const char* label, const char* opt_uuid, uint32_t flags, char* err, int errlen)
+    dll.ext4_mkfs_ex.argtypes = [C.c_char_p, C.c_uint64, C.c_uint32, C.c_char_p, C.c_char_p, C.c_uint32, C.c_char_p, C.c_int]
+    dll.ext4_mkfs_ex.restype = C.c_int
+
+    # int ext4_scan_inodes(void* fs_handle, uint32_t group_start, uint32_t group_end, uint32_t* cursor, void* cols, uint32_t cap, uint32_t* out_count, uint32_t* out_groups, char* err, int errlen)
+    dll.ext4_scan_inodes.argtypes = [C.c_void_p, C.c_uint32, C.c_uint32, C.POINTER(C.c_uint32), C.c_void_p, C.c_uint32,
+                                     C.POINTER(C.c_uint32), C.POINTER(C.c_uint32), C.c_char_p, C.c_int]
+    dll.ext4_scan_inodes.restype = C.c_int
+
+    # int ext4_submit(void* fs_handle, const uint8_t* ops, uint64_t ops_len, uint32_t count, int32_t* status, uint32_t flags, char* err, int errlen)
+    dll.ext4_submit.argtypes = [C.c_void_p, C.c_char_p, C.c_uint64, C.c_uint32, C.POINTER(C.c_int32),
+                                C.c_uint32, C.c_char_p, C.c_int]
+    dll.ext4_submit.restype = C.c_int
+
+    # int ext4_trim(void* fs_handle, uint64_t min_bytes, uint32_t flags, uint64_t* out_trimmed, uint64_t* out_reclaimed, char* err, int errlen)
+    dll.ext4_trim.argtypes = [C.c_void_p, C.c_uint64, C.c_uint32, C.POINTER(C.c_uint64), C.POINTER(C.c_uint64),
+                              C.c_char_p, C.c_int]
+    dll.ext4_trim.restype = C.c_int
+
+    # int ext4_clone(void* fs_handle, const char* dst_path, uint64_t new_size_bytes, uint64_t* out_copied, uint64_t* out_size, char* err, int errlen)
+    dll.ext4_clone.argtypes = [C.c_void_p, C.c_char_p, C.c_uint64, C.POINTER(C.c_uint64), C.POINTER(C.c_uint64),
+                               C.c_char_p, C.c_int]
+    dll.ext4_clone.restype = C.c_int
+
+    # int ext4_read_at(void* fs_handle, const char* abs_path, uint64_t offset, uint8_t* buf, uint64_t bufsize, uint64_t* out_read, char* err, int errlen)
+    dll.ext4_read_at.argtypes = [C.c_void_p, C.c_char_p, C.c_uint64, C.c_void_p, C.c_uint64, C.POINTER(C.c_uint64),
+                                 C.c_char_p, C.c_int]
+    dll.ext4_read_at.restype = C.c_int
+
+    # int ext4_du(void* fs_handle, const char* abs_path, uint32_t top_n, char* json_utf8, int buflen, char* err, int errlen)
+    dll.ext4_du.argtypes = [C.c_void_p, C.c_char_p, C.c_uint32, C.c_char_p, C.c_int, C.c_char_p, C.c_int]
+    dll.ext4_du.restype = C.c_int
+
+    # int ext4_walk(void* fs_handle, const char* abs_path, uint32_t* inos, uint32_t max_entries, char* paths, uint64_t paths_cap, uint32_t* out_count, uint64_t* out_paths_len, char* err, int errlen)
+    dll.ext4_walk.argtypes = [C.c_void_p, C.c_char_p, C.c_void_p, C.c_uint32, C.c_void_p, C.c_uint64,
+                              C.POINTER(C.c_uint32), C.POINTER(C.c_uint64), C.c_char_p, C.c_int]
+    dll.ext4_walk.restype = C.c_int
+
+    # int ext4_map_digest(void* fs_handle, const uint32_t* inos, uint32_t count, uint64_t* out, char* err, int errlen)
+    dll.ext4_map_digest.argtypes = [C.c_void_p, C.c_void_p, C.c_uint32, C.c_void_p, C.c_char_p, C.c_int]
+    dll.ext4_map_digest.restype = C.c_int
+
+    # int ext4_read_inodes(void* fs_handle, const uint32_t* inos, uint32_t count, void* cols, char* err, int errlen)
+    dll.ext4_read_inodes.argtypes = [C.c_void_p, C.c_void_p, C.c_uint32, C.c_void_p, C.c_char_p, C.c_int]
+    dll.ext4_read_inodes.restype = C.c_int
+
+    # int ext4_sync(void* fs_handle, int checkpoint, char* err, int errlen)
+    dll.ext4_sync.argtypes = [C.c_void_p, C.c_int, C.c_char_p, C.c_int]
+    dll.ext4_sync.restype = C.c_int
+
+    # int ext4_set_commit_interval(void* fs_handle, uint32_t ms)
+    dll.ext4_set_commit_interval.argtypes = [C.c_void_p, C.c_uint32]
+    dll.ext4_set_commit_interval.restype = C.c_int
+
+    # int ext4_fs_info(void* fs_handle, char* json_utf8, int buflen, char* err, int errlen)
+    dll.ext4_fs_info.argtypes = [C.c_void_p, C.c_char_p, C.c_int, C.c_char_p, C.c_int]
+    dll.ext4_fs_info.restype = C.c_int
+
+    # int ext4_hash(void* fs_handle, const char* abs_path, const char* algo, char* hex_out, int hexlen, char* err, int errlen)
+    dll.ext4_hash.argtypes = [C.c_void_p, C.c_char_p, C.c_char_p, C.c_char_p, C.c_int, C.c_char_p, C.c_int]
+    dll.ext4_hash.restype = C.c_int
+
+    # int ext4_get_stats(void* fs_handle, char* json_utf8, int buflen, char* err, int errlen)
+    dll.ext4_get_stats.argtypes = [C.c_void_p, C.c_char_p, C.c_int, C.c_char_p, C.c_int]
+    dll.ext4_get_stats.restype = C.c_int
+
+    # int ext4_reset_stats(void* fs_handle)
+    dll.ext4_reset_stats.argtypes = [C.c_void_p]
+    dll.ext4_reset_stats.restype = C.c_int
+
     return dll
 
 
@@ -129,6 +229,361 @@ class Stat:
     ctime: int
 
 
+@dataclass
+class IndexEntry:
+    path: str
+    inode: int
+    is_dir: bool
+    size: int
+    mode: int
+    mtime: int
+
+
+@dataclass
+class DiffEntry:
+    path: str
+    change: str                   # "added", "removed" or "modified"
+    is_dir: bool
+    fields: Tuple[str, ...] = ()  # for "modified": type, mode, owner, size, mtime, content
+
+
+# ---------- Path index ----------
+#
+# Sidecar file next to the image (<image>.idx) for name and size search
+# without walking directories. Native little-endian, every section 8-byte
+# aligned so it is used straight from an mmap:
+#
+#   header    magic, version, stamp (s_wtime, s_mnt_count, s_kbytes_written), count
+#   name_off  u64[count + 1]  offsets into names; entries are sorted by path
+#   size      u64[count]
+#   inode     u32[count]
+#   mode      u32[count]
+#   mtime     u32[count]
+#   by_size   u32[count]      entry numbers ordered by size
+#   names     UTF-8 paths, each followed by b"\n"
+#
+# Changes made through Ext4FS after the build are appended to <image>.idx.log
+# as JSON lines, each batch closed by the new superblock stamp, and overlay the
+# base table in queries. Once the overlay outgrows an eighth of the base it is
+# folded into a fresh base file.
+
+def _norm_path(p: str) -> str:
+    return "/" + "/".join(x for x in p.split("/") if x)
+
+
+def _is_dir_mode(mode: int) -> bool:
+    return (mode & 0o170000) == 0o040000
+
+
+def _glob_prefilter(pattern: str) -> bytes:
+    # Regex over the names blob matching a superset of basename globs: every
+    # bracket expression is widened to "any character", fnmatchcase decides.
+    out, i = [], 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == "*":
+            out.append(b"[^/\n]*")
+        elif c == "?":
+            out.append(b"[^/\n]")
+        elif c == "[" and "]" in pattern[i + 2:]:
+            i = pattern.index("]", i + 2)
+            out.append(b"[^/\n]")
+        else:
+            out.append(re.escape(c.encode("utf-8")))
+        i += 1
+    return b"/" + b"".join(out) + b"\n"
+
+
+class PathIndex:
+    MAGIC = b"E4PIDX\x00\x01"
+    VERSION = 1
+    COMPACT_MIN = 4096
+    # magic, version, mnt_count, count, wtime, kbytes_written, reserved
+    _HEADER = struct.Struct("<8sIIQQQQ")
+    _COLUMNS = (("size", "Q"), ("inode", "I"), ("mode", "I"), ("mtime", "I"), ("by_size", "I"))
+
+    def __init__(self, path: str, stamp: Tuple[int, int, int]):
+        self.path = path
+        self.log_path = path + ".log"
+        self.stamp = stamp
+        self.count = 0
+        self._file = None
+        self._mm: Optional[mmap.mmap] = None
+        self._views: List[memoryview] = []
+        self._cols: Dict[str, memoryview] = {}
+        self._offs: Optional[memoryview] = None
+        self._names: Optional[memoryview] = None
+        self._overlay: Dict[str, Optional[IndexEntry]] = {}
+        self._pending: List[str] = []
+
+    # ----- file format -----
+
+    @classmethod
+    def write(cls, path: str, entries: Iterable[IndexEntry], stamp: Tuple[int, int, int]):
+        """Write a base index of entries (sorted by path) and drop any change log."""
+        names = bytearray()
+        offs = array("Q", [0])
+        cols = {name: array(code) for name, code in cls._COLUMNS}
+        for e in entries:
+            names += e.path.encode("utf-8") + b"\n"
+            offs.append(len(names))
+            cols["size"].append(e.size)
+            cols["inode"].append(e.inode)
+            cols["mode"].append(e.mode)
+            cols["mtime"].append(e.mtime)
+        count = len(offs) - 1
+        sizes = cols["size"]
+        cols["by_size"] = array("I", sorted(range(count), key=sizes.__getitem__))
+        wtime, mnt_count, kbytes = stamp
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(cls._HEADER.pack(cls.MAGIC, cls.VERSION, mnt_count, count, wtime, kbytes, 0))
+            f.write(offs.tobytes())
+            for name, _ in cls._COLUMNS:
+                f.write(cols[name].tobytes())
+            f.write(b"\0" * (-f.tell() % 8))
+            f.write(names)
+        os.replace(tmp, path)
+        if os.path.exists(path + ".log"):
+            os.remove(path + ".log")
+
+    @classmethod
+    def load(cls, path: str, stamp: Tuple[int, int, int]) -> Optional["PathIndex"]:
+        """Open an index; None if it is missing, unreadable or stale for stamp."""
+        try:
+            f = open(path, "rb")
+        except OSError:
+            return None
+        hdr = f.read(cls._HEADER.size)
+        if len(hdr) < cls._HEADER.size:
+            f.close()
+            return None
+        magic, version, mnt_count, count, wtime, kbytes, _ = cls._HEADER.unpack(hdr)
+        if magic != cls.MAGIC or version != cls.VERSION:
+            f.close()
+            return None
+        idx = cls(path, (wtime, mnt_count, kbytes))
+        idx._map(f, count)
+        if not idx._replay_log() or idx.stamp != tuple(stamp):
+            idx.close()
+            return None
+        return idx
+
+    def _map(self, f, count: int):
+        self._file = f
+        self.count = count
+        self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        base = memoryview(self._mm)
+        self._views = [base]
+        pos = self._HEADER.size
+
+        def take(nbytes: int, code: Optional[str] = None) -> memoryview:
+            nonlocal pos
+            v = base[pos:pos + nbytes]
+            pos += nbytes
+            v = v.cast(code) if code else v
+            self._views.append(v)
+            return v
+
+        self._offs = take(8 * (count + 1), "Q")
+        for name, code in self._COLUMNS:
+            self._cols[name] = take(array(code).itemsize * count, code)
+        pos += -pos % 8
+        self._names = take(len(base) - pos)
+
+    def _replay_log(self) -> bool:
+        try:
+            with open(self.log_path, "r", encoding="utf-8") as f:
+                lines = [ln for ln in f.read().splitlines() if ln]
+        except FileNotFoundError:
+            return True
+        except OSError:
+            return False
+        try:
+            for ln in lines:
+                rec = json.loads(ln)
+                if "put" in rec:
+                    path, inode, size, mode, mtime = rec["put"]
+                    self._overlay[path] = IndexEntry(path, inode, _is_dir_mode(mode), size, mode, mtime)
+                elif "del" in rec:
+                    self._overlay[rec["del"]] = None
+                elif "stamp" in rec:
+                    self.stamp = tuple(rec["stamp"])
+        except (ValueError, KeyError, TypeError):
+            return False
+        # an interrupted commit leaves changes without a closing stamp
+        return not lines or "stamp" in json.loads(lines[-1])
+
+    def close(self):
+        for v in reversed(self._views):
+            v.release()
+        self._views, self._cols, self._offs, self._names = [], {}, None, None
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    # ----- base table access -----
+
+    def _raw(self, i: int) -> bytes:
+        return bytes(self._names[self._offs[i]:self._offs[i + 1] - 1])
+
+    def _entry(self, i: int, path: Optional[str] = None) -> IndexEntry:
+        mode = self._cols["mode"][i]
+        return IndexEntry(path if path is not None else self._raw(i).decode("utf-8"),
+                          self._cols["inode"][i], _is_dir_mode(mode),
+                          self._cols["size"][i], mode, self._cols["mtime"][i])
+
+    def _bisect(self, key: bytes) -> int:
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._raw(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _prefix_ids(self, prefix: bytes) -> Iterator[int]:
+        i = self._bisect(prefix)
+        while i < self.count and self._raw(i).startswith(prefix):
+            yield i
+            i += 1
+
+    def _collect(self, ids: Iterable[int], match, limit: Optional[int], key) -> List[IndexEntry]:
+        out = []
+        for i in ids:
+            path = self._raw(i).decode("utf-8")
+            if path in self._overlay or not match(path):
+                continue
+            out.append(self._entry(i, path))
+            if limit is not None and len(out) >= limit:
+                break
+        out.extend(e for e in self._overlay.values() if e is not None and match(e.path, e))
+        out.sort(key=key)
+        return out if limit is None else out[:limit]
+
+    # ----- queries -----
+
+    def __len__(self) -> int:
+        shadowed = sum(1 for p in self._overlay if self._find(p) is not None)
+        added = sum(1 for e in self._overlay.values() if e is not None)
+        return self.count - shadowed + added
+
+    def _find(self, path: str) -> Optional[int]:
+        key = path.encode("utf-8")
+        i = self._bisect(key)
+        return i if i < self.count and self._raw(i) == key else None
+
+    def lookup(self, path: str) -> Optional[IndexEntry]:
+        path = _norm_path(path)
+        if path in self._overlay:
+            return self._overlay[path]
+        i = self._find(path)
+        return None if i is None else self._entry(i, path)
+
+    def prefix(self, prefix: str, limit: Optional[int] = None) -> List[IndexEntry]:
+        """Entries whose path starts with prefix (plain string prefix), sorted by path."""
+        return self._collect(self._prefix_ids(prefix.encode("utf-8")),
+                             lambda p, e=None: p.startswith(prefix), limit, lambda e: e.path)
+
+    def glob(self, pattern: str, limit: Optional[int] = None) -> List[IndexEntry]:
+        """
+        fnmatch-style search sorted by path. A pattern containing "/" is
+        matched against the full path, anything else against the basename.
+        """
+        if "/" in pattern:
+            literal = re.split(r"[*?\[]", pattern, maxsplit=1)[0]
+            return self._collect(self._prefix_ids(literal.encode("utf-8")),
+                                 lambda p, e=None: fnmatchcase(p, pattern), limit, lambda e: e.path)
+        rx = re.compile(_glob_prefilter(pattern))
+        offs = self._offs
+        ids = (bisect_left(offs, m.end()) - 1 for m in rx.finditer(self._names))
+        return self._collect(ids, lambda p, e=None: fnmatchcase(p.rsplit("/", 1)[-1], pattern),
+                             limit, lambda e: e.path)
+
+    def size_range(self, min_size: int = 0, max_size: Optional[int] = None,
+                   limit: Optional[int] = None) -> List[IndexEntry]:
+        """Entries with min_size <= size <= max_size, ordered by size."""
+        sizes, order = self._cols["size"], self._cols["by_size"]
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if sizes[order[mid]] < min_size:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        def ids() -> Iterator[int]:
+            k = lo
+            while k < self.count and (max_size is None or sizes[order[k]] <= max_size):
+                yield order[k]
+                k += 1
+
+        def match(p: str, e: Optional[IndexEntry] = None) -> bool:
+            return e is None or (e.size >= min_size and (max_size is None or e.size <= max_size))
+
+        return self._collect(ids(), match, limit, lambda e: (e.size, e.path))
+
+    # ----- incremental updates -----
+
+    def put(self, entry: IndexEntry):
+        self._overlay[entry.path] = entry
+        self._pending.append(json.dumps({"put": [entry.path, entry.inode, entry.size, entry.mode, entry.mtime]}))
+
+    def _delete(self, path: str):
+        self._overlay[path] = None
+        self._pending.append(json.dumps({"del": path}))
+
+    def delete_tree(self, path: str) -> List[IndexEntry]:
+        """Drop path and everything below it; returns the dropped entries."""
+        path = _norm_path(path)
+        gone = [e for e in [self.lookup(path)] + self.prefix(path.rstrip("/") + "/") if e is not None]
+        for e in gone:
+            self._delete(e.path)
+        return gone
+
+    def move_tree(self, src: str, dst: str):
+        src, dst = _norm_path(src), _norm_path(dst)
+        for e in self.delete_tree(src):
+            self.put(replace(e, path=dst + e.path[len(src):]))
+
+    def commit(self, stamp: Tuple[int, int, int]):
+        """Persist pending changes under the image's new superblock stamp."""
+        self.stamp = tuple(stamp)
+        self._pending.append(json.dumps({"stamp": list(self.stamp)}))
+        with open(self.log_path, "a", encoding="utf-8") as f:
+            f.write("\n".join(self._pending) + "\n")
+        self._pending = []
+        if len(self._overlay) > max(self.COMPACT_MIN, self.count // 8):
+            self.compact()
+
+    def compact(self):
+        """Fold the change log into a new base file."""
+        entries = self.prefix("/")
+        self.close()
+        self.write(self.path, entries, self.stamp)
+        self._overlay = {}
+        f = open(self.path, "rb")
+        self._map(f, self._HEADER.unpack(f.read(self._HEADER.size))[3])
+
+
+class _ImageReader:
+    """Sequential read() over one image file for tarfile, via Ext4FS.read_at."""
+
+    def __init__(self, fs: "Ext4FS", abs_path: str):
+        self._fs, self._path, self._pos = fs, abs_path, 0
+
+    def read(self, size: int = -1) -> bytes:
+        if size < 0:
+            size = max(self._fs.stat(self._path).size - self._pos, 0)
+        data = self._fs.read_at(self._path, self._pos, size)
+        self._pos += len(data)
+        return data
+
+
 # ---------- Main class ----------
 
 class Ext4FS:
@@ -142,10 +597,27 @@ class Ext4FS:
         fs.close()
     """
     _ERRLEN = 512
+    HASH_ALGOS = ("crc32c", "sha256", "xxh64")
+    _MOVE_REPLACE = 0x1
+    _MKFS_LEGACY_LAYOUT = 0x1
+    _MKFS_INLINE_DATA = 0x2
+    _SUBMIT_STOP = 0x1
+    _SUBMIT_FLUSH_FAILED = -2  # ops ran and status is valid, the final flush failed
+    _TRIM_ZERO = 0x1
+    # submit() op names -> shim op codes
+    SUBMIT_OPS = {"mkdirs": 1, "write": 2, "remove": 3, "rmtree": 4, "rename": 5, "move": 6, "chmod": 7,
+                  "append": 8, "setattr": 9}
+    # scan_inodes columns in the order the shim lays them out
+    SCAN_COLUMNS = (("size", "Q"), ("blocks", "Q"), ("ino", "I"), ("mode", "I"), ("uid", "I"),
+                    ("gid", "I"), ("links", "I"), ("flags", "I"), ("atime", "I"), ("mtime", "I"),
+                    ("ctime", "I"))
 
     def __init__(self, dll_path: Optional[str] = None):
+        self._dll_path = dll_path
         self._dll = _bind(_load_dll(dll_path))
         self._handle = C.c_void_p(0)
+        self._image_path: Optional[str] = None
+        self._index: Optional[PathIndex] = None
 
     # context manager
     def __enter__(self) -> "Ext4FS":
@@ -165,14 +637,34 @@ class Ext4FS:
 
     # ----- API -----
 
-    def open(self, image_path: str, rw: bool = True):
+    def open(self, image_path: str, rw: bool = True, commit_interval: float = 0.0):
+        """
+        Open an image. Read-write handles replay a journal left by a crash
+        (read-only ones replay it in memory, leaving the image file as it
+        is) and then log metadata changes through it; commit_interval (seconds)
+        groups the ops of that long into one journal transaction instead of
+        committing at the end of each op (see sync()).
+        """
         err = self._errbuf()
         h = C.c_void_p()
         rc = self._dll.ext4_open(_b(image_path), 1 if rw else 0, C.byref(h), err, self._ERRLEN)
         self._raise_if_err(rc, err, "open failed")
         self._handle = h
+        if rw and commit_interval > 0:
+            self._dll.ext4_set_commit_interval(h, int(commit_interval * 1000))
+        self._image_path = image_path
+        idx_path = image_path + ".idx"
+        self._index = PathIndex.load(idx_path, self._stamp()) if os.path.exists(idx_path) else None
 
     def close(self):
+        if self._index:
+            if self._handle and self._handle.value:
+                # grouped ops commit now; keep the index stamp in step
+                self.sync()
+                if self._stamp() != self._index.stamp:
+                    self._index_commit()
+            self._index.close()
+            self._index = None
         if self._handle and self._handle.value:
             try:
                 self._dll.ext4_close(self._handle)
@@ -181,7 +673,7 @@ class Ext4FS:
 
     def listdir(self, abs_path: str = "/") -> List[DirEntry]:
         bufsize = 64 * 1024
-        for attempt in range(5):
+        while True:
             json_buf = C.create_string_buffer(bufsize)
             err = self._errbuf()
             rc = self._dll.ext4_listdir(self._handle, _b(abs_path), json_buf, bufsize, err, self._ERRLEN)
@@ -194,11 +686,10 @@ class Ext4FS:
                     raise Ext4Error(f"listdir JSON parse failed: {e}\nRaw: {data[:2000]}")
             # retry on buffer errors
             msg = err.value.decode("utf-8", "ignore")
-            if "buffer too small" in msg.lower() and bufsize < 8 * 1024 * 1024:
+            if "buffer too small" in msg.lower() and bufsize < 256 * 1024 * 1024:
                 bufsize *= 2
                 continue
             self._raise_if_err(rc, err, "listdir failed")
-        raise Ext4Error("listdir failed: ran out of retries")
 
     def stat(self, abs_path: str = "/") -> Stat:
         bufsize = 2048
@@ -221,13 +712,26 @@ class Ext4FS:
                 raise Ext4Error("Cannot read a directory")
             size_hint = max(int(st.size), 0)
 
-        buf = (C.c_uint8 * int(size_hint))()
+        buf = C.create_string_buffer(int(size_hint))
         out_read = C.c_uint64(0)
         err = self._errbuf()
         rc = self._dll.ext4_read(self._handle, _b(abs_path), C.cast(buf, C.c_void_p),
                                  C.c_uint64(size_hint), C.byref(out_read), err, self._ERRLEN)
         self._raise_if_err(rc, err, "read failed")
-        return bytes(buf[: int(out_read.value)])
+        # string_at is a single memcpy; slicing the ctypes array built a list of ints
+        return C.string_at(buf, int(out_read.value))
+
+    def read_at(self, abs_path: str, offset: int, size: int) -> bytes:
+        """
+        Read up to size bytes starting at offset; b"" at or past EOF.
+        """
+        buf = C.create_string_buffer(int(size))
+        out_read = C.c_uint64(0)
+        err = self._errbuf()
+        rc = self._dll.ext4_read_at(self._handle, _b(abs_path), C.c_uint64(offset), C.cast(buf, C.c_void_p),
+                                    C.c_uint64(size), C.byref(out_read), err, self._ERRLEN)
+        self._raise_if_err(rc, err, "read_at failed")
+        return C.string_at(buf, int(out_read.value))
 
     def write_overwrite(self, abs_path: str, data: bytes, mode: int = 0o644):
         if isinstance(data, memoryview):
@@ -239,35 +743,759 @@ class Ext4FS:
                                             C.c_uint16(mode & 0o777),
                                             err, self._ERRLEN)
         self._raise_if_err(rc, err, "write_overwrite failed")
+        if self._index:
+            self._index_put(abs_path)
 
     def mkdirs(self, abs_path: str, mode: int = 0o755):
         err = self._errbuf()
         rc = self._dll.ext4_mkdirs(self._handle, _b(abs_path), C.c_uint16(mode & 0o777), err, self._ERRLEN)
         self._raise_if_err(rc, err, "mkdirs failed")
+        if self._index:
+            self._index_put(abs_path)
 
     def remove(self, abs_path: str):
+        """
+        Remove a file or an empty directory, freeing its blocks and inode
+        once the last link is gone.
+        """
         err = self._errbuf()
         rc = self._dll.ext4_remove(self._handle, _b(abs_path), err, self._ERRLEN)
         self._raise_if_err(rc, err, "remove failed")
+        if self._index:
+            self._index.delete_tree(abs_path)
+            self._index_commit()
+
+    def rmtree(self, abs_path: str):
+        """
+        Remove a file or a whole directory tree in one native pass with a single flush.
+        """
+        err = self._errbuf()
+        rc = self._dll.ext4_rmtree(self._handle, _b(abs_path), err, self._ERRLEN)
+        self._raise_if_err(rc, err, "rmtree failed")
+        if self._index:
+            self._index.delete_tree(abs_path)
+            self._index_commit()
 
     def rename(self, old_abs_path: str, new_basename: str):
         err = self._errbuf()
         rc = self._dll.ext4_rename(self._handle, _b(old_abs_path), _b(new_basename), err, self._ERRLEN)
         self._raise_if_err(rc, err, "rename failed")
+        if self._index:
+            src = _norm_path(old_abs_path)
+            self._index.move_tree(src, src.rsplit("/", 1)[0] + "/" + new_basename)
+            self._index_put(src.rsplit("/", 1)[0] + "/" + new_basename)
+
+    def move(self, src_abs_path: str, dst_abs_path: str, replace: bool = False):
+        """
+        Move a file or directory to a new absolute path, possibly in another
+        directory. Only directory entries change; no data is copied.
+        With replace=True an existing file (or empty directory) at dst is
+        swapped out in place.
+        """
+        err = self._errbuf()
+        rc = self._dll.ext4_move(self._handle, _b(src_abs_path), _b(dst_abs_path),
+                                 self._MOVE_REPLACE if replace else 0, err, self._ERRLEN)
+        self._raise_if_err(rc, err, "move failed")
+        if self._index:
+            if replace:
+                self._index.delete_tree(dst_abs_path)
+            self._index.move_tree(src_abs_path, dst_abs_path)
+            self._index_put(dst_abs_path)
+
+    def copy(self, src_abs_path: str, dst_abs_path: str):
+        """
+        Copy a file (or symlink/special file) inside the image without a
+        round trip through Python. Holes, mode, owner, times and xattrs are kept.
+        """
+        err = self._errbuf()
+        rc = self._dll.ext4_copy(self._handle, _b(src_abs_path), _b(dst_abs_path), err, self._ERRLEN)
+        self._raise_if_err(rc, err, "copy failed")
+        if self._index:
+            self._index_put(dst_abs_path)
+
+    def copytree(self, src_abs_path: str, dst_abs_path: str):
+        """
+        Copy a whole directory tree natively; the image is flushed once at the end.
+        """
+        err = self._errbuf()
+        rc = self._dll.ext4_copytree(self._handle, _b(src_abs_path), _b(dst_abs_path), err, self._ERRLEN)
+        self._raise_if_err(rc, err, "copytree failed")
+        if self._index:
+            self._index_put(dst_abs_path, tree=True)
+
+    def submit(self, ops: Iterable[tuple], stop_on_error: bool = False) -> List[int]:
+        """
+        Run a batch of mutations in one shim call with a single flush.
+        Each op is a tuple:
+            ("mkdirs", path[, mode])      ("write", path, data[, mode])
+            ("remove", path)              ("rmtree", path)
+            ("rename", path, new_basename)
+            ("move", src, dst)            ("chmod", path, mode)
+            ("append", path, data)        ("setattr", path, mode, uid, gid, mtime)
+        Returns one status per op: 0 ok, -1 failed, 1 skipped after an earlier
+        failure (stop_on_error=True). Failed ops do not undo earlier ones.
+        A malformed batch raises before any op runs; if the final flush fails
+        the index still takes the ops that ran before Ext4Error is raised.
+        """
+        ops = list(ops)
+        parts: List[bytes] = []
+        for op in ops:
+            name, path = op[0], op[1].encode("utf-8")
+            arg, mode = b"", 0
+            if name == "mkdirs":
+                mode = op[2] if len(op) > 2 else 0o755
+            elif name == "write":
+                arg = bytes(op[2])
+                mode = (op[3] if len(op) > 3 else 0o644) & 0o777  # as write_overwrite
+            elif name in ("rename", "move"):
+                arg = op[2].encode("utf-8")
+            elif name == "chmod":
+                mode = op[2]
+            elif name == "append":
+                arg = bytes(op[2])
+            elif name == "setattr":
+                mode = op[2]
+                arg = struct.pack("<3I", op[3], op[4], int(op[5]))
+            elif name not in self.SUBMIT_OPS:
+                raise Ext4Error(f"unknown submit op: {name!r}")
+            rec = struct.pack("<4I", self.SUBMIT_OPS[name], mode & 0o7777, len(path), len(arg)) + path + arg
+            parts.append(rec + b"\0" * (-len(rec) % 8))
+        buf = b"".join(parts)
+        status = (C.c_int32 * max(len(ops), 1))()
+        err = self._errbuf()
+        rc = self._dll.ext4_submit(self._handle, buf, len(buf), len(ops), status,
+                                   self._SUBMIT_STOP if stop_on_error else 0, err, self._ERRLEN)
+        if rc < 0 and rc != self._SUBMIT_FLUSH_FAILED:
+            self._raise_if_err(rc, err, "submit failed")
+        result = list(status[:len(ops)])
+        if self._index:
+            self._index_apply(ops, result)
+        if rc == self._SUBMIT_FLUSH_FAILED:
+            self._raise_if_err(rc, err, "submit failed")
+        return result
+
+    def _index_apply(self, ops: List[tuple], status: List[int]):
+        # Replay a batch on the index. Paths to re-stat are collected first and
+        # carried through later moves/removes, since the image only shows the
+        # final state.
+        pending: Dict[str, None] = {}
+
+        def under(p: str, root: str) -> bool:
+            return p == root or p.startswith(root.rstrip("/") + "/")
+
+        for op, st in zip(ops, status):
+            if st != 0:
+                continue
+            name, path = op[0], _norm_path(op[1])
+            if name in ("rename", "move"):
+                dst = path.rsplit("/", 1)[0] + "/" + op[2] if name == "rename" else _norm_path(op[2])
+                self._index.move_tree(path, dst)
+                pending = {(dst + p[len(path):] if under(p, path) else p): None for p in pending}
+                pending[dst] = None
+            elif name in ("remove", "rmtree"):
+                self._index.delete_tree(path)
+                pending = {p: None for p in pending if not under(p, path)}
+            else:
+                pending[path] = None
+        for path in pending:
+            self._index_put(path, commit=False)
+        self._index_commit()
+
+    def import_tree(self, host_dir: str, abs_path: str) -> Tuple[int, int]:
+        """
+        Copy a host directory tree into the image under abs_path, keeping
+        permission bits. Returns (files, bytes) written.
+        """
+        files = nbytes = 0
+        root = abs_path.rstrip("/")
+        self.mkdirs(root or "/", os.stat(host_dir).st_mode)
+        for dirpath, dirnames, filenames in os.walk(host_dir):
+            rel = os.path.relpath(dirpath, host_dir).replace(os.sep, "/")
+            base = root if rel == "." else root + "/" + rel
+            for name in dirnames:
+                self.mkdirs(base + "/" + name, os.stat(os.path.join(dirpath, name)).st_mode)
+            for name in filenames:
+                host = os.path.join(dirpath, name)
+                with open(host, "rb") as f:
+                    data = f.read()
+                self.write_overwrite(base + "/" + name, data, os.stat(host).st_mode)
+                files += 1
+                nbytes += len(data)
+        return files, nbytes
+
+    def extract_tree(self, abs_path: str, host_dir: str) -> Tuple[int, int]:
+        """
+        Copy the directories and regular files under abs_path out to host_dir.
+        Returns (files, bytes) written.
+        """
+        files = nbytes = 0
+        stack = [(abs_path.rstrip("/") or "/", host_dir)]
+        while stack:
+            src, dst = stack.pop()
+            os.makedirs(dst, exist_ok=True)
+            for e in self.listdir(src):
+                if e.name in (".", ".."):
+                    continue
+                p = src.rstrip("/") + "/" + e.name
+                if e.is_dir:
+                    stack.append((p, os.path.join(dst, e.name)))
+                elif (e.mode & 0o170000) == 0o100000:
+                    data = self.read(p, e.size)
+                    with open(os.path.join(dst, e.name), "wb") as f:
+                        f.write(data)
+                    files += 1
+                    nbytes += len(data)
+        return files, nbytes
+
+    def export_tar(self, image_dir: str, fileobj, chunk_size: int = 1 << 20) -> dict:
+        """
+        Write the tree under image_dir to fileobj as a tar stream, reading file
+        data chunk_size bytes at a time. Names are relative to image_dir and
+        mode, owner and mtime are kept. Only directories and regular files are
+        archived; other entries are counted in "skipped". fileobj only needs
+        write(), so pipes and sockets work.
+        """
+        counts = {"files": 0, "dirs": 0, "bytes": 0, "skipped": 0}
+        root = _norm_path(image_dir)
+        with tarfile.open(fileobj=fileobj, mode="w|", copybufsize=chunk_size) as tar:
+            stack = [(root, "")]
+            while stack:
+                src, rel = stack.pop()
+                subdirs = []
+                for e in sorted(self.listdir(src), key=lambda e: e.name):
+                    if e.name in (".", ".."):
+                        continue
+                    p = src.rstrip("/") + "/" + e.name
+                    st = self.stat(p)
+                    ti = tarfile.TarInfo(rel + e.name)
+                    ti.mode, ti.uid, ti.gid, ti.mtime = st.mode & 0o7777, st.uid, st.gid, st.mtime
+                    if e.is_dir:
+                        ti.type = tarfile.DIRTYPE
+                        tar.addfile(ti)
+                        subdirs.append((p, rel + e.name + "/"))
+                        counts["dirs"] += 1
+                    elif (e.mode & 0o170000) == 0o100000:
+                        ti.size = st.size
+                        tar.addfile(ti, _ImageReader(self, p))
+                        counts["files"] += 1
+                        counts["bytes"] += st.size
+                    else:
+                        counts["skipped"] += 1
+                stack.extend(reversed(subdirs))
+        return counts
+
+    def import_tar(self, fileobj, image_dir: str, chunk_size: int = 1 << 20,
+                   batch_bytes: int = 16 << 20) -> dict:
+        """
+        Unpack a tar stream (plain, gz, bz2 or xz) from fileobj into image_dir
+        as it arrives. File data is sent in chunk_size pieces (a write, then
+        appends) through submit() batches of about batch_bytes, so memory stays
+        bounded and each batch is flushed once. Mode, owner and mtime are
+        applied. Links, devices and names escaping image_dir are counted in
+        "skipped". fileobj only needs read(), so pipes work.
+        """
+        counts = {"files": 0, "dirs": 0, "bytes": 0, "skipped": 0}
+        root = _norm_path(image_dir).rstrip("/")
+        ops: List[tuple] = []
+        dirs: List[Tuple[str, tarfile.TarInfo]] = []
+        queued = 0
+
+        def flush():
+            nonlocal queued
+            if ops:
+                status = self.submit(ops, stop_on_error=True)
+                if -1 in status:
+                    raise Ext4Error(f"import_tar failed at {ops[status.index(-1)][1]}")
+                ops.clear()
+            queued = 0
+
+        self.mkdirs(root or "/")
+        with tarfile.open(fileobj=fileobj, mode="r|*", copybufsize=chunk_size) as tar:
+            for m in tar:
+                parts = [x for x in m.name.split("/") if x not in ("", ".")]
+                if ".." in parts:
+                    counts["skipped"] += 1
+                    continue
+                dst = "/".join([root] + parts) or "/"
+                if m.isdir():
+                    if parts:
+                        ops.append(("mkdirs", dst, m.mode))
+                        counts["dirs"] += 1
+                    dirs.append((dst, m))
+                elif m.isreg():
+                    f = tar.extractfile(m)
+                    data = f.read(chunk_size)
+                    ops.append(("write", dst, data, m.mode))
+                    queued += len(data)
+                    while len(data) == chunk_size:
+                        if queued >= batch_bytes:
+                            flush()
+                        data = f.read(chunk_size)
+                        if data:
+                            ops.append(("append", dst, data))
+                            queued += len(data)
+                    ops.append(("setattr", dst, m.mode, m.uid, m.gid, m.mtime))
+                    counts["files"] += 1
+                    counts["bytes"] += m.size
+                else:
+                    counts["skipped"] += 1
+                if queued >= batch_bytes or len(ops) >= 4096:
+                    flush()
+        # directory times last, once nothing more is added inside them
+        for dst, m in reversed(dirs):
+            ops.append(("setattr", dst, m.mode, m.uid, m.gid, m.mtime))
+        flush()
+        return counts
+
+    def du(self, abs_path: str = "/", top_n: int = 20) -> dict:
+        """
+        Disk usage of a subtree in one native walk. Returns "size" (apparent,
+        i_size) and "alloc" (allocated bytes, i_blocks), "files", "dirs" and
+        "hardlinks" (extra links, counted once) for the whole subtree, plus
+        "dir_totals": one {"path", "size", "alloc", "files", "dirs"} per
+        directory, and "top": the top_n largest files by allocated bytes.
+        """
+        bufsize = 1024 * 1024
+        while True:
+            json_buf = C.create_string_buffer(bufsize)
+            err = self._errbuf()
+            rc = self._dll.ext4_du(self._handle, _b(abs_path), top_n, json_buf, bufsize, err, self._ERRLEN)
+            if rc == 0:
+                return json.loads(json_buf.value.decode("utf-8", "strict"))
+            msg = err.value.decode("utf-8", "ignore")
+            if "buffer too small" in msg.lower() and bufsize < 1024 * 1024 * 1024:
+                bufsize *= 4
+                continue
+            self._raise_if_err(rc, err, "du failed")
+
+    def walk(self, abs_path: str = "/") -> List[Tuple[str, int]]:
+        """
+        (path, inode) for everything below abs_path, from one native directory
+        walk: each directory is followed by its subtree, in directory order.
+        """
+        max_entries, paths_cap = 65536, 4 * 1024 * 1024
+        while True:
+            inos = array("I", bytes(4 * max_entries))
+            paths = C.create_string_buffer(paths_cap)
+            count, used = C.c_uint32(0), C.c_uint64(0)
+            err = self._errbuf()
+            ino_ptr, _ = inos.buffer_info()
+            rc = self._dll.ext4_walk(self._handle, _b(abs_path), ino_ptr, max_entries, paths, paths_cap,
+                                     C.byref(count), C.byref(used), err, self._ERRLEN)
+            if rc == 0:
+                break
+            msg = err.value.decode("utf-8", "ignore")
+            if "buffer too small" in msg.lower():
+                max_entries = max(max_entries, count.value)
+                paths_cap = max(paths_cap, used.value)
+                continue
+            self._raise_if_err(rc, err, "walk failed")
+        names = paths.raw[:used.value].decode("utf-8", "strict").split("\0")[:-1]
+        return list(zip(names, inos[:count.value]))
+
+    def _map_digests(self, inos: array) -> array:
+        out = array("Q", bytes(8 * len(inos)))
+        if inos:
+            err = self._errbuf()
+            rc = self._dll.ext4_map_digest(self._handle, inos.buffer_info()[0], len(inos),
+                                           out.buffer_info()[0], err, self._ERRLEN)
+            self._raise_if_err(rc, err, "map_digest failed")
+        return out
+
+    def hash(self, abs_path: str, algo: str = "sha256") -> str:
+        """
+        Hex digest of a file's content, computed inside the shim.
+        algo: "crc32c", "sha256" or "xxh64". Fails rather than digest a
+        file that cannot be read to its full size.
+        """
+        hex_buf = C.create_string_buffer(72)
+        err = self._errbuf()
+        rc = self._dll.ext4_hash(self._handle, _b(abs_path), _b(algo), hex_buf, 72, err, self._ERRLEN)
+        self._raise_if_err(rc, err, "hash failed")
+        return hex_buf.value.decode("ascii")
+
+    def hash_tree(self, abs_path: str = "/", algo: str = "sha256", workers: int = 4) -> Dict[str, str]:
+        """
+        Digests of every regular file under abs_path, keyed by absolute path.
+        Files are hashed across `workers` extra read-only handles on the same image.
+        """
+        if not self._image_path:
+            raise Ext4Error("hash_tree requires an open image")
+        files: List[str] = []
+        stack = [abs_path.rstrip("/") or "/"]
+        while stack:
+            d = stack.pop()
+            for e in self.listdir(d):
+                if e.name in (".", ".."):
+                    continue
+                p = (d.rstrip("/") + "/" + e.name)
+                if e.is_dir:
+                    stack.append(p)
+                elif (e.mode & 0o170000) == 0o100000:
+                    files.append(p)
+        if not files:
+            return {}
+
+        # the reader handles only see what has reached the image file
+        self.sync(checkpoint=True)
+        workers = max(1, min(int(workers), len(files)))
+        local = threading.local()
+        handles: List[Ext4FS] = []
+        lock = threading.Lock()
+
+        def _one(p: str) -> Tuple[str, str]:
+            fs = getattr(local, "fs", None)
+            if fs is None:
+                fs = Ext4FS(self._dll_path)
+                fs.open(self._image_path, rw=False)
+                local.fs = fs
+                with lock:
+                    handles.append(fs)
+            return p, fs.hash(p, algo)
+
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                return dict(pool.map(_one, files))
+        finally:
+            for fs in handles:
+                fs.close()
+
+    def scan_inodes(self, groups: Optional[Tuple[int, int]] = None,
+                    batch: int = 65536) -> Iterator[Dict[str, array]]:
+        """
+        Yield every in-use inode, read straight from the inode tables in disk
+        order, as columnar batches: dicts mapping each SCAN_COLUMNS name to an
+        array.array of up to `batch` entries (blocks are 512-byte units).
+        groups=(first, end) limits the scan to that half-open block group
+        range so several processes can split an image; see group_count().
+        """
+        first, end = groups if groups is not None else (0, 0xFFFFFFFF)
+        widths = [array(code).itemsize for _, code in self.SCAN_COLUMNS]
+        buf = C.create_string_buffer(batch * sum(widths))
+        cursor, count, ngroups = C.c_uint32(0), C.c_uint32(0), C.c_uint32(0)
+        while True:
+            err = self._errbuf()
+            rc = self._dll.ext4_scan_inodes(self._handle, first, end, C.byref(cursor), buf, batch,
+                                            C.byref(count), C.byref(ngroups), err, self._ERRLEN)
+            self._raise_if_err(rc, err, "scan_inodes failed")
+            n = count.value
+            if n:
+                view = memoryview(buf).cast("B")
+                cols, off = {}, 0
+                for (name, code), width in zip(self.SCAN_COLUMNS, widths):
+                    col = array(code)
+                    col.frombytes(view[off:off + n * width])
+                    cols[name] = col
+                    off += batch * width
+                yield cols
+            if not cursor.value:
+                return
+
+    def group_count(self) -> int:
+        """Number of block groups in the image (the unit scan_inodes() splits on)."""
+        cursor, count, ngroups = C.c_uint32(0), C.c_uint32(0), C.c_uint32(0)
+        err = self._errbuf()
+        rc = self._dll.ext4_scan_inodes(self._handle, 0, 0, C.byref(cursor), None, 0,
+                                        C.byref(count), C.byref(ngroups), err, self._ERRLEN)
+        self._raise_if_err(rc, err, "group_count failed")
+        return ngroups.value
+
+    def diff(self, other, algo: str = "xxh64", verify: bool = False) -> Iterator[DiffEntry]:
+        """
+        Compare this image (old) with `other` (new: an image path, opened
+        read-only for the duration, or an open Ext4FS) and yield a DiffEntry
+        per added, removed or modified path.
+
+        Both trees are walked together one directory pair at a time and
+        entries are yielded as they are found: depth first, each directory's
+        entries by name, each followed by its subtree. Only the directories
+        on the current path are held in memory. Files whose size, mtime,
+        ctime and block placement all match are taken as unchanged without
+        reading them; file contents are hashed (with `algo`) only when the
+        size matches but the rest does not. Timestamps have one-second
+        resolution, so a same-size rewrite in place within the same second
+        goes unseen unless verify=True, which hashes every same-size pair. A
+        "modified" entry lists what differs in `fields`.
+        """
+        other_fs = other if isinstance(other, Ext4FS) else None
+        if other_fs is None:
+            other_fs = Ext4FS(self._dll_path)
+            other_fs.open(other, rw=False)
+        try:
+            yield from self._diff(other_fs, algo, verify)
+        finally:
+            if other is not other_fs:
+                other_fs.close()
+
+    def _read_inodes(self, inos: array) -> Dict[str, array]:
+        # scan_inodes() columns for the given inode numbers
+        widths = [array(code).itemsize for _, code in self.SCAN_COLUMNS]
+        n = len(inos)
+        buf = C.create_string_buffer(max(n, 1) * sum(widths))
+        if n:
+            err = self._errbuf()
+            rc = self._dll.ext4_read_inodes(self._handle, inos.buffer_info()[0], n, buf, err, self._ERRLEN)
+            self._raise_if_err(rc, err, "read_inodes failed")
+        view = memoryview(buf).cast("B")
+        cols, off = {}, 0
+        for (name, code), width in zip(self.SCAN_COLUMNS, widths):
+            col = array(code)
+            col.frombytes(view[off:off + n * width])
+            cols[name] = col
+            off += n * width
+        return cols
+
+    def _diff_dir(self, d: str) -> Dict[str, DirEntry]:
+        return {e.name: e for e in self.listdir(d) if e.name not in (".", "..")}
+
+    def _diff(self, other: "Ext4FS", algo: str, verify: bool) -> Iterator[DiffEntry]:
+        # Stack of pending work, popped in output order: ("entry", DiffEntry),
+        # ("pair", path, old_meta, new_meta, maps) for a path on both sides,
+        # or ("dir", path, in_old, in_new) for a directory still to list.
+        stack: List[tuple] = [("dir", "/", True, True)]
+        while stack:
+            item = stack.pop()
+            if item[0] == "entry":
+                yield item[1]
+                continue
+            if item[0] == "pair":
+                entry = self._diff_pair(other, *item[1:], algo, verify)
+                if entry:
+                    yield entry
+                continue
+
+            _, d, in_old, in_new = item
+            old = self._diff_dir(d) if in_old else {}
+            new = other._diff_dir(d) if in_new else {}
+            common = [name for name in old if name in new]
+            metas = []
+            for fs, side in ((self, old), (other, new)):
+                cols = fs._read_inodes(array("I", (side[name].inode for name in common)))
+                metas.append(list(zip(cols["mode"], cols["uid"], cols["gid"], cols["size"],
+                                      cols["mtime"], cols["ctime"])))
+            # same-size non-directories: fingerprint block placement natively
+            # before deciding whether their contents need hashing
+            same = [i for i, (om, nm) in enumerate(zip(*metas)) if not _is_dir_mode(om[0]) and om[3] == nm[3]]
+            old_maps = self._map_digests(array("I", (old[common[i]].inode for i in same)))
+            new_maps = other._map_digests(array("I", (new[common[i]].inode for i in same)))
+            maps = {common[i]: (om, nm) for i, om, nm in zip(same, old_maps, new_maps)}
+            pair = {name: (om, nm) for name, om, nm in zip(common, *metas)}
+
+            prefix = d.rstrip("/") + "/"
+            items: List[tuple] = []
+            for name in sorted(old.keys() | new.keys()):
+                path = prefix + name
+                if name not in new:
+                    items.append(("entry", DiffEntry(path, "removed", old[name].is_dir)))
+                    if old[name].is_dir:
+                        items.append(("dir", path, True, False))
+                elif name not in old:
+                    items.append(("entry", DiffEntry(path, "added", new[name].is_dir)))
+                    if new[name].is_dir:
+                        items.append(("dir", path, False, True))
+                else:
+                    om, nm = pair[name]
+                    items.append(("pair", path, om, nm, maps.get(name)))
+                    old_dir, new_dir = _is_dir_mode(om[0]), _is_dir_mode(nm[0])
+                    if old_dir or new_dir:
+                        items.append(("dir", path, old_dir, new_dir))
+            stack.extend(reversed(items))
+
+    def _diff_pair(self, other: "Ext4FS", path: str, old_meta: tuple, new_meta: tuple,
+                   maps: Optional[Tuple[int, int]], algo: str, verify: bool) -> Optional[DiffEntry]:
+        mode, uid, gid, size, mtime, ctime = old_meta
+        nmode, nuid, ngid, nsize, nmtime, nctime = new_meta
+        is_dir = _is_dir_mode(mode)
+        if (mode & 0o170000) != (nmode & 0o170000):
+            return DiffEntry(path, "modified", is_dir, ("type",))
+        fields = []
+        if (mode & 0o7777) != (nmode & 0o7777):
+            fields.append("mode")
+        if (uid, gid) != (nuid, ngid):
+            fields.append("owner")
+        if not is_dir:
+            if size != nsize:
+                fields.append("size")
+            if mtime != nmtime:
+                fields.append("mtime")
+            if size != nsize:
+                fields.append("content")
+            elif (mtime, ctime) == (nmtime, nctime) and maps[0] == maps[1] and not verify:
+                pass
+            elif (mode & 0o170000) == 0o100000:
+                if self.hash(path, algo) != other.hash(path, algo):
+                    fields.append("content")
+            elif maps[0] != maps[1]:
+                # symlinks: the fingerprint of a fast symlink is its target
+                fields.append("content")
+        return DiffEntry(path, "modified", is_dir, tuple(fields)) if fields else None
+
+    def info(self) -> dict:
+        """
+        Superblock summary: label, uuid, block size, block/inode totals and
+        free counts, group count, and the write stamp (wtime, mnt_count,
+        kbytes_written).
+        """
+        bufsize = 1024
+        json_buf = C.create_string_buffer(bufsize)
+        err = self._errbuf()
+        rc = self._dll.ext4_fs_info(self._handle, json_buf, bufsize, err, self._ERRLEN)
+        self._raise_if_err(rc, err, "info failed")
+        return json.loads(json_buf.value.decode("utf-8", "strict"))
+
+    def _stamp(self) -> Tuple[int, int, int]:
+        info = self.info()
+        return info["wtime"], info["mnt_count"], info["kbytes_written"]
+
+    # ----- path index -----
+
+    @property
+    def index(self) -> Optional[PathIndex]:
+        """The image's path index (<image>.idx) if one exists and is current."""
+        return self._index
+
+    def build_index(self, index_path: Optional[str] = None) -> PathIndex:
+        """
+        Build the sidecar path index for the whole image and attach it; from
+        then on mutations made through this object keep it current.
+        """
+        mtimes: Dict[int, int] = {}
+        for batch in self.scan_inodes():
+            mtimes.update(zip(batch["ino"], batch["mtime"]))
+        entries = []
+        stack = ["/"]
+        while stack:
+            d = stack.pop()
+            for e in self.listdir(d):
+                if e.name in (".", ".."):
+                    continue
+                p = d.rstrip("/") + "/" + e.name
+                entries.append(IndexEntry(p, e.inode, e.is_dir, e.size, e.mode, mtimes.get(e.inode, 0)))
+                if e.is_dir:
+                    stack.append(p)
+        entries.sort(key=lambda e: e.path)
+        if self._index:
+            self._index.close()
+            self._index = None
+        path = index_path or self._image_path + ".idx"
+        stamp = self._stamp()
+        PathIndex.write(path, entries, stamp)
+        self._index = PathIndex.load(path, stamp)
+        return self._index
+
+    def _index_entry(self, path: str) -> IndexEntry:
+        st = self.stat(path)
+        return IndexEntry(path, st.inode, st.is_dir, st.size, st.mode, st.mtime)
+
+    def _index_put(self, abs_path: str, tree: bool = False, commit: bool = True):
+        # (re)index abs_path, the parents it may have created or grown and,
+        # with tree, its subtree
+        path = _norm_path(abs_path)
+        parts = path.split("/")
+        for i in range(2, len(parts)):
+            parent = "/".join(parts[:i])
+            if i == len(parts) - 1 or self._index.lookup(parent) is None:
+                self._index.put(self._index_entry(parent))
+        self._index.put(self._index_entry(path))
+        stack = [path] if tree else []
+        while stack:
+            d = stack.pop()
+            for e in self.listdir(d):
+                if e.name in (".", ".."):
+                    continue
+                p = d + "/" + e.name
+                self._index.put(self._index_entry(p))
+                if e.is_dir:
+                    stack.append(p)
+        if commit:
+            self._index_commit()
+
+    def _index_commit(self):
+        self._index.commit(self._stamp())
+
+    def sync(self, checkpoint: bool = False):
+        """
+        Commit the ops grouped so far (open(commit_interval=...)) as one
+        journal transaction. checkpoint=True also writes the journal back to
+        the filesystem proper, so that other handles and copies of the image
+        file see every change. No-op on read-only handles.
+        """
+        err = self._errbuf()
+        rc = self._dll.ext4_sync(self._handle, 1 if checkpoint else 0, err, self._ERRLEN)
+        self._raise_if_err(rc, err, "sync failed")
+
+    def stats(self) -> dict:
+        """
+        Shim counters for this handle: per-API calls and cumulative ns ("ops"),
+        namei/lookups, inode reads/writes, block reads/writes with byte totals,
+        flush count and time, and bitmap loads and time. Bitmaps are loaded
+        lazily, so ops["open"] is the bare open latency. "journal" is 1 once
+        metadata goes through the journal; journal_commits/journal_blocks
+        count transactions and blocks written to the log, checkpoints/
+        checkpoint_blocks the write-backs to the filesystem proper.
+        """
+        bufsize = 4096
+        json_buf = C.create_string_buffer(bufsize)
+        err = self._errbuf()
+        rc = self._dll.ext4_get_stats(self._handle, json_buf, bufsize, err, self._ERRLEN)
+        self._raise_if_err(rc, err, "stats failed")
+        return json.loads(json_buf.value.decode("utf-8", "strict"))
+
+    def reset_stats(self):
+        self._dll.ext4_reset_stats(self._handle)
+
+    def trim(self, min_bytes: int = 64 * 1024, zero_fill: bool = False) -> dict:
+        """
+        Give free space back to the host: punch holes in the image file for
+        every run of free blocks of at least min_bytes. zero_fill=True writes
+        zeros over those runs instead, for storage that cannot punch holes
+        (this allocates them on a sparse host file). Needs a read-write handle.
+        Returns {"trimmed": bytes covered, "reclaimed": drop in host allocation}.
+        """
+        trimmed, reclaimed = C.c_uint64(0), C.c_uint64(0)
+        err = self._errbuf()
+        rc = self._dll.ext4_trim(self._handle, C.c_uint64(min_bytes), self._TRIM_ZERO if zero_fill else 0,
+                                 C.byref(trimmed), C.byref(reclaimed), err, self._ERRLEN)
+        self._raise_if_err(rc, err, "trim failed")
+        return {"trimmed": trimmed.value, "reclaimed": reclaimed.value}
+
+    def clone_image(self, dst_path: str, size_bytes: Optional[int] = None) -> dict:
+        """
+        Copy the open image to dst_path as a sparse file holding only the
+        blocks in use. size_bytes grows the clone (new block groups must fit
+        the existing group descriptor blocks); shrinking is not supported.
+        Returns bytes copied, the clone's filesystem size and throughput.
+        """
+        copied, size = C.c_uint64(0), C.c_uint64(0)
+        err = self._errbuf()
+        t0 = time.perf_counter()
+        rc = self._dll.ext4_clone(self._handle, _b(dst_path), C.c_uint64(size_bytes or 0),
+                                  C.byref(copied), C.byref(size), err, self._ERRLEN)
+        self._raise_if_err(rc, err, "clone failed")
+        seconds = max(time.perf_counter() - t0, 1e-9)
+        return {"bytes_copied": copied.value, "size": size.value, "seconds": round(seconds, 6),
+                "mb_per_s": round(copied.value / (1024 * 1024) / seconds, 2)}
 
     # ----- class/staticmethods -----
 
     @classmethod
     def mkfs(cls, target_path: str, size_bytes: int, block_size: int = 4096,
-             label: str = "", uuid: Optional[str] = None, dll_path: Optional[str] = None):
+             label: str = "", uuid: Optional[str] = None, dll_path: Optional[str] = None,
+             legacy_layout: bool = False, inline_data: bool = False):
         """
         Create a new ext4 image file.
+
+        Files are extent-mapped (extents, flex_bg, huge_file). legacy_layout=True
+        creates the older block-map layout instead, mainly for comparisons.
+        inline_data=True uses 256-byte inodes and keeps files of up to 128 bytes
+        inside the inode, without a data block.
         """
         dll = _bind(_load_dll(dll_path))
         errlen = 512
         err = C.create_string_buffer(errlen)
-        rc = dll.ext4_mkfs(_b(target_path), C.c_uint64(size_bytes), C.c_uint32(block_size),
-                           _b(label), _b(uuid or ""), err, errlen)
+        flags = (cls._MKFS_LEGACY_LAYOUT if legacy_layout else 0) | (cls._MKFS_INLINE_DATA if inline_data else 0)
+        rc = dll.ext4_mkfs_ex(_b(target_path), C.c_uint64(size_bytes), C.c_uint32(block_size),
+                              _b(label), _b(uuid or ""), flags, err, errlen)
         if rc != 0:
             msg = err.value.decode("utf-8", "ignore") or "mkfs failed"
             raise Ext4Error(msg)
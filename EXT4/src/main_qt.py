@@ -1,15 +1,36 @@
 import sys
 import os
+import re
+from dataclasses import asdict
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QToolBar, QAction, QTreeWidget, 
     QTreeWidgetItem, QTableWidget, QTableWidgetItem, QSplitter,
     QStatusBar, QPlainTextEdit, QFileDialog, QMessageBox,
     QVBoxLayout, QWidget, QLabel, QInputDialog, QDialog, QListWidget,
-    QPushButton, QHBoxLayout
+    QListWidgetItem, QPushButton, QHBoxLayout, QLineEdit, QTabWidget
 )
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, QTimer
 from ext4fs import Ext4FS, Ext4Error
 
+SEARCH_LIMIT = 5000
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+USAGE_TOP_N = 100
+
+
+def parse_size_query(text):
+    """'>10M', '<4K' or '1M-5M' -> (min_size, max_size); None for anything else."""
+    num = r'(\d+)\s*([KMG]?)B?'
+    m = re.fullmatch(r'([<>])\s*' + num, text.strip(), re.I)
+    if m:
+        size = int(m.group(2)) * SIZE_UNITS[m.group(3).upper()]
+        return (size, None) if m.group(1) == '>' else (0, size)
+    m = re.fullmatch(num + r'\s*-\s*' + num, text.strip(), re.I)
+    if m:
+        return (int(m.group(1)) * SIZE_UNITS[m.group(2).upper()],
+                int(m.group(3)) * SIZE_UNITS[m.group(4).upper()])
+    return None
+
+
 class Ext4GUI(QMainWindow):
     def __init__(self):
         super().__init__()
@@ -58,6 +79,22 @@ class Ext4GUI(QMainWindow):
         self.action_props.triggered.connect(self.show_properties)
         toolbar.addAction(self.action_props)
         
+        self.action_usage = QAction('Disk Usage', self)
+        self.action_usage.triggered.connect(self.show_usage)
+        toolbar.addAction(self.action_usage)
+        
+        self.action_stats = QAction('Show Stats', self)
+        self.action_stats.setCheckable(True)
+        self.action_stats.toggled.connect(self.toggle_stats)
+        toolbar.addAction(self.action_stats)
+        
+        # Search over the sidecar path index (built on first use)
+        self.search_box = QLineEdit()
+        self.search_box.setPlaceholderText('Search: name, *.txt, /dir/prefix, >10M')
+        self.search_box.setMaximumWidth(280)
+        self.search_box.returnPressed.connect(self.search)
+        toolbar.addWidget(self.search_box)
+        
         # Create central widget with splitter
         central_widget = QWidget()
         self.setCentralWidget(central_widget)
@@ -91,9 +128,106 @@ class Ext4GUI(QMainWindow):
         self.setStatusBar(self.status_bar)
         self.status_bar.showMessage('Ready')
         
+        # Shim counters (optional, refreshed while 'Show Stats' is checked)
+        self.stats_label = QLabel('')
+        self.stats_label.setVisible(False)
+        self.status_bar.addPermanentWidget(self.stats_label)
+        self.stats_timer = QTimer(self)
+        self.stats_timer.setInterval(1000)
+        self.stats_timer.timeout.connect(self.update_stats)
+        
     def log_message(self, message):
         self.log_panel.appendPlainText(message)
         
+    def toggle_stats(self, enabled):
+        self.stats_label.setVisible(enabled)
+        if enabled:
+            self.update_stats()
+            self.stats_timer.start()
+        else:
+            self.stats_timer.stop()
+            
+    def update_stats(self):
+        if not self.current_image:
+            self.stats_label.setText('No image')
+            return
+        try:
+            st = self.fs.stats()
+        except Ext4Error as e:
+            self.stats_label.setText(f'Stats unavailable: {str(e)}')
+            return
+        calls = sum(op['calls'] for op in st['ops'].values())
+        api_ms = sum(op['ns'] for op in st['ops'].values()) / 1e6
+        self.stats_label.setText(
+            f"calls {calls} ({api_ms:.0f} ms) | namei {st['namei']} lookups {st['lookups']} | "
+            f"inode r/w {st['inode_reads']}/{st['inode_writes']} | "
+            f"blocks r/w {st['block_reads']}/{st['block_writes']} "
+            f"({st['bytes_read'] / 1048576:.1f}/{st['bytes_written'] / 1048576:.1f} MiB) | "
+            f"flush {st['flushes']} ({st['flush_ns'] / 1e6:.0f} ms) | "
+            f"open {st['ops'].get('open', {}).get('ns', 0) / 1e6:.1f} ms | "
+            f"bitmaps {st['bitmap_loads']} ({st['bitmap_ns'] / 1e6:.0f} ms)"
+        )
+        
+    def search(self):
+        query = self.search_box.text().strip()
+        if not query:
+            return
+        if not self.current_image:
+            QMessageBox.warning(self, 'Warning', 'Please open an image first')
+            return
+        try:
+            index = self.fs.index
+            if index is None:
+                self.status_bar.showMessage('Building path index...')
+                QApplication.processEvents()
+                index = self.fs.build_index()
+                self.log_message(f'Built path index: {len(index)} entries')
+            wildcard = any(c in query for c in '*?[')
+            size_range = parse_size_query(query)
+            if size_range:
+                results = index.size_range(*size_range, limit=SEARCH_LIMIT)
+            elif query.startswith('/') and not wildcard:
+                results = index.prefix(query, limit=SEARCH_LIMIT)
+            else:
+                results = index.glob(query if wildcard else f'*{query}*', limit=SEARCH_LIMIT)
+        except (Ext4Error, OSError) as e:
+            QMessageBox.critical(self, 'Error', f'Search failed: {str(e)}')
+            self.log_message(f'Error searching for {query}: {str(e)}')
+            return
+        self.status_bar.showMessage(f'{len(results)} match(es) for {query}')
+        self.show_search_results(query, results)
+        
+    def show_search_results(self, query, results):
+        dialog = QDialog(self)
+        dialog.setWindowTitle(f'Search: {query}')
+        dialog.setGeometry(200, 200, 600, 400)
+        
+        layout = QVBoxLayout()
+        result_list = QListWidget()
+        for entry in results:
+            suffix = '/' if entry.is_dir else f'  ({entry.size} bytes)'
+            item = QListWidgetItem(entry.path + suffix)
+            item.setData(Qt.UserRole, entry)
+            result_list.addItem(item)
+        if len(results) >= SEARCH_LIMIT:
+            layout.addWidget(QLabel(f'Showing the first {SEARCH_LIMIT} matches'))
+        result_list.itemDoubleClicked.connect(lambda item: self.show_index_entry(item.data(Qt.UserRole)))
+        layout.addWidget(result_list)
+        
+        close_btn = QPushButton('Close')
+        close_btn.clicked.connect(dialog.close)
+        layout.addWidget(close_btn)
+        
+        dialog.setLayout(layout)
+        dialog.exec_()
+        
+    def show_index_entry(self, entry):
+        fields = asdict(entry)
+        self.props_table.setRowCount(len(fields))
+        for row, (key, value) in enumerate(fields.items()):
+            self.props_table.setItem(row, 0, QTableWidgetItem(str(key)))
+            self.props_table.setItem(row, 1, QTableWidgetItem(oct(value) if key == 'mode' else str(value)))
+        
     def open_image(self):
         file_path, _ = QFileDialog.getOpenFileName(
             self, 'Open Ext4 Image', '', 'Ext4 Images (*.img *.ext4);;All Files (*)'
@@ -324,7 +458,7 @@ class Ext4GUI(QMainWindow):
                                    QMessageBox.Yes | QMessageBox.No)
         if reply == QMessageBox.Yes:
             try:
-                self.fs.remove(item_path)
+                self.fs.rmtree(item_path)
                 self.log_message(f'Deleted: {item_path}')
                 
                 # Update tree
@@ -423,6 +557,59 @@ class Ext4GUI(QMainWindow):
             QMessageBox.critical(self, 'Error', f'Failed to get properties: {str(e)}')
             self.log_message(f'Error getting properties for {item_path}: {str(e)}')
 
+    def show_usage(self):
+        if not self.current_image:
+            QMessageBox.warning(self, 'Warning', 'Please open an image first')
+            return
+        current_item = self.tree_widget.currentItem()
+        item_path = (current_item.data(0, Qt.UserRole) if current_item else None) or '/'
+        try:
+            self.status_bar.showMessage(f'Computing disk usage of {item_path}...')
+            QApplication.processEvents()
+            usage = self.fs.du(item_path, top_n=USAGE_TOP_N)
+        except Ext4Error as e:
+            QMessageBox.critical(self, 'Error', f'Disk usage failed: {str(e)}')
+            self.log_message(f'Error computing disk usage of {item_path}: {str(e)}')
+            return
+        summary = (f"{item_path}: {usage['alloc'] / 1048576:.1f} MiB allocated, "
+                   f"{usage['size'] / 1048576:.1f} MiB apparent, {usage['files']} files, "
+                   f"{usage['dirs']} directories, {usage['hardlinks']} extra hard links")
+        self.status_bar.showMessage(summary)
+        self.log_message(summary)
+        
+        dialog = QDialog(self)
+        dialog.setWindowTitle(f'Disk Usage: {item_path}')
+        dialog.setGeometry(200, 200, 800, 500)
+        layout = QVBoxLayout()
+        layout.addWidget(QLabel(summary))
+        tabs = QTabWidget()
+        tabs.addTab(self.usage_table(usage['dir_totals'], ['files', 'dirs']), 'Directories')
+        tabs.addTab(self.usage_table(usage['top'], []), f'Largest {USAGE_TOP_N} files')
+        layout.addWidget(tabs)
+        
+        close_btn = QPushButton('Close')
+        close_btn.clicked.connect(dialog.close)
+        layout.addWidget(close_btn)
+        
+        dialog.setLayout(layout)
+        dialog.exec_()
+        
+    def usage_table(self, rows, extra):
+        columns = ['path', 'alloc', 'size'] + extra
+        table = QTableWidget(len(rows), len(columns))
+        table.setHorizontalHeaderLabels(['Path', 'Allocated (bytes)', 'Apparent (bytes)'] +
+                                        [c.capitalize() for c in extra])
+        for row, entry in enumerate(rows):
+            for col, key in enumerate(columns):
+                cell = QTableWidgetItem()
+                # numbers as data so the columns sort numerically
+                cell.setData(Qt.DisplayRole, entry[key])
+                table.setItem(row, col, cell)
+        table.setSortingEnabled(True)
+        table.sortItems(1, Qt.DescendingOrder)
+        table.resizeColumnsToContents()
+        return table
+
 def main():
     app = QApplication(sys.argv)
     window = Ext4GUI()
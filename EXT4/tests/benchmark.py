@@ -0,0 +1,524 @@
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import argparse
+import importlib
+import json
+import platform
+import shutil
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Benchmark suite for the Ext4FS hot paths.
+#
+# Every scenario builds its own synthetic image, times one class of operation
+# and records ops/s, MB/s and the process peak RSS. Results are written as JSON
+# to build_logs/benchmark.json and compared against a stored baseline:
+#
+#   python tests/benchmark.py                      # run, compare with baseline if present
+#   python tests/benchmark.py --save-baseline      # run and store as the new baseline
+#   python tests/benchmark.py --scale 0.1 --only small_files,large_file
+#
+# --backend selects the implementation as "module:Class"; any class with the
+# Ext4FS API works (default: the ctypes shim wrapper).
+#
+# No baseline is committed: absolute rates depend on the machine and disk, so
+# each machine saves its own. A baseline taken with a different --scale or
+# --backend is not compared (counts and code paths differ); with --only just
+# the scenarios present in both runs are.
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE = os.path.join(HERE, 'benchmark_baseline.json')
+DEFAULT_OUTPUT = os.path.join(HERE, '..', 'build_logs', 'benchmark.json')
+
+MiB = 1024 * 1024
+
+
+def peak_rss_kb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def load_backend(spec):
+    module_name, _, class_name = spec.partition(':')
+    return getattr(importlib.import_module(module_name), class_name or 'Ext4FS')
+
+
+class Bench:
+    def __init__(self, backend, workdir, scale):
+        self.backend = backend
+        self.workdir = workdir
+        self.scale = scale
+        self.results = {}
+
+    def n(self, count):
+        return max(1, int(count * self.scale))
+
+    def record(self, name, ops, seconds, nbytes=0, **extra):
+        seconds = max(seconds, 1e-9)
+        res = {
+            'ops': ops,
+            'seconds': round(seconds, 6),
+            'ops_per_s': round(ops / seconds, 2),
+            'peak_rss_kb': peak_rss_kb(),
+        }
+        if nbytes:
+            res['bytes'] = nbytes
+            res['mb_per_s'] = round(nbytes / MiB / seconds, 2)
+        res.update(extra)
+        self.results[name] = res
+        print(f"  {name:<32} {res['ops_per_s']:>12.1f} ops/s"
+              + (f"  {res['mb_per_s']:>9.1f} MB/s" if nbytes else ''))
+
+    def image(self, name, size_mb=256, **mkfs_args):
+        path = os.path.join(self.workdir, name + '.img')
+        if os.path.exists(path):
+            os.remove(path)
+        self.backend.mkfs(path, size_mb * MiB, **mkfs_args)
+        return path
+
+    def fs(self, path, rw=True, **open_args):
+        fs = self.backend()
+        fs.open(path, rw=rw, **open_args)
+        return fs
+
+    # ----- scenarios -----
+
+    def bench_mkfs(self):
+        count = self.n(10)
+        t0 = time.perf_counter()
+        for i in range(count):
+            self.image(f'mkfs_{i % 2}', 256)
+        self.record('mkfs_256mb', count, time.perf_counter() - t0)
+
+    def bench_open(self):
+        img = self.image('open')
+        count = self.n(200)
+        for rw in (False, True):
+            t0 = time.perf_counter()
+            for _ in range(count):
+                fs = self.fs(img, rw=rw)
+                fs.close()
+            self.record(f'open_close_{"rw" if rw else "ro"}', count, time.perf_counter() - t0)
+
+    def bench_small_files(self):
+        img = self.image('small_files', 512)
+        count = self.n(2000)
+        payload = b'key=value\n' * 10
+        fs = self.fs(img)
+        try:
+            fs.mkdirs('/small', 0o755)
+            paths = [f'/small/d{i % 32}/f{i}.conf' for i in range(count)]
+            t0 = time.perf_counter()
+            for p in paths:
+                fs.write_overwrite(p, payload, 0o644)
+            self.record('small_files_write', count, time.perf_counter() - t0, count * len(payload))
+
+            t0 = time.perf_counter()
+            for p in paths:
+                fs.stat(p)
+            self.record('small_files_stat', count, time.perf_counter() - t0)
+
+            t0 = time.perf_counter()
+            nbytes = 0
+            for p in paths:
+                nbytes += len(fs.read(p))
+            self.record('small_files_read', count, time.perf_counter() - t0, nbytes)
+
+            t0 = time.perf_counter()
+            for i in range(32):
+                fs.listdir(f'/small/d{i}')
+            self.record('small_files_listdir', 32, time.perf_counter() - t0)
+
+            t0 = time.perf_counter()
+            for i, p in enumerate(paths):
+                fs.rename(p, f'r{i}.conf')
+            self.record('small_files_rename', count, time.perf_counter() - t0)
+
+            t0 = time.perf_counter()
+            for i in range(count):
+                fs.remove(f'/small/d{i % 32}/r{i}.conf')
+            self.record('small_files_remove', count, time.perf_counter() - t0)
+        finally:
+            fs.close()
+
+    def bench_huge_dir(self):
+        # Create rate is sampled per tenth of the directory so a lookup/insert
+        # cost that grows with directory size (linear dirs) shows up as a
+        # falling rate; with htree the last tenth should match the first.
+        img = self.image('huge_dir', 2048)
+        count = self.n(100000)
+        batch = max(1, count // 10)
+        fs = self.fs(img)
+        try:
+            fs.mkdirs('/huge', 0o755)
+            rates = []
+            t0 = tb = time.perf_counter()
+            for i in range(count):
+                fs.write_overwrite(f'/huge/entry_{i:08d}', b'x', 0o644)
+                if (i + 1) % batch == 0:
+                    now = time.perf_counter()
+                    rates.append(round(batch / max(now - tb, 1e-9), 2))
+                    tb = now
+            self.record('huge_dir_create', count, time.perf_counter() - t0, entries=count,
+                        batch_ops_per_s=rates,
+                        last_to_first=round(rates[-1] / rates[0], 3) if rates else None)
+
+            t0 = time.perf_counter()
+            entries = fs.listdir('/huge')
+            self.record('huge_dir_listdir', 1, time.perf_counter() - t0, entries=len(entries))
+
+            probes = [f'/huge/entry_{i:08d}' for i in range(0, count, max(1, count // 500))]
+            t0 = time.perf_counter()
+            for p in probes:
+                fs.stat(p)
+            self.record('huge_dir_stat', len(probes), time.perf_counter() - t0, entries=count)
+        finally:
+            fs.close()
+
+    def bench_deep_tree(self):
+        img = self.image('deep_tree')
+        depth = 64
+        fs = self.fs(img)
+        try:
+            path = '/' + '/'.join(f'level{i}' for i in range(depth))
+            t0 = time.perf_counter()
+            fs.mkdirs(path, 0o755)
+            self.record('deep_tree_mkdirs', depth, time.perf_counter() - t0)
+
+            count = self.n(500)
+            t0 = time.perf_counter()
+            for _ in range(count):
+                fs.stat(path)
+            self.record('deep_tree_stat_leaf', count, time.perf_counter() - t0, depth=depth)
+
+            t0 = time.perf_counter()
+            cur = ''
+            for i in range(depth):
+                cur += f'/level{i}'
+                fs.listdir(cur)
+            self.record('deep_tree_listdir_walk', depth, time.perf_counter() - t0)
+        finally:
+            fs.close()
+
+    def bench_large_file(self):
+        img = self.image('large_file', 1024)
+        fs = self.fs(img)
+        try:
+            sizes = [4 * 1024, 64 * 1024, MiB, 16 * MiB, self.n(256) * MiB]
+            for size in sizes:
+                label = f'{size // 1024}k' if size < MiB else f'{size // MiB}m'
+                for kind, data in (('random', os.urandom(size)), ('zeros', bytes(size))):
+                    reps = max(1, min(self.n(100), (64 * MiB) // size))
+                    t0 = time.perf_counter()
+                    for _ in range(reps):
+                        fs.write_overwrite(f'/large_{kind}', data, 0o644)
+                    self.record(f'write_{kind}_{label}', reps, time.perf_counter() - t0, reps * size)
+
+                    t0 = time.perf_counter()
+                    for _ in range(reps):
+                        fs.read(f'/large_{kind}', size)
+                    self.record(f'read_{kind}_{label}', reps, time.perf_counter() - t0, reps * size)
+                    del data
+        finally:
+            fs.close()
+
+    def bench_layout(self):
+        # Large files on the default extent layout vs the legacy block-map
+        # layout (legacy_layout=True). io_requests is the number of device
+        # requests one read issues: data plus indirect/extent metadata.
+        sizes = [MiB, 16 * MiB, self.n(128) * MiB]
+        for layout, legacy in (('extents', False), ('blockmap', True)):
+            img = self.image('layout_' + layout, 1024, legacy_layout=legacy)
+            fs = self.fs(img)
+            try:
+                for size in sizes:
+                    label = f'{size // MiB}m'
+                    data = os.urandom(size)
+                    reps = max(1, min(self.n(20), (128 * MiB) // size))
+                    t0 = time.perf_counter()
+                    for _ in range(reps):
+                        fs.write_overwrite(f'/file_{label}', data, 0o644)
+                    self.record(f'layout_write_{layout}_{label}', reps, time.perf_counter() - t0, reps * size)
+
+                    fs.reset_stats()
+                    t0 = time.perf_counter()
+                    for _ in range(reps):
+                        fs.read(f'/file_{label}', size)
+                    elapsed = time.perf_counter() - t0
+                    self.record(f'layout_read_{layout}_{label}', reps, elapsed, reps * size,
+                                io_requests=fs.stats()['block_reads'] // reps)
+                    del data
+            finally:
+                fs.close()
+
+    def bench_inline(self):
+        # Tiny config files with and without inline_data: write/read rate,
+        # device bytes per read and host bytes allocated for the image
+        count = self.n(5000)
+        payload = b'key=value\n' * 5
+        for layout, inline in (('blocks', False), ('inline', True)):
+            img = self.image('inline_' + layout, 256, inline_data=inline)
+            paths = [f'/cfg/d{i % 32}/f{i}.conf' for i in range(count)]
+            fs = self.fs(img)
+            try:
+                t0 = time.perf_counter()
+                for p in paths:
+                    fs.write_overwrite(p, payload, 0o644)
+                self.record(f'inline_write_{layout}', count, time.perf_counter() - t0, count * len(payload))
+            finally:
+                fs.close()
+            fs = self.fs(img, rw=False)
+            try:
+                fs.reset_stats()
+                t0 = time.perf_counter()
+                for p in paths:
+                    fs.read(p)
+                elapsed = time.perf_counter() - t0
+                # st_blocks is missing on Windows
+                allocated = getattr(os.stat(img), 'st_blocks', None)
+                self.record(f'inline_read_{layout}', count, elapsed, count * len(payload),
+                            bytes_read_per_file=fs.stats()['bytes_read'] // count,
+                            image_allocated=allocated * 512 if allocated is not None else None)
+            finally:
+                fs.close()
+
+    def bench_scan(self):
+        # Metadata export: inode-table scan vs walking the tree with listdir+stat
+        img = self.image('scan', 512)
+        count = self.n(20000)
+        fs = self.fs(img)
+        try:
+            for i in range(count):
+                fs.write_overwrite(f'/scan/d{i % 64}/f{i}', b'x', 0o644)
+
+            t0 = time.perf_counter()
+            inodes = sum(len(batch['ino']) for batch in fs.scan_inodes())
+            self.record('scan_inodes', inodes, time.perf_counter() - t0)
+
+            t0 = time.perf_counter()
+            walked, stack = 0, ['/']
+            while stack:
+                d = stack.pop()
+                for e in fs.listdir(d):
+                    if e.name in ('.', '..'):
+                        continue
+                    p = d.rstrip('/') + '/' + e.name
+                    fs.stat(p)
+                    walked += 1
+                    if e.is_dir:
+                        stack.append(p)
+            self.record('scan_walk_listdir_stat', walked, time.perf_counter() - t0)
+        finally:
+            fs.close()
+
+    def bench_submit(self):
+        # Config-tree generation as one batched call vs one call per file
+        img = self.image('submit', 512)
+        count = self.n(10000)
+        payload = b'key=value\n' * 10
+        ops = [('write', f'/cfg/d{i % 100}/f{i}.conf', payload) for i in range(count)]
+        fs = self.fs(img)
+        try:
+            t0 = time.perf_counter()
+            status = fs.submit(ops)
+            self.record('submit_write', count, time.perf_counter() - t0, count * len(payload),
+                        failed=sum(1 for st in status if st))
+
+            t0 = time.perf_counter()
+            fs.submit([('chmod', op[1], 0o600) for op in ops])
+            self.record('submit_chmod', count, time.perf_counter() - t0)
+
+            t0 = time.perf_counter()
+            fs.submit([('remove', op[1]) for op in ops])
+            self.record('submit_remove', count, time.perf_counter() - t0)
+
+            t0 = time.perf_counter()
+            for _, path, data in ops:
+                fs.write_overwrite(path, data, 0o644)
+            self.record('submit_baseline_per_call_write', count, time.perf_counter() - t0,
+                        count * len(payload))
+        finally:
+            fs.close()
+
+    def bench_clone(self):
+        # Golden-image duplication: used-blocks-only clone vs copying the host file
+        img = self.image('clone', 2048)
+        fs = self.fs(img)
+        try:
+            chunk = os.urandom(4 * MiB)
+            for i in range(self.n(50)):
+                fs.write_overwrite(f'/golden/f{i}', chunk, 0o644)
+            image_bytes = os.path.getsize(img)
+
+            dst = os.path.join(self.workdir, 'clone_copy.img')
+            res = fs.clone_image(dst)
+            self.record('clone_image', 1, res['seconds'], res['bytes_copied'], image_bytes=image_bytes)
+            os.remove(dst)
+
+            t0 = time.perf_counter()
+            shutil.copyfile(img, dst)
+            self.record('clone_baseline_copyfile', 1, time.perf_counter() - t0, image_bytes)
+            os.remove(dst)
+        finally:
+            fs.close()
+
+    def bench_flush(self):
+        # mkdirs on an existing directory does no allocation, so this is
+        # essentially the cost of the superblock/bitmap flush per mutation
+        img = self.image('flush')
+        count = self.n(500)
+        fs = self.fs(img)
+        try:
+            fs.mkdirs('/d', 0o755)
+            t0 = time.perf_counter()
+            for _ in range(count):
+                fs.mkdirs('/d', 0o755)
+            self.record('flush_noop_mutation', count, time.perf_counter() - t0)
+        finally:
+            fs.close()
+
+    def bench_journal(self):
+        # Small-file churn with a commit per op vs ops grouped into journal
+        # transactions, then the replay cost of opening a crashed copy
+        count = self.n(5000)
+        payload = b'x' * 100
+        for label, interval in (('per_op', 0.0), ('grouped', 1.0)):
+            img = self.image('journal_' + label)
+            fs = self.fs(img, commit_interval=interval)
+            try:
+                t0 = time.perf_counter()
+                for i in range(count):
+                    fs.write_overwrite(f'/j/d{i % 50}/f{i}', payload, 0o644)
+                fs.sync()
+                st = fs.stats()
+                self.record(f'journal_{label}_write', count, time.perf_counter() - t0, count * len(payload),
+                            commits=st['journal_commits'], journal_blocks=st['journal_blocks'])
+                crash = os.path.join(self.workdir, 'journal_crash.img')
+                shutil.copyfile(img, crash)
+            finally:
+                fs.close()
+            t0 = time.perf_counter()
+            self.fs(crash).close()
+            self.record(f'journal_{label}_replay_open', 1, time.perf_counter() - t0)
+            os.remove(crash)
+
+
+SCENARIOS = ['mkfs', 'open', 'small_files', 'huge_dir', 'deep_tree', 'large_file', 'layout', 'inline', 'scan', 'submit', 'clone', 'flush', 'journal']
+
+# Metrics where a drop beyond the threshold counts as a regression
+RATE_METRICS = ('ops_per_s', 'mb_per_s')
+# Run settings that must match the baseline's for rates to be comparable
+COMPARABLE_META = ('backend', 'scale')
+
+
+def incomparable(meta, baseline_meta):
+    """Settings that differ between a run and its baseline, as 'key: old -> new'."""
+    return [f"{key}: {baseline_meta.get(key)!r} -> {meta.get(key)!r}"
+            for key in COMPARABLE_META if baseline_meta.get(key) != meta.get(key)]
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, res in results.items():
+        base = baseline.get('results', {}).get(name)
+        if not base:
+            continue
+        for metric in RATE_METRICS:
+            if metric in res and base.get(metric):
+                ratio = res[metric] / base[metric]
+                if ratio < 1.0 - threshold:
+                    regressions.append((name, metric, base[metric], res[metric], ratio))
+    return regressions
+
+
+def run_benchmarks(args):
+    backend = load_backend(args.backend)
+    workdir = args.workdir or tempfile.mkdtemp(prefix='ext4bench_')
+    os.makedirs(workdir, exist_ok=True)
+    only = [s for s in args.only.split(',') if s] if args.only else SCENARIOS
+    bench = Bench(backend, workdir, args.scale)
+    print(f"Running benchmarks ({args.backend}, scale={args.scale}) in {workdir}")
+    try:
+        for name in only:
+            if name not in SCENARIOS:
+                raise SystemExit(f"unknown scenario '{name}' (choose from {', '.join(SCENARIOS)})")
+            print(f"[{name}]")
+            getattr(bench, 'bench_' + name)()
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'backend': args.backend,
+            'scale': args.scale,
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'timestamp': int(time.time()),
+        },
+        'results': bench.results,
+    }
+    return report
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description='Ext4FS benchmark suite')
+    ap.add_argument('--backend', default='src.ext4fs:Ext4FS', help='implementation as module:Class')
+    ap.add_argument('--scale', type=float, default=1.0, help='multiplier for operation counts')
+    ap.add_argument('--only', default='', help='comma-separated scenarios: ' + ','.join(SCENARIOS))
+    ap.add_argument('--workdir', default=None, help='directory for synthetic images (default: temp)')
+    ap.add_argument('--keep', action='store_true', help='keep synthetic images')
+    ap.add_argument('--output', default=DEFAULT_OUTPUT)
+    ap.add_argument('--baseline', default=DEFAULT_BASELINE)
+    ap.add_argument('--save-baseline', action='store_true')
+    ap.add_argument('--threshold', type=float, default=0.2,
+                    help='allowed relative slowdown before a metric counts as a regression')
+    args = ap.parse_args(argv)
+
+    report = run_benchmarks(args)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print(f"Results written to {args.output}")
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("No baseline found; run with --save-baseline to create one on this machine.")
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    mismatch = incomparable(report['meta'], baseline.get('meta', {}))
+    if mismatch:
+        print(f"Skipping comparison, baseline {args.baseline} was taken with other settings "
+              f"({'; '.join(mismatch)}); rerun with matching settings or --save-baseline.")
+        return 0
+    if baseline.get('meta', {}).get('platform') != report['meta']['platform']:
+        print(f"Warning: baseline is from {baseline['meta'].get('platform')}; rates may not carry over.")
+    regressions = compare(report['results'], baseline, args.threshold)
+    for name, metric, old, new, ratio in regressions:
+        print(f"REGRESSION {name}.{metric}: {old} -> {new} ({(1 - ratio) * 100:.1f}% slower)")
+    if regressions:
+        return 1
+    print(f"No regressions beyond {args.threshold * 100:.0f}% against {args.baseline}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -27,7 +27,27 @@ def run_dll_function_test():
             'ext4_mkdirs',
             'ext4_remove',
             'ext4_rename',
-            'ext4_mkfs'
+            'ext4_mkfs',
+            'ext4_hash',
+            'ext4_get_stats',
+            'ext4_reset_stats',
+            'ext4_rmtree',
+            'ext4_move',
+            'ext4_copy',
+            'ext4_copytree',
+            'ext4_mkfs_ex',
+            'ext4_scan_inodes',
+            'ext4_fs_info',
+            'ext4_submit',
+            'ext4_trim',
+            'ext4_clone',
+            'ext4_read_at',
+            'ext4_du',
+            'ext4_walk',
+            'ext4_map_digest',
+            'ext4_sync',
+            'ext4_set_commit_interval',
+            'ext4_read_inodes'
         ]
         
         for func_name in required_functions:
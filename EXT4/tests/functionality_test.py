@@ -22,7 +22,31 @@ def run_functionality_test():
         'mkdirs',
         'remove',
         'rename',
-        'mkfs'
+        'mkfs',
+        'hash',
+        'hash_tree',
+        'stats',
+        'reset_stats',
+        'rmtree',
+        'move',
+        'copy',
+        'copytree',
+        'scan_inodes',
+        'group_count',
+        'info',
+        'build_index',
+        'import_tree',
+        'extract_tree',
+        'submit',
+        'trim',
+        'clone_image',
+        'read_at',
+        'export_tar',
+        'import_tar',
+        'du',
+        'walk',
+        'diff',
+        'sync'
     ]
     
     for method in methods:
@@ -3,7 +3,13 @@ import os
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
 
 from src.ext4fs import Ext4FS
+import hashlib
+import io
 import os
+import shutil
+import subprocess
+import tempfile
+import threading
 
 def run_smoke_test():
     IMG = 'test.img'
@@ -30,22 +36,26 @@ def run_smoke_test():
     data = fs.read('/dir/hello.txt')
     assert data == b'Hello world!'
     
+    # Hash the file natively
+    assert fs.hash('/dir/hello.txt', 'sha256') == hashlib.sha256(b'Hello world!').hexdigest()
+    assert fs.hash_tree('/dir', 'sha256') == {'/dir/hello.txt': hashlib.sha256(b'Hello world!').hexdigest()}
+    
     # Check directory listing
     items = fs.listdir('/dir')
-    names = [item['name'] for item in items]
+    names = [item.name for item in items]
     assert 'hello.txt' in names
     
     # Check file stats
     stats = fs.stat('/dir/hello.txt')
-    assert stats['type'] == 'file'
-    assert stats['size'] == 12
+    assert not stats.is_dir
+    assert stats.size == 12
     
     # Rename the file
     fs.rename('/dir/hello.txt', 'hello2.txt')
     
     # Check that old file is gone and new file exists
     items = fs.listdir('/dir')
-    names = [item['name'] for item in items]
+    names = [item.name for item in items]
     assert 'hello.txt' not in names
     assert 'hello2.txt' in names
     
@@ -54,15 +64,187 @@ def run_smoke_test():
     
     # Check that file is gone
     items = fs.listdir('/dir')
-    names = [item['name'] for item in items]
+    names = [item.name for item in items]
     assert 'hello2.txt' not in names
     
+    # Move across directories without copying
+    fs.write_overwrite('/tree/a/b/c.txt', b'data', 0o644)
+    fs.mkdirs('/tree/e', 0o755)
+    fs.move('/tree/a/b', '/tree/e/b')
+    assert fs.read('/tree/e/b/c.txt') == b'data'
+    
+    # Copy a file and a tree inside the image
+    fs.copy('/tree/e/b/c.txt', '/tree/c_copy.txt')
+    assert fs.read('/tree/c_copy.txt') == b'data'
+    fs.copytree('/tree/e', '/tree/e2')
+    assert fs.read('/tree/e2/b/c.txt') == b'data'
+    
+    # Remove a populated tree in one call
+    fs.write_overwrite('/tree/d.txt', b'data', 0o644)
+    fs.rmtree('/tree')
+    assert 'tree' not in [e.name for e in fs.listdir('/')]
+    
+    # Large extent-mapped file that does not end on a block boundary
+    big = os.urandom(3 * 1024 * 1024 + 1)
+    fs.write_overwrite('/big.bin', big, 0o644)
+    assert fs.read('/big.bin') == big
+    fs.write_overwrite('/big.bin', big[:5000], 0o644)
+    assert fs.read('/big.bin') == big[:5000]
+    
+    # Blocks freed by the truncation go back to the host
+    assert fs.trim()['trimmed'] >= 3 * 1024 * 1024
+    assert fs.read('/big.bin') == big[:5000]
+    
+    # Inode-table scan sees the file with its size
+    scanned = {}
+    for batch in fs.scan_inodes(batch=16):
+        scanned.update(zip(batch['ino'], batch['size']))
+    assert scanned[fs.stat('/big.bin').inode] == 5000
+    assert fs.group_count() >= 1
+    
+    # Host tree round trip
+    with tempfile.TemporaryDirectory() as tmp:
+        os.makedirs(os.path.join(tmp, 'in', 'sub'))
+        with open(os.path.join(tmp, 'in', 'sub', 'f.txt'), 'wb') as f:
+            f.write(b'tree data')
+        assert fs.import_tree(os.path.join(tmp, 'in'), '/imported') == (1, 9)
+        assert fs.extract_tree('/imported', os.path.join(tmp, 'out')) == (1, 9)
+        with open(os.path.join(tmp, 'out', 'sub', 'f.txt'), 'rb') as f:
+            assert f.read() == b'tree data'
+    fs.rmtree('/imported')
+    
+    # Tar stream round trip through a pipe, with mode/owner/mtime kept
+    fs.write_overwrite('/tar/sub/f.bin', big, 0o640)
+    fs.submit([('setattr', '/tar/sub/f.bin', 0o640, 1000, 1000, 1234567890)])
+    archive = io.BytesIO()
+    assert fs.export_tar('/tar', archive)['bytes'] == len(big)
+    r, w = os.pipe()
+    writer = threading.Thread(target=lambda: (os.write(w, archive.getvalue()), os.close(w)))
+    writer.start()
+    with os.fdopen(r, 'rb') as pipe:
+        assert fs.import_tar(pipe, '/untar', chunk_size=1 << 20, batch_bytes=1 << 20)['files'] == 1
+    writer.join()
+    assert fs.read('/untar/sub/f.bin') == big
+    st = fs.stat('/untar/sub/f.bin')
+    assert (st.mode & 0o777, st.uid, st.mtime) == (0o640, 1000, 1234567890)
+    
+    # Disk usage: per-directory totals and the largest files in one call
+    usage = fs.du('/untar', top_n=1)
+    assert (usage['files'], usage['dirs']) == (1, 1) and usage['size'] > len(big)
+    assert usage['alloc'] >= len(big)
+    assert [d['path'] for d in usage['dir_totals']] == ['/untar/sub', '/untar']
+    assert usage['top'][0]['path'] == '/untar/sub/f.bin'
+    fs.rmtree('/tar')
+    fs.rmtree('/untar')
+    
+    # Clone holds the same files and can be grown
+    clone = IMG + '.clone'
+    assert fs.clone_image(clone, 128 * 1024 * 1024)['size'] == 128 * 1024 * 1024
+    with Ext4FS() as cfs:
+        cfs.open(clone, rw=True)
+        assert cfs.read('/big.bin') == big[:5000]
+        assert cfs.info()['blocks'] * cfs.info()['block_size'] == 128 * 1024 * 1024
+        
+        # Diff against the changed clone; at most the chmod'ed file is hashed
+        cfs.write_overwrite('/added.txt', b'new', 0o644)
+        cfs.submit([('chmod', '/big.bin', 0o600)])
+        hashes = fs.stats()['ops']['hash']['calls']
+        changes = [(e.path, e.change, e.fields) for e in fs.diff(cfs)]
+        assert changes == [('/added.txt', 'added', ()), ('/big.bin', 'modified', ('mode',))]
+        assert fs.stats()['ops']['hash']['calls'] - hashes <= 1
+    os.remove(clone)
+    
+    # Sidecar path index follows later mutations and survives a reopen
+    index = fs.build_index()
+    assert index.lookup('/big.bin').size == 5000
+    fs.write_overwrite('/docs/readme.txt', b'read me', 0o644)
+    fs.rename('/big.bin', 'big2.bin')
+    assert [e.path for e in fs.index.glob('*.txt')] == ['/docs/readme.txt']
+    assert fs.index.lookup('/big.bin') is None
+    assert [e.path for e in fs.index.size_range(4500, 6000)] == ['/big2.bin']
+    
+    # Batched mutations: one call, one flush, per-op status
+    flushes = fs.stats()['flushes']
+    status = fs.submit([('mkdirs', '/cfg'), ('write', '/cfg/a.conf', b'a=1'),
+                        ('write', '/cfg/b.conf', b'b=2'), ('chmod', '/cfg/a.conf', 0o600),
+                        ('rename', '/cfg/b.conf', 'c.conf'), ('remove', '/cfg/missing')])
+    assert status == [0, 0, 0, 0, 0, -1]
+    assert fs.stats()['flushes'] == flushes + 1
+    assert fs.stat('/cfg/a.conf').mode & 0o777 == 0o600
+    assert fs.read('/cfg/c.conf') == b'b=2'
+    assert [e.path for e in fs.index.prefix('/cfg/')] == ['/cfg/a.conf', '/cfg/c.conf']
+    fs.close()
+    fs.open(IMG, rw=True)
+    assert fs.index is not None and fs.index.lookup('/docs/readme.txt').size == 7
+
+    # Bitmaps are only loaded once something is mutated
+    assert fs.stats()['bitmap_loads'] == 0
+    fs.write_overwrite('/docs/later.txt', b'later', 0o644)
+    assert fs.stats()['bitmap_loads'] == 1
+
     # Close filesystem
     fs.close()
     
+    # Inline data: tiny files live in the inode and grow out of it on demand
+    inline_img = IMG + '.inline'
+    Ext4FS.mkfs(inline_img, 64 * 1024 * 1024, inline_data=True)
+    with Ext4FS() as ifs:
+        ifs.open(inline_img, rw=True)
+        ifs.write_overwrite('/etc/app.conf', b'key=value\n', 0o644)
+        assert ifs.read('/etc/app.conf') == b'key=value\n'
+        assert ifs.du('/etc/app.conf')['alloc'] == 0
+        ifs.copytree('/etc', '/etc2')
+        assert ifs.read('/etc2/app.conf') == b'key=value\n' and ifs.du('/etc2/app.conf')['alloc'] == 0
+        assert ifs.submit([('append', '/etc/app.conf', b'x' * 5000)]) == [0]
+        assert ifs.read('/etc/app.conf') == b'key=value\n' + b'x' * 5000
+        assert ifs.listdir('/etc')[-1].size == 5010
+    os.remove(inline_img)
+    
+    # Journal: grouped ops commit together and a crash copy replays on open
+    journal_img = IMG + '.journal'
+    crash_img = IMG + '.crash'
+    Ext4FS.mkfs(journal_img, 64 * 1024 * 1024)
+    with Ext4FS() as jfs:
+        jfs.open(journal_img, rw=True, commit_interval=60)
+        for i in range(20):
+            jfs.write_overwrite(f'/j/f{i}.txt', b'%d' % i, 0o644)
+        jfs.rename('/j/f0.txt', 'g.txt')
+        jfs.sync()
+        assert jfs.stats()['journal'] == 1 and jfs.stats()['journal_commits'] == 1
+        shutil.copyfile(journal_img, crash_img)
+        jfs.write_overwrite('/uncommitted.txt', b'x', 0o644)
+        jfs.sync(checkpoint=True)
+        assert jfs.stats()['checkpoints'] == 1
+    with Ext4FS() as rfs:
+        # read-only handles replay the log in memory and leave the file alone
+        rfs.open(crash_img, rw=False)
+        assert rfs.read('/j/f19.txt') == b'19' and rfs.read('/j/g.txt') == b'0'
+    with Ext4FS() as cfs:
+        cfs.open(crash_img, rw=True)
+        assert cfs.read('/j/f19.txt') == b'19' and cfs.read('/j/g.txt') == b'0'
+        assert 'uncommitted.txt' not in [e.name for e in cfs.listdir('/')]
+    os.remove(journal_img)
+    os.remove(crash_img)
+    
+    # Journal checkpoints under a growing htree directory on 1K blocks
+    htree_img = IMG + '.htree'
+    Ext4FS.mkfs(htree_img, 64 * 1024 * 1024, block_size=1024)
+    with Ext4FS() as hfs:
+        hfs.open(htree_img, rw=True)
+        for i in range(4000):
+            hfs.write_overwrite(f'/big/f{i}', b'', 0o644)
+        assert hfs.stats()['checkpoints'] >= 3
+        for i in range(4000):
+            hfs.stat(f'/big/f{i}')
+    if shutil.which('e2fsck'):
+        fsck = subprocess.run(['e2fsck', '-fn', htree_img], capture_output=True, text=True)
+        assert fsck.returncode == 0, fsck.stdout
+    os.remove(htree_img)
+    
     # Clean up
-    if os.path.exists(IMG):
-        os.remove(IMG)
+    for path in (IMG, IMG + '.idx', IMG + '.idx.log'):
+        if os.path.exists(path):
+            os.remove(path)
     
     print('Smoke test passed!')
     return True